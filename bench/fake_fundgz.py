@@ -0,0 +1,164 @@
+"""
+本地模拟基金估值接口（替代fundgz.1234567.com.cn），用于压测
+返回与真实接口一致的 jsonpgz({...}); 格式，可配置延迟、错误率、基金数量
+
+启动：python bench/fake_fundgz.py --port 18080 --latency 0.05 --error-rate 0.01 --funds 500
+应用指向模拟接口：FUND_API_URL = 'http://127.0.0.1:18080/js/{fund_code}.js?rt={timestamp}'
+统计：GET /__stats 返回请求次数，GET /__reset 清零
+历史净值：GET /history/{fund_code}.json?start=YYYY-MM-DD&end=YYYY-MM-DD 返回工作日净值行数组，
+应用回填指向：HISTORY_SOURCE = 'http://127.0.0.1:18080/history/{fund_code}.json?start={start}&end={end}'
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FUND_CODE_BASE = 100000  # 模拟基金代码从100000开始连续编号
+
+
+def fund_code_of(index):
+    """第index只模拟基金的代码（6位数字）"""
+    return f"{FUND_CODE_BASE + index:06d}"
+
+
+class FakeFundgzServer(ThreadingHTTPServer):
+    """模拟接口服务：记录请求次数，按配置注入延迟和错误"""
+    daemon_threads = True
+    request_queue_size = 1024  # 默认监听队列只有5，并发压测时会出现1秒的SYN重传延迟
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, fund_count=1000):
+        super().__init__(address, FakeFundgzHandler)
+        self.latency = latency  # 固定延迟（秒）
+        self.jitter = jitter  # 随机附加延迟上限（秒）
+        self.error_rate = error_rate  # 返回500的概率
+        self.fund_count = fund_count  # 有效基金数量，超出编号的代码返回非JSONP（基金不存在）
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'not_found': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats[key] += 1
+
+    def reset(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    @property
+    def url_template(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/js/{{fund_code}}.js?rt={{timestamp}}"
+
+    @property
+    def history_url_template(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/history/{{fund_code}}.json?start={{start}}&end={{end}}"
+
+
+def history_rows(fund_code, start_date, end_date):
+    """模拟基金[start_date, end_date]内工作日的历史净值（同一基金同一天结果固定）"""
+    rows = []
+    day = datetime.strptime(start_date, '%Y-%m-%d').date()
+    end_day = datetime.strptime(end_date, '%Y-%m-%d').date()
+    while day <= end_day:
+        if day.weekday() < 5:
+            record_date = day.strftime('%Y-%m-%d')
+            rnd = random.Random(f"{fund_code}-{record_date}")
+            rows.append({'fund_code': fund_code, 'record_date': record_date,
+                         'dwjz': round(1 + rnd.random() * 2, 4), 'gszzl': round(rnd.uniform(-3, 3), 2)})
+        day += timedelta(days=1)
+    return rows
+
+
+class FakeFundgzHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/javascript; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        if path == '/__stats':
+            with server.lock:
+                return self.send_body(200, json.dumps(server.stats), 'application/json')
+        if path == '/__reset':
+            server.reset()
+            return self.send_body(200, '{}', 'application/json')
+        if path.startswith('/history/'):
+            return self.send_history(path[len('/history/'):].split('.')[0])
+        if not path.startswith('/js/'):
+            return self.send_body(404, 'not found', 'text/plain')
+
+        time.sleep(server.latency + random.random() * server.jitter)
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self.send_body(500, 'internal error', 'text/plain')
+        fund_code = path[len('/js/'):].split('.')[0]
+        if not fund_code.isdigit() or not 0 <= int(fund_code) - FUND_CODE_BASE < server.fund_count:
+            server.count('not_found')
+            return self.send_body(200, 'jsonpgz();')
+        # 同一基金同一分钟内返回相同估值，模拟真实接口的刷新频率
+        rnd = random.Random(f"{fund_code}-{time.strftime('%Y%m%d%H%M')}")
+        dwjz = round(1 + rnd.random() * 2, 4)
+        gszzl = round(rnd.uniform(-3, 3), 2)
+        payload = {
+            'fundcode': fund_code,
+            'name': f"模拟基金{fund_code}",
+            'jzrq': time.strftime('%Y-%m-%d', time.localtime(time.time() - 86400)),
+            'dwjz': f"{dwjz:.4f}",
+            'gsz': f"{dwjz * (1 + gszzl / 100):.4f}",
+            'gszzl': f"{gszzl:.2f}",
+            'gztime': time.strftime('%Y-%m-%d %H:%M')
+        }
+        server.count('ok')
+        self.send_body(200, f"jsonpgz({json.dumps(payload, ensure_ascii=False)});")
+
+    def send_history(self, fund_code):
+        server = self.server
+        time.sleep(server.latency + random.random() * server.jitter)
+        query = parse_qs(urlparse(self.path).query)
+        if not fund_code.isdigit() or not 0 <= int(fund_code) - FUND_CODE_BASE < server.fund_count:
+            server.count('not_found')
+            return self.send_body(200, '[]', 'application/json')
+        today = time.strftime('%Y-%m-%d')
+        rows = history_rows(fund_code, query.get('start', [today])[0], query.get('end', [today])[0])
+        server.count('ok')
+        self.send_body(200, json.dumps(rows), 'application/json')
+
+
+def start_server(host='127.0.0.1', port=0, **options):
+    """后台线程启动模拟接口，port=0随机端口，返回server（server.url_template为接口地址模板）"""
+    server = FakeFundgzServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟基金估值接口')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.05, help='固定延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='随机附加延迟上限（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500的概率')
+    parser.add_argument('--funds', type=int, default=1000, help='有效基金数量')
+    args = parser.parse_args()
+    server = FakeFundgzServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate, fund_count=args.funds)
+    print(f"🚀 模拟基金接口启动：{server.url_template}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+压测数据生成：N个用户 × 每人M只基金 × D天历史收益，写入指定数据库（默认bench/bench.db，不动funds.db）
+用户名 bench_u{序号}，密码统一为123456；基金代码与fake_fundgz的模拟基金一致
+
+用法：python bench/gen_data.py --users 100 --funds 20 --days 250 --fund-pool 500 --db bench/bench.db
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+from fake_fundgz import fund_code_of  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+BENCH_PASSWORD = '123456'
+
+
+def trading_days(days):
+    """今天之前的days个工作日（升序），用于生成历史数据"""
+    result = []
+    day = date.today() - timedelta(days=1)
+    while len(result) < days:
+        if day.weekday() < 5:
+            result.append(day.strftime("%Y-%m-%d"))
+        day -= timedelta(days=1)
+    return result[::-1]
+
+
+def generate(db_path, users, funds_per_user, days, fund_pool, seed=2026):
+    """生成压测数据，返回各表写入行数"""
+    rnd = random.Random(seed)
+    main.DATABASE = db_path
+    main.init_db()
+    dates = trading_days(days)
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    add_time = f"{dates[0]} 09:00:00" if dates else now
+    fund_codes = [fund_code_of(i) for i in range(fund_pool)]
+    # 基金每日涨幅：所有用户共享
+    gszzl_map = {(code, day): round(rnd.uniform(-3, 3), 2) for code in fund_codes for day in dates}
+    password_hash = generate_password_hash(BENCH_PASSWORD)  # 哈希计算很慢，所有用户共用一个
+
+    with main.app.app_context():
+        db = main.get_db(readonly=False)
+        cur = db.cursor()
+        cur.executemany('INSERT OR IGNORE INTO users (username, password, create_time) VALUES (?, ?, ?)',
+                        [(f"bench_u{i}", password_hash, now) for i in range(users)])
+        cur.execute("SELECT id FROM users WHERE username LIKE 'bench_u%'")
+        user_ids = [row['id'] for row in cur.fetchall()]
+        cur.executemany('''
+                        INSERT OR IGNORE INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime,
+                                                                create_time)
+                        VALUES (?, ?, ?, 1.0, 1.0, ?, ?, ?)
+                        ''', [(code, day, day, gszzl_map[(code, day)], f"{day} 15:00", now)
+                              for code in fund_codes for day in dates])
+        relation_rows = []
+        earnings_rows = []
+        for user_id in user_ids:
+            for code in rnd.sample(fund_codes, min(funds_per_user, fund_pool)):
+                principal = round(rnd.uniform(1000, 50000), 2)
+                relation_rows.append((user_id, code, f"模拟基金{code}", principal, add_time))
+                total_earn = 0.0
+                for day in dates:
+                    day_earn, total_earn = main.calc_record_earn(principal, gszzl_map[(code, day)], total_earn)
+                    earnings_rows.append((user_id, code, day, principal, gszzl_map[(code, day)], day_earn,
+                                          total_earn, now))
+        cur.executemany('''
+                        INSERT OR IGNORE INTO user_fund_relation (user_id, fund_code, fund_name, invest_principal,
+                                                                  add_time)
+                        VALUES (?, ?, ?, ?, ?)
+                        ''', relation_rows)
+        cur.executemany('''
+                        INSERT OR IGNORE INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal,
+                                                                  day_gszzl, day_earn, total_earn, create_time)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', earnings_rows)
+        db.commit()
+    return {'users': len(user_ids), 'relations': len(relation_rows), 'earnings': len(earnings_rows),
+            'trend': len(gszzl_map)}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='生成压测数据')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench.db'))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--funds', type=int, default=20, help='每个用户持有的基金数')
+    parser.add_argument('--days', type=int, default=120, help='历史交易日数')
+    parser.add_argument('--fund-pool', type=int, default=200, help='基金池大小（不同基金总数）')
+    parser.add_argument('--seed', type=int, default=2026)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = generate(args.db, args.users, args.funds, args.days, args.fund_pool, args.seed)
+    print(f"✅ 压测数据生成完成（{time.perf_counter() - start:.1f}s）：{counts} -> {args.db}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,259 @@
+"""
+压测脚本：启动模拟基金接口+应用（真实HTTP服务），按场景并发请求，统计延迟分位数、吞吐、SQL条数、外部接口调用次数
+结果保存为JSON，便于不同版本对比
+
+用法：
+    python bench/gen_data.py --users 50 --funds 20 --days 120
+    python bench/run_bench.py --requests 200 --concurrency 16 --latency 0.05 --out bench/results/base.json
+场景：list/stat/pie/dashboard/trend（HTTP接口）、auto_record（定时落库任务）
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import main  # noqa: E402
+import fake_fundgz  # noqa: E402
+from gen_data import BENCH_PASSWORD  # noqa: E402
+
+SCENARIOS = {
+    'list': '/api/fund/list',
+    'stat': '/api/fund/stat',
+    'pie': '/api/fund/chart/pie',
+    'dashboard': '/api/fund/dashboard',
+    'trend': '/api/fund/chart/trend/{fund_code}',
+}
+
+
+class SqlCounter:
+    """统计应用执行的SQL条数（通过连接的trace回调）"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, statement):
+        with self.lock:
+            self.count += 1
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+
+
+SQL_COUNTER = SqlCounter()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """压测时不打印每个请求的访问日志"""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def install_sql_counter():
+    """给连接池新建的连接挂上SQL计数回调（需在应用建立任何连接前调用）"""
+    connect = main.ConnectionPool.connect
+
+    def counting_connect(self):
+        db = connect(self)
+        db.set_trace_callback(SQL_COUNTER)
+        return db
+
+    main.ConnectionPool.connect = counting_connect
+
+
+def percentile(values, pct):
+    """计算分位数（毫秒列表）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return round(ordered[index], 2)
+
+
+def summarize(latencies_ms, errors, elapsed, sql_count, upstream_count):
+    """汇总一个场景的结果"""
+    total = len(latencies_ms) + errors
+    return {
+        'requests': total,
+        'errors': errors,
+        'p50_ms': percentile(latencies_ms, 50),
+        'p95_ms': percentile(latencies_ms, 95),
+        'p99_ms': percentile(latencies_ms, 99),
+        'mean_ms': round(statistics.mean(latencies_ms), 2) if latencies_ms else None,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+        'sql_queries': sql_count,
+        'sql_per_request': round(sql_count / total, 2) if total else None,
+        'upstream_calls': upstream_count,
+        'upstream_per_request': round(upstream_count / total, 3) if total else None,
+    }
+
+
+def load_bench_users(limit):
+    """读取压测用户及其持有基金"""
+    with main.app.app_context():
+        cur = main.get_db(readonly=False).cursor()
+        cur.execute('''
+                    SELECT u.username, r.fund_code
+                    FROM users u
+                             JOIN user_fund_relation r ON r.user_id = u.id
+                    WHERE u.username LIKE 'bench_u%'
+                    ''')
+        users = {}
+        for row in cur.fetchall():
+            users.setdefault(row['username'], []).append(row['fund_code'])
+    return dict(list(users.items())[:limit])
+
+
+def login_sessions(base_url, users):
+    """每个压测用户登录一次，返回[(requests.Session, 持有基金列表)]"""
+    sessions = []
+    for username, fund_codes in users.items():
+        http = requests.Session()
+        res = http.post(f"{base_url}/api/login", json={'username': username, 'password': BENCH_PASSWORD})
+        if res.json().get('code') != 200:
+            raise RuntimeError(f"压测用户{username}登录失败：{res.text}")
+        sessions.append((http, fund_codes))
+    return sessions
+
+
+def run_http_scenario(name, base_url, sessions, total_requests, concurrency, fake_server, cold):
+    """并发请求一个接口场景"""
+    path = SCENARIOS[name]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one_request(i):
+        nonlocal errors
+        http, fund_codes = sessions[i % len(sessions)]
+        url = base_url + path.format(fund_code=random.choice(fund_codes))
+        if cold:
+            main.QUOTE_CACHE.invalidate()
+            main.invalidate_portfolio_snapshot()
+        start = time.perf_counter()
+        try:
+            res = http.get(url, timeout=60)
+            ok = res.status_code == 200 and res.json().get('code') == 200
+        except Exception:
+            ok = False
+        cost = (time.perf_counter() - start) * 1000
+        with lock:
+            if ok:
+                latencies.append(cost)
+            else:
+                errors += 1
+
+    SQL_COUNTER.reset()
+    fake_server.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(total_requests)))
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, errors, elapsed, SQL_COUNTER.count, fake_server.stats['requests'])
+
+
+def run_auto_record_scenario(iterations, fake_server):
+    """执行定时落库任务（每次先删除当天数据，保证每轮都完整落库）"""
+    latencies = []
+    errors = 0
+    SQL_COUNTER.reset()
+    fake_server.reset()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with main.app.app_context():
+            db = main.get_db(readonly=False)
+            today = time.strftime("%Y-%m-%d")
+            db.execute('DELETE FROM user_fund_earnings WHERE record_date = ?', (today,))
+            db.execute('DELETE FROM fund_daily_trend WHERE record_date = ?', (today,))
+            db.commit()
+        main.QUOTE_CACHE.invalidate()
+        job_start = time.perf_counter()
+        result = main.auto_record_data()
+        if result is None:
+            errors += 1
+        else:
+            latencies.append((time.perf_counter() - job_start) * 1000)
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, errors, elapsed, SQL_COUNTER.count, fake_server.stats['requests'])
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='基金管理系统压测')
+    parser.add_argument('--db', default=os.path.join(BENCH_DIR, 'bench.db'), help='gen_data生成的数据库')
+    parser.add_argument('--scenarios', default='list,stat,pie,dashboard,trend,auto_record')
+    parser.add_argument('--requests', type=int, default=200, help='每个HTTP场景的请求数')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=50, help='参与压测的用户数')
+    parser.add_argument('--auto-record-runs', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟接口固定延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='模拟接口随机附加延迟上限（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟接口错误率')
+    parser.add_argument('--fund-pool', type=int, default=1000, help='模拟接口有效基金数')
+    parser.add_argument('--cold', action='store_true', help='每个请求前清空行情缓存和组合快照')
+    parser.add_argument('--out', default=None, help='结果JSON路径，默认bench/results/<时间>.json')
+    args = parser.parse_args()
+
+    fake_server = fake_fundgz.start_server(latency=args.latency, jitter=args.jitter,
+                                           error_rate=args.error_rate, fund_count=args.fund_pool)
+    main.FUND_API_URL = fake_server.url_template
+    main.DATABASE = args.db
+    install_sql_counter()
+    main.init_db()
+    http_server = make_server('127.0.0.1', 0, main.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{http_server.server_port}"
+
+    users = load_bench_users(args.users)
+    if not users:
+        raise SystemExit('❌ 数据库中没有压测用户，请先运行 bench/gen_data.py')
+    sessions = login_sessions(base_url, users)
+
+    results = {}
+    for name in [item.strip() for item in args.scenarios.split(',') if item.strip()]:
+        if name == 'auto_record':
+            results[name] = run_auto_record_scenario(args.auto_record_runs, fake_server)
+        elif name in SCENARIOS:
+            results[name] = run_http_scenario(name, base_url, sessions, args.requests, args.concurrency,
+                                              fake_server, args.cold)
+        else:
+            raise SystemExit(f"❌ 未知场景：{name}")
+        print(f"📊 {name}: {json.dumps(results[name], ensure_ascii=False)}")
+    http_server.shutdown()
+
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'params': vars(args),
+        'quote_cache': main.QUOTE_CACHE.stats(),
+        'results': results,
+    }
+    out = args.out or os.path.join(BENCH_DIR, 'results', time.strftime("%Y%m%d-%H%M%S") + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ 压测结果已保存：{out}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,19 @@
+# gunicorn部署配置：gunicorn -c gunicorn.conf.py main:app
+# 多worker时定时落库、行情刷新由数据库租约保证只有一个worker执行
+# 异步服务模式（需安装uvicorn）：gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker main:asgi_app
+bind = '0.0.0.0:5000'
+workers = 4
+threads = 32  # 每个实时推送连接（SSE）占用一个线程，main.STREAM_MAX_CLIENTS限制每个worker最多16个
+
+
+def on_starting(server):
+    """主进程启动：初始化数据库后关闭连接，避免SQLite连接被fork到worker"""
+    import main
+    main.init_db()
+    main.close_db_pools()
+
+
+def post_fork(server, worker):
+    """每个worker启动后台任务线程（线程不随fork继承，需在worker内启动）"""
+    import main
+    main.start_background_jobs()
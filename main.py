@@ -1,50 +1,474 @@
-from flask import Flask, request, jsonify, g, send_from_directory, session
+from flask import Flask, request, jsonify, g, send_from_directory, session, has_request_context
 from flask_cors import CORS
-from flask_session import Session
+from flask.sessions import SessionInterface, SecureCookieSession
+from flask.json.tag import TaggedJSONSerializer
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import os
 import time
 import requests
 import re
+import json
+import csv
+import gzip
+import zlib
+import struct
+import hashlib
+import secrets
+import mimetypes
 from datetime import datetime, date, timedelta
 import threading
+import socket
 import schedule
+from collections import OrderedDict
+from array import array
+from itertools import accumulate, count, groupby
+from bisect import bisect_left, bisect_right, insort
+import queue
+import contextvars
+import asyncio
+import sys
+from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import brotli  # 可选依赖：安装后优先使用br压缩
+except ImportError:
+    brotli = None
+
+try:
+    import uvicorn  # 可选依赖：ASYNC_MODE=True时用于运行ASGI入口asgi_app
+except ImportError:
+    uvicorn = None
+
+try:
+    import httpx  # 可选依赖：异步服务模式在事件循环上请求行情接口
+except ImportError:
+    httpx = None
+
+try:
+    from a2wsgi import WSGIMiddleware  # 可选依赖：异步服务模式把Flask（WSGI）放在线程池中执行
+except ImportError:
+    WSGIMiddleware = None
 
 # 初始化Flask应用
 app = Flask(__name__)
 CORS(app, supports_credentials=True)  # 支持跨域+Cookie
 app.secret_key = 'FundSystem_2026_Secret_Key_123456'  # 生产环境请修改
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_PERMANENT'] = False
-app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # Session1小时有效期
-Session(app)
+app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # Session1小时有效期（服务端存储，见SQLiteSessionInterface）
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 7 * 24 * 3600  # /static/下静态资源浏览器缓存时间（秒）
 
 # 配置项
 DATABASE = 'funds.db'  # 数据库文件
+DB_BUSY_TIMEOUT = 5000  # 数据库锁等待时间（毫秒），超时才报database is locked
+DB_CACHE_SIZE_KB = 20000  # 每个连接的页缓存大小（KB）
+DB_MMAP_SIZE = 256 * 1024 * 1024  # 内存映射读取大小（字节）
+DB_POOL_SIZE = 8  # 读写连接池各自保留的空闲连接数
 STATIC_FOLDER = os.path.join(os.path.dirname(__file__), 'static')  # 前端目录
 FUND_API_URL = 'http://fundgz.1234567.com.cn/js/{fund_code}.js?rt={timestamp}'  # 真实基金接口
 HEADERS = {  # 请求头，避免接口拦截
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/121.0.0.0 Safari/537.36'
 }
+QUOTE_CACHE_TTL_TRADING = 30  # 行情缓存有效期（秒）：交易时段
+QUOTE_CACHE_TTL_CLOSED = 1800  # 行情缓存有效期（秒）：非交易时段（收盘后估值基本不变）
+QUOTE_CACHE_MAX_SIZE = 2000  # 行情缓存最多保留的基金数，超出按LRU淘汰
+QUOTE_CACHE_BACKEND = 'memory'  # 行情缓存存储：memory=进程内，sqlite=数据库共享（gunicorn多worker共用）
+QUOTE_FETCH_TIMEOUT = 10  # 单只基金接口请求超时（秒）
+QUOTE_FETCH_WORKERS = 16  # 批量拉取行情的最大并发数
+QUOTE_BATCH_DEADLINE = 3  # 接口批量拉取行情的总时限（秒），超时的基金返回旧数据或缺失
+NEGATIVE_CACHE_NOT_FOUND_BASE = 600  # 基金不存在（接口返回非标准JSONP）首次退避时长（秒），连续失败翻倍
+NEGATIVE_CACHE_NOT_FOUND_MAX = 86400  # 基金不存在最长退避时长（秒）
+NEGATIVE_CACHE_ERROR_BASE = 5  # 超时/网络错误首次退避时长（秒），连续失败翻倍
+NEGATIVE_CACHE_ERROR_MAX = 300  # 超时/网络错误最长退避时长（秒）
+NEGATIVE_CACHE_MAX_SIZE = 10000  # 最多记录的失败基金数，超出淘汰最早记录的
+CIRCUIT_FAILURE_THRESHOLD = 5  # 接口连续超时/网络错误达到该次数后熔断，不再请求接口
+CIRCUIT_OPEN_SECONDS = 30  # 熔断持续时长（秒），到期后放行一个探测请求，成功则恢复
+QUOTE_REFRESH_INTERVAL = 60  # 后台行情刷新间隔（秒）：交易时段
+QUOTE_REFRESH_INTERVAL_CLOSED = 1800  # 后台行情刷新间隔（秒）：非交易时段
+JOB_LEASE_SECONDS = 1800  # 定时任务执行租约时长（秒），持有者异常退出后其他进程可在到期后接管
+PORTFOLIO_SNAPSHOT_TTL = 5  # 用户组合快照复用时间（秒），覆盖前端同一批并行请求
+PORTFOLIO_SNAPSHOT_MAX_SIZE = 1000  # 最多缓存的用户组合快照数
+HISTORY_SOURCE = ''  # 历史净值回填数据源：''=不回填，csv:文件路径、json:文件路径（.json数组/.jsonl逐行），或HTTP地址模板（含{fund_code}/{start}/{end}）
+HISTORY_BACKFILL_DAYS = 365  # 新增基金时回填的历史行情天数
+BACKFILL_BATCH_SIZE = 5000  # 历史行情每批upsert行数，每批一个短事务，不长时间占用写锁
+TREND_GAP_MAX_ATTEMPTS = 3  # 缺口日期最多尝试补齐的次数，仍无数据（工作日休市等）不再重试
+TREND_MAX_POINTS = 400  # 趋势图默认目标点数：区间天数超过时改按周汇总，周数仍超过则按月汇总
+TREND_PAGE_MAX = 2000  # 趋势图单页最多返回的点数（limit上限）
+ARCHIVE_KEEP_MONTHS = 3  # 收益明细在线保留的整月数（含当月），更早的整月按用户-基金-月压缩归档
+ARCHIVE_BATCH_PAIRS = 200  # 归档任务每批处理的用户-基金数，每批一个短事务
+ARCHIVE_VACUUM_RATIO = 0.25  # 归档后空闲页占比超过该值时VACUUM回收文件空间，0=不回收
+EARNINGS_STORAGE = 'rows'  # 收益存储模式：rows=每日每个用户-基金落库一行收益明细，derived=只存基金行情+本金时间线，收益按需计算（切回rows需先回填明细）
+DERIVED_CACHE_TTL = 300  # derived模式：基金行情序列/用户收益序列缓存时间（秒），本金修改通过时间线校验立即生效
+DERIVED_CACHE_MAX_SIZE = 20000  # derived模式：最多缓存的用户-基金收益序列数
+FUND_SERIES_CACHE_MAX_SIZE = 5000  # derived模式：最多缓存的基金行情序列数
+STREAM_POLL_INTERVAL = 2  # 实时推送：检查本地行情表变化的间隔（秒），本进程刷新行情后立即检查
+STREAM_HEARTBEAT = 15  # 实时推送心跳间隔（秒），避免代理断开空闲连接
+STREAM_MAX_SECONDS = 300  # 单个推送连接最长保持时间（秒），到期后浏览器自动重连，释放工作线程
+STREAM_MAX_CLIENTS = 16  # 每个进程最多同时保持的推送连接数（每个连接占用一个工作线程）
+COMPRESS_MIN_SIZE = 500  # 响应体超过该字节数才压缩
+COMPRESS_LEVEL = 6  # 接口响应实时压缩级别（预压缩静态文件用最高级别）
+SESSION_CACHE_TTL = 30  # Session进程内读缓存时间（秒），多进程部署时其他进程的登出最迟在该时间后生效
+SESSION_CACHE_MAX_SIZE = 10000  # 进程内最多缓存的Session数
+SESSION_RENEW_RATIO = 0.5  # Session剩余有效期低于该比例时才续期写库，未变化的请求不写库
+SESSION_SWEEP_INTERVAL = 300  # 过期Session批量清理间隔（秒）
+ASYNC_MODE = False  # 异步服务模式：True时python main.py用uvicorn运行asgi_app，组合接口的行情拉取在事件循环上进行
+ASYNC_WORKER_THREADS = 8  # 异步模式下执行Flask视图（数据库读取+计算）的固定线程数
+SLOW_REQUEST_LOG_MS = 0  # 慢请求日志阈值（毫秒），超过则打印SQL/外部接口/Session耗时明细，0=关闭
+ADMIN_USERNAMES = ('admin',)  # 可调用运维接口（任务执行记录、手动回填、清除接口失败记录）的账号
+
+
+# ---------------------- 性能监控（请求耗时/SQL/外部接口/Session，Prometheus文本格式） ----------------------
+class Histogram:
+    """Prometheus直方图：按标签分组累计各桶计数、总和、次数"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # 标签值元组 -> [各桶计数列表, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._series.items()):
+                labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+                prefix = labels + ',' if labels else ''
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{labels}}} {round(total, 6)}')
+                lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+METRIC_REQUEST_SECONDS = Histogram('fund_http_request_duration_seconds', '接口请求耗时',
+                                   ('endpoint', 'method', 'status'), LATENCY_BUCKETS)
+METRIC_SQL_QUERIES = Histogram('fund_sql_queries_per_request', '每个请求执行的SQL条数',
+                               ('endpoint',), COUNT_BUCKETS)
+METRIC_SQL_SECONDS = Histogram('fund_sql_seconds_per_request', '每个请求SQL总耗时',
+                               ('endpoint',), LATENCY_BUCKETS)
+METRIC_UPSTREAM_CALLS = Histogram('fund_upstream_calls_per_request', '每个请求调用外部行情接口次数',
+                                  ('endpoint',), COUNT_BUCKETS)
+METRIC_SESSION_SECONDS = Histogram('fund_session_seconds_per_request', '每个请求Session读写耗时',
+                                   ('endpoint',), LATENCY_BUCKETS)
+METRIC_UPSTREAM_SECONDS = Histogram('fund_upstream_quote_duration_seconds',
+                                    '外部行情接口调用耗时（success=成功，failure=失败，stale=估值时间非今日）',
+                                    ('result',), LATENCY_BUCKETS)
+ALL_METRICS = (METRIC_REQUEST_SECONDS, METRIC_SQL_QUERIES, METRIC_SQL_SECONDS, METRIC_UPSTREAM_CALLS,
+               METRIC_SESSION_SECONDS, METRIC_UPSTREAM_SECONDS)
+
+# 当前请求的性能统计（contextvars：提交到线程池时复制上下文，拉取行情线程也能记到同一请求上）
+REQUEST_PERF = contextvars.ContextVar('request_perf', default=None)
+
+
+class RequestPerf:
+    """单个请求的耗时明细"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.upstream = {'success': 0, 'failure': 0, 'stale': 0}
+        self.upstream_seconds = 0.0
+        self.session_seconds = 0.0
+        self.endpoint = None
+        self.status = None
+        self.lock = threading.Lock()
+
+    def add_sql(self, seconds, count=1):
+        with self.lock:
+            self.sql_count += count
+            self.sql_seconds += seconds
+
+    def add_upstream(self, result, seconds):
+        with self.lock:
+            self.upstream[result] += 1
+            self.upstream_seconds += seconds
+
+    def add_session(self, seconds):
+        with self.lock:
+            self.session_seconds += seconds
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """统计SQL条数与耗时（含取结果、逐行迭代游标）到当前请求"""
+
+    def _timed(self, method, count, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            perf = REQUEST_PERF.get()
+            if perf is not None:
+                perf.add_sql(time.perf_counter() - start, count)
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, 1, *args)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, 1, *args)
+
+    def fetchone(self):
+        return self._timed(sqlite3.Cursor.fetchone, 0)
+
+    def fetchall(self):
+        return self._timed(sqlite3.Cursor.fetchall, 0)
+
+    def __next__(self):
+        return self._timed(sqlite3.Cursor.__next__, 0)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """连接上直接execute也走统计游标"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+def record_upstream_call(result, seconds):
+    """记录一次外部行情接口调用（result：success/failure/stale）"""
+    METRIC_UPSTREAM_SECONDS.observe(seconds, result)
+    perf = REQUEST_PERF.get()
+    if perf is not None:
+        perf.add_upstream(result, seconds)
+
+
+class PerfMiddleware:
+    """
+    WSGI中间件：请求最外层计时（含Session读写），结束后写入直方图，超过阈值打印慢请求明细
+    响应体由PerfResponseBody包装，流式响应（生成器）计时到服务器迭代完、调用close()为止
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        perf = RequestPerf()
+        token = REQUEST_PERF.set(perf)
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.finish(perf, environ)
+            raise
+        finally:
+            REQUEST_PERF.reset(token)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(response, file_wrapper):
+            # 服务器的文件包装（sendfile）不能再包一层，静态文件在此结束计时
+            self.finish(perf, environ)
+            return response
+        return PerfResponseBody(response, perf, environ)
+
+    @staticmethod
+    def finish(perf, environ):
+        endpoint = perf.endpoint or 'unknown'
+        seconds = time.perf_counter() - perf.start
+        METRIC_REQUEST_SECONDS.observe(seconds, endpoint, environ.get('REQUEST_METHOD', ''), str(perf.status))
+        METRIC_SQL_QUERIES.observe(perf.sql_count, endpoint)
+        METRIC_SQL_SECONDS.observe(perf.sql_seconds, endpoint)
+        METRIC_UPSTREAM_CALLS.observe(sum(perf.upstream.values()), endpoint)
+        METRIC_SESSION_SECONDS.observe(perf.session_seconds, endpoint)
+        if SLOW_REQUEST_LOG_MS and seconds * 1000 >= SLOW_REQUEST_LOG_MS:
+            print(f"🐢 慢请求 {environ.get('REQUEST_METHOD')} {environ.get('PATH_INFO')} "
+                  f"{seconds * 1000:.1f}ms：SQL {perf.sql_count}条/{perf.sql_seconds * 1000:.1f}ms，"
+                  f"外部接口 成功{perf.upstream['success']}/失败{perf.upstream['failure']}/"
+                  f"非今日{perf.upstream['stale']}次/{perf.upstream_seconds * 1000:.1f}ms，"
+                  f"Session {perf.session_seconds * 1000:.1f}ms")
+
+
+class PerfResponseBody:
+    """
+    WSGI响应体包装：迭代期间的SQL/外部接口调用仍计入该请求，
+    响应体迭代完或close()（以先到者为准）时结束计时并写入直方图
+    """
+
+    def __init__(self, iterable, perf, environ):
+        self.iterable = iterable
+        self.perf = perf
+        self.environ = environ
+        self.finished = False
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            token = REQUEST_PERF.set(self.perf)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                self.finish()
+                return
+            finally:
+                REQUEST_PERF.reset(token)
+            yield chunk
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            PerfMiddleware.finish(self.perf, self.environ)
+
+    def close(self):
+        token = REQUEST_PERF.set(self.perf)
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            REQUEST_PERF.reset(token)
+            self.finish()
+
+
+class TimedSessionInterface:
+    """包装Session存储，统计每个请求Session读写耗时，其余属性透传给原存储"""
+
+    def __init__(self, interface):
+        self.interface = interface
+
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            perf = REQUEST_PERF.get()
+            if perf is not None:
+                perf.add_session(time.perf_counter() - start)
+
+    def open_session(self, app, request):
+        return self._timed(self.interface.open_session, app, request)
+
+    def save_session(self, app, session, response):
+        return self._timed(self.interface.save_session, app, session, response)
+
+
+app.wsgi_app = PerfMiddleware(app.wsgi_app)
+
+
+@app.after_request
+def record_request_endpoint(response):
+    """记录当前请求的接口名和状态码，供中间件按接口汇总"""
+    perf = REQUEST_PERF.get()
+    if perf is not None:
+        perf.endpoint = request.endpoint
+        perf.status = response.status_code
+    return response
 
 
 # ---------------------- 数据库工具函数（核心：4张表初始化） ----------------------
-def get_db():
-    """获取数据库连接，返回字典格式行数据"""
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+class ConnectionPool:
+    """
+    SQLite连接池：连接在请求间复用（避免每个请求重新打开文件、重建页缓存）
+    所有连接开启WAL（读写互不阻塞）、synchronous=NORMAL、busy_timeout、页缓存与mmap
+    readonly=True的连接以只读模式打开，供GET接口使用，不会持有写锁
+    """
+
+    def __init__(self, database, readonly=False, max_idle=DB_POOL_SIZE):
+        self.database = database
+        self.readonly = readonly
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def connect(self):
+        """新建连接并设置连接参数"""
+        if self.readonly:
+            db = sqlite3.connect(f'file:{os.path.abspath(self.database)}?mode=ro', uri=True,
+                                 timeout=DB_BUSY_TIMEOUT / 1000, check_same_thread=False,
+                                 factory=InstrumentedConnection)
+        else:
+            db = sqlite3.connect(self.database, timeout=DB_BUSY_TIMEOUT / 1000, check_same_thread=False,
+                                 factory=InstrumentedConnection)
+            db.execute('PRAGMA journal_mode=WAL')  # WAL持久化在数据库文件中，写连接设置一次即可
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT)}')
+        db.execute(f'PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}')
+        db.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+        if self.readonly:
+            db.execute('PRAGMA query_only=ON')
         db.row_factory = sqlite3.Row  # 行转字典，方便取值
+        return db
+
+    def acquire(self):
+        """取一个空闲连接，没有则新建"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, db):
+        """归还连接：回滚未提交事务，空闲连接已满则关闭"""
+        try:
+            if db.in_transaction:
+                db.rollback()
+            self._idle.put_nowait(db)
+        except (queue.Full, sqlite3.Error):
+            db.close()
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+DB_POOLS = {}  # (数据库文件, 是否只读) -> ConnectionPool
+DB_POOLS_LOCK = threading.Lock()
+
+
+def get_db_pool(readonly=False):
+    """获取连接池（按数据库文件+读写类型懒加载）"""
+    key = (DATABASE, readonly)
+    pool = DB_POOLS.get(key)
+    if pool is None:
+        with DB_POOLS_LOCK:
+            pool = DB_POOLS.setdefault(key, ConnectionPool(DATABASE, readonly=readonly))
+    return pool
+
+
+def get_db(readonly=None):
+    """
+    获取数据库连接，返回字典格式行数据（只读/读写连接分别缓存在当前上下文，结束时一起归还）
+    :param readonly: 是否只读连接，默认GET/HEAD请求用只读连接，其余（含定时任务）用读写连接；
+                     未指定时若已取过读写连接则沿用（读到本请求未提交的写入）
+    """
+    if readonly is None:
+        if getattr(g, '_database_rw', None) is not None:
+            return g._database_rw
+        readonly = has_request_context() and request.method in ('GET', 'HEAD')
+    attr = '_database_ro' if readonly else '_database_rw'
+    db = getattr(g, attr, None)
+    if db is None:
+        db = get_db_pool(readonly).acquire()
+        setattr(g, attr, db)
     return db
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """请求结束自动关闭数据库连接"""
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    """请求结束自动归还数据库连接（只读、读写）到各自的连接池"""
+    for attr, readonly in (('_database_ro', True), ('_database_rw', False)):
+        db = g.pop(attr, None)
+        if db is not None:
+            get_db_pool(readonly).release(db)
 
 
 def init_db():
@@ -241,6 +665,467 @@ def init_db():
                         ))
         db.commit()
         print("✅ 数据库初始化完成，严格创建4张指定表，插入测试用户")
+        # 执行版本化迁移（索引等后续表结构变更），并检查热点查询执行计划
+        run_migrations(db)
+        check_query_plans(db)
+
+
+# ---------------------- 数据库迁移（版本号记录在PRAGMA user_version） ----------------------
+# 迁移脚本按版本号递增追加，已执行的版本不会重复执行；每个版本的步骤为SQL字符串或接收cursor的函数
+MIGRATIONS = [
+    (1, '热点查询覆盖索引', [
+        # 基金列表：WHERE user_id=? ORDER BY add_time DESC，免排序
+        'CREATE INDEX IF NOT EXISTS idx_relation_user_add_time ON user_fund_relation (user_id, add_time)',
+        # 历史收益汇总/昨日收益/趋势图：按用户+基金+日期范围扫描，覆盖收益字段免回表
+        'CREATE INDEX IF NOT EXISTS idx_earnings_user_fund_date '
+        'ON user_fund_earnings (user_id, fund_code, record_date, day_earn, total_earn, day_gszzl)',
+        # 基金行情按日期范围读取，覆盖涨幅/净值字段免回表
+        'CREATE INDEX IF NOT EXISTS idx_trend_fund_date '
+        'ON fund_daily_trend (fund_code, record_date, gszzl, dwjz)',
+    ]),
+    (2, '基金实时行情表（后台刷新，接口直接读取）', [
+        '''
+        CREATE TABLE IF NOT EXISTS fund_intraday_quote
+        (
+            fund_code   TEXT PRIMARY KEY,
+            fund_name   TEXT NOT NULL,
+            jzrq        TEXT NOT NULL, -- 净值日期
+            dwjz        REAL NOT NULL, -- 单位净值
+            gsz         REAL NOT NULL, -- 估值净值
+            gszzl       REAL NOT NULL, -- 实时涨幅（%）
+            gztime      TEXT NOT NULL, -- 估值更新时间
+            update_ts   REAL NOT NULL  -- 本地刷新时间戳（秒）
+        )
+        ''',
+    ]),
+    (3, '跨进程共享缓存表（多worker共用行情缓存）', [
+        '''
+        CREATE TABLE IF NOT EXISTS shared_cache
+        (
+            cache_key   TEXT PRIMARY KEY, -- 命名空间:key
+            payload     TEXT,             -- JSON结果，NULL表示仅有回源租约
+            expires_at  REAL NOT NULL,    -- 过期时间戳（秒）
+            lease_owner TEXT,             -- 回源租约持有者（进程标识）
+            lease_until REAL NOT NULL,    -- 租约到期时间戳（秒）
+            access_ts   REAL NOT NULL     -- 最近访问时间戳（写入，命中批量刷新），用于LRU淘汰
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_shared_cache_access ON shared_cache (access_ts)',
+    ]),
+    (4, '定时任务租约表+执行记录表（多进程只有一个执行定时任务）', [
+        '''
+        CREATE TABLE IF NOT EXISTS job_lease
+        (
+            lease_name  TEXT PRIMARY KEY, -- 任务名（每日任务带日期，如auto_record_data:2026-02-08）
+            owner       TEXT    NOT NULL, -- 持有者（主机名-进程号）
+            lease_until REAL    NOT NULL, -- 租约到期时间戳（秒）
+            done        INTEGER NOT NULL DEFAULT 0 -- 1=已成功执行，不再被抢占
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS job_runs
+        (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_name     TEXT    NOT NULL,
+            run_key      TEXT    NOT NULL, -- 执行批次（如日期）
+            owner        TEXT    NOT NULL, -- 执行进程
+            start_time   TEXT    NOT NULL,
+            end_time     TEXT,
+            duration     REAL,             -- 耗时（秒）
+            rows_written INTEGER NOT NULL DEFAULT 0,
+            failures     INTEGER NOT NULL DEFAULT 0,
+            status       TEXT    NOT NULL, -- running/success/failed
+            error        TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_job_runs_name_start ON job_runs (job_name, start_time)',
+    ]),
+    (5, '用户基金收益汇总表（累计收益增量维护，读取不再SUM明细）', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_fund_summary
+        (
+            user_id          INTEGER NOT NULL,
+            fund_code        TEXT    NOT NULL,
+            last_record_date TEXT    NOT NULL,            -- 最近一条收益记录日期
+            total_earn       REAL    NOT NULL DEFAULT 0,  -- 截至最近记录日的累计收益（当日收益之和）
+            last_day_gszzl   REAL    NOT NULL DEFAULT 0,  -- 最近记录日涨幅
+            last_day_earn    REAL    NOT NULL DEFAULT 0,  -- 最近记录日收益
+            prev_record_date TEXT,                        -- 上一条收益记录日期（最近记录为今日时作为"昨日"）
+            prev_day_gszzl   REAL,
+            prev_day_earn    REAL,
+            update_time      TEXT    NOT NULL,
+            PRIMARY KEY (user_id, fund_code)
+        )
+        ''',
+        # 收益明细每插入一行，同一事务内累加汇总行（INSERT冲突跳过的行不会触发）
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_earnings_summary_insert
+            AFTER INSERT
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO user_fund_summary (user_id, fund_code, last_record_date, total_earn, last_day_gszzl,
+                                           last_day_earn, update_time)
+            VALUES (NEW.user_id, NEW.fund_code, NEW.record_date, NEW.day_earn, NEW.day_gszzl, NEW.day_earn,
+                    NEW.create_time)
+            ON CONFLICT(user_id, fund_code) DO UPDATE SET
+                total_earn       = round(total_earn + excluded.total_earn, 2),
+                prev_record_date = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN last_record_date
+                                       WHEN excluded.last_record_date > coalesce(prev_record_date, '')
+                                           THEN excluded.last_record_date
+                                       ELSE prev_record_date END,
+                prev_day_gszzl   = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN last_day_gszzl
+                                       WHEN excluded.last_record_date > coalesce(prev_record_date, '')
+                                           THEN excluded.last_day_gszzl
+                                       ELSE prev_day_gszzl END,
+                prev_day_earn    = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN last_day_earn
+                                       WHEN excluded.last_record_date > coalesce(prev_record_date, '')
+                                           THEN excluded.last_day_earn
+                                       ELSE prev_day_earn END,
+                last_day_gszzl   = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN excluded.last_day_gszzl
+                                       ELSE last_day_gszzl END,
+                last_day_earn    = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN excluded.last_day_earn
+                                       ELSE last_day_earn END,
+                last_record_date = max(last_record_date, excluded.last_record_date),
+                update_time      = excluded.update_time;
+        END
+        ''',
+        lambda cur: rebuild_fund_summaries(cur, archived=False),
+    ]),
+    (6, '收益明细按基金+日期索引（行情修正/本金修改后按基金批量重算）', [
+        'CREATE INDEX IF NOT EXISTS idx_earnings_fund_date ON user_fund_earnings (fund_code, record_date, user_id)',
+    ]),
+    (7, '收益周/月汇总表（长区间趋势图读汇总行，不再扫描每日明细）', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_fund_earnings_rollup
+        (
+            user_id      INTEGER NOT NULL,
+            fund_code    TEXT    NOT NULL,
+            period       TEXT    NOT NULL, -- week=自然周（周一开始），month=自然月
+            period_start TEXT    NOT NULL, -- 周期起始日期
+            first_date   TEXT    NOT NULL, -- 周期内第一条收益记录日期
+            last_date    TEXT    NOT NULL, -- 周期内最后一条收益记录日期
+            days         INTEGER NOT NULL, -- 周期内记录天数
+            open_total   REAL    NOT NULL, -- 第一条记录的累计收益
+            high_total   REAL    NOT NULL, -- 周期内累计收益最高值
+            low_total    REAL    NOT NULL, -- 周期内累计收益最低值
+            close_total  REAL    NOT NULL, -- 最后一条记录的累计收益
+            sum_day_earn REAL    NOT NULL, -- 周期内当日收益之和
+            period_gszzl REAL    NOT NULL, -- 周期内复合涨幅（%）
+            PRIMARY KEY (user_id, fund_code, period, period_start)
+        )
+        ''',
+        # 收益明细有变化的用户-基金及最早变化日期，读取趋势图时只重建变化日期之后的周期
+        '''
+        CREATE TABLE IF NOT EXISTS earnings_rollup_dirty
+        (
+            user_id   INTEGER NOT NULL,
+            fund_code TEXT    NOT NULL,
+            from_date TEXT    NOT NULL,
+            PRIMARY KEY (user_id, fund_code)
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_earnings_rollup_insert
+            AFTER INSERT
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO earnings_rollup_dirty (user_id, fund_code, from_date)
+            VALUES (NEW.user_id, NEW.fund_code, NEW.record_date)
+            ON CONFLICT(user_id, fund_code) DO UPDATE SET from_date = min(from_date, excluded.from_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_earnings_rollup_update
+            AFTER UPDATE
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO earnings_rollup_dirty (user_id, fund_code, from_date)
+            VALUES (NEW.user_id, NEW.fund_code, min(OLD.record_date, NEW.record_date))
+            ON CONFLICT(user_id, fund_code) DO UPDATE SET from_date = min(from_date, excluded.from_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_earnings_rollup_delete
+            AFTER DELETE
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO earnings_rollup_dirty (user_id, fund_code, from_date)
+            VALUES (OLD.user_id, OLD.fund_code, OLD.record_date)
+            ON CONFLICT(user_id, fund_code) DO UPDATE SET from_date = min(from_date, excluded.from_date);
+        END
+        ''',
+        # 已有数据全部标记为待重建，首次打开趋势图时生成汇总
+        '''
+        INSERT OR REPLACE INTO earnings_rollup_dirty (user_id, fund_code, from_date)
+        SELECT user_id, fund_code, MIN(record_date)
+        FROM user_fund_earnings
+        GROUP BY user_id, fund_code
+        ''',
+    ]),
+    (8, 'Session表（替代文件Session，过期时间索引用于批量清理）', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_sessions
+        (
+            sid        TEXT PRIMARY KEY,
+            data       TEXT NOT NULL, -- Session内容（TaggedJSON）
+            expires_at REAL NOT NULL  -- 过期时间戳
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_user_sessions_expires ON user_sessions (expires_at)',
+    ]),
+    (9, '收益明细归档表（已结束的整月压缩为一行，见pack_earnings_period）', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_fund_earnings_archive
+        (
+            user_id       INTEGER NOT NULL,
+            fund_code     TEXT    NOT NULL,
+            period_start  TEXT    NOT NULL, -- 月份1日
+            first_date    TEXT    NOT NULL,
+            last_date     TEXT    NOT NULL,
+            days          INTEGER NOT NULL,
+            open_total    REAL    NOT NULL, -- 周期内累计收益首/高/低/末值（月汇总可直接读取，不解包）
+            high_total    REAL    NOT NULL,
+            low_total     REAL    NOT NULL,
+            close_total   REAL    NOT NULL,
+            sum_day_earn  REAL    NOT NULL, -- 周期内当日收益之和（收益汇总行重建用）
+            period_gszzl  REAL    NOT NULL, -- 周期复合涨幅（%）
+            data          BLOB    NOT NULL, -- 压缩的每日明细：日期偏移+本金/涨幅/收益/累计收益数组
+            PRIMARY KEY (user_id, fund_code, period_start)
+        ) WITHOUT ROWID
+        ''',
+        # 行情修正/回填按基金+日期解档
+        'CREATE INDEX IF NOT EXISTS idx_earnings_archive_fund ON user_fund_earnings_archive (fund_code, last_date)',
+    ]),
+    (10, '用户组合每日汇总表（组合趋势图按用户+日期范围读取，不再逐基金扫描明细）', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_portfolio_daily
+        (
+            user_id          INTEGER NOT NULL,
+            record_date      TEXT    NOT NULL,
+            invest_principal REAL    NOT NULL, -- 当日有收益记录的基金投入本金之和
+            day_earn         REAL    NOT NULL, -- 当日收益之和
+            total_earn       REAL    NOT NULL, -- 截至当日累计收益（与收益汇总行同口径，只统计添加日之后）
+            funds            INTEGER NOT NULL, -- 当日有收益记录的基金数
+            PRIMARY KEY (user_id, record_date)
+        ) WITHOUT ROWID
+        ''',
+        # 待重建标记：收益明细变化的最早日期，落库/回填任务或组合趋势图读取时重建该日期之后的汇总
+        '''
+        CREATE TABLE IF NOT EXISTS portfolio_daily_dirty
+        (
+            user_id   INTEGER PRIMARY KEY,
+            from_date TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_portfolio_daily_insert
+            AFTER INSERT
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO portfolio_daily_dirty (user_id, from_date)
+            VALUES (NEW.user_id, NEW.record_date)
+            ON CONFLICT(user_id) DO UPDATE SET from_date = min(from_date, excluded.from_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_portfolio_daily_update
+            AFTER UPDATE
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO portfolio_daily_dirty (user_id, from_date)
+            VALUES (NEW.user_id, min(OLD.record_date, NEW.record_date))
+            ON CONFLICT(user_id) DO UPDATE SET from_date = min(from_date, excluded.from_date);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_portfolio_daily_delete
+            AFTER DELETE
+            ON user_fund_earnings
+        BEGIN
+            INSERT INTO portfolio_daily_dirty (user_id, from_date)
+            VALUES (OLD.user_id, OLD.record_date)
+            ON CONFLICT(user_id) DO UPDATE SET from_date = min(from_date, excluded.from_date);
+        END
+        ''',
+        # 已有用户全部标记为待重建（空字符串=全部历史）
+        '''
+        INSERT OR REPLACE INTO portfolio_daily_dirty (user_id, from_date)
+        SELECT DISTINCT user_id, ''
+        FROM user_fund_relation
+        ''',
+    ]),
+    (11, '用户本金时间线（derived模式由共享行情+本金时间线计算收益）', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_principal_history
+        (
+            user_id          INTEGER NOT NULL,
+            fund_code        TEXT    NOT NULL,
+            effective_date   TEXT    NOT NULL, -- 本金生效日期（含）
+            invest_principal REAL    NOT NULL,
+            PRIMARY KEY (user_id, fund_code, effective_date)
+        ) WITHOUT ROWID
+        ''',
+        lambda cur: seed_principal_history(cur),
+    ]),
+    (12, '收益汇总触发器只累加添加日及之后的收益（与重建口径一致）', [
+        'DROP TRIGGER IF EXISTS trg_earnings_summary_insert',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_earnings_summary_insert
+            AFTER INSERT
+            ON user_fund_earnings
+            WHEN NEW.record_date >= (SELECT substr(add_time, 1, 10)
+                                     FROM user_fund_relation
+                                     WHERE user_id = NEW.user_id
+                                       AND fund_code = NEW.fund_code)
+        BEGIN
+            INSERT INTO user_fund_summary (user_id, fund_code, last_record_date, total_earn, last_day_gszzl,
+                                           last_day_earn, update_time)
+            VALUES (NEW.user_id, NEW.fund_code, NEW.record_date, NEW.day_earn, NEW.day_gszzl, NEW.day_earn,
+                    NEW.create_time)
+            ON CONFLICT(user_id, fund_code) DO UPDATE SET
+                total_earn       = round(total_earn + excluded.total_earn, 2),
+                prev_record_date = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN last_record_date
+                                       WHEN excluded.last_record_date > coalesce(prev_record_date, '')
+                                           THEN excluded.last_record_date
+                                       ELSE prev_record_date END,
+                prev_day_gszzl   = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN last_day_gszzl
+                                       WHEN excluded.last_record_date > coalesce(prev_record_date, '')
+                                           THEN excluded.last_day_gszzl
+                                       ELSE prev_day_gszzl END,
+                prev_day_earn    = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN last_day_earn
+                                       WHEN excluded.last_record_date > coalesce(prev_record_date, '')
+                                           THEN excluded.last_day_earn
+                                       ELSE prev_day_earn END,
+                last_day_gszzl   = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN excluded.last_day_gszzl
+                                       ELSE last_day_gszzl END,
+                last_day_earn    = CASE
+                                       WHEN excluded.last_record_date > last_record_date THEN excluded.last_day_earn
+                                       ELSE last_day_earn END,
+                last_record_date = max(last_record_date, excluded.last_record_date),
+                update_time      = excluded.update_time;
+        END
+        ''',
+        # 已按旧触发器累加了添加日之前收益的汇总行重建
+        lambda cur: rebuild_fund_summaries(cur),
+    ]),
+    (13, '行情缺口补齐尝试记录（工作日休市等补不到的日期不再每天重试）', [
+        '''
+        CREATE TABLE IF NOT EXISTS trend_gap_attempts
+        (
+            fund_code    TEXT    NOT NULL,
+            record_date  TEXT    NOT NULL,
+            attempts     INTEGER NOT NULL DEFAULT 0, -- 已尝试补齐次数
+            last_attempt TEXT    NOT NULL,
+            PRIMARY KEY (fund_code, record_date)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+]
+
+
+def run_migrations(db):
+    """按版本顺序执行未执行过的迁移，每个版本一个事务，成功后更新PRAGMA user_version"""
+    cur = db.cursor()
+    current_version = cur.execute('PRAGMA user_version').fetchone()[0]
+    for version, desc, steps in MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            cur.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            cur.execute(f'PRAGMA user_version = {int(version)}')
+            db.commit()
+            print(f"✅ 数据库迁移v{version}完成：{desc}")
+        except Exception as e:
+            db.rollback()
+            print(f"❌ 数据库迁移v{version}失败：{desc} - {str(e)}")
+            raise
+
+
+# 接口热点查询（参数用占位值），用于检查执行计划是否全表扫描
+HOT_QUERIES = [
+    ('基金列表', '''
+        SELECT * FROM user_fund_relation WHERE user_id = ? ORDER BY add_time DESC
+    ''', (0,)),
+    ('基金归属校验', '''
+        SELECT * FROM user_fund_relation WHERE user_id = ? AND fund_code = ?
+    ''', (0, '')),
+    ('收益汇总', '''
+        SELECT s.* FROM user_fund_summary s
+                 JOIN user_fund_relation r ON r.user_id = s.user_id AND r.fund_code = s.fund_code
+        WHERE s.user_id = ?
+    ''', (0,)),
+    ('上一条收益', '''
+        SELECT total_earn FROM user_fund_earnings
+        WHERE user_id = ? AND fund_code = ? AND record_date < ? ORDER BY record_date DESC LIMIT 1
+    ''', (0, '', '')),
+    ('趋势图收益', '''
+        SELECT record_date, day_gszzl, day_earn, total_earn
+        FROM user_fund_earnings
+        WHERE user_id = ? AND fund_code = ? AND record_date >= ? AND record_date <= ?
+        ORDER BY record_date ASC
+    ''', (0, '', '', '')),
+    ('趋势图周/月汇总', '''
+        SELECT * FROM user_fund_earnings_rollup
+        WHERE user_id = ? AND fund_code = ? AND period = ? AND period_start >= ? AND period_start <= ?
+        ORDER BY period_start ASC
+    ''', (0, '', '', '', '')),
+    ('趋势图归档收益', '''
+        SELECT period_start, data FROM user_fund_earnings_archive
+        WHERE user_id = ? AND fund_code = ? AND period_start >= ? AND period_start <= ?
+        ORDER BY period_start ASC
+    ''', (0, '', '', '')),
+    ('基金归档收益', '''
+        SELECT user_id, fund_code, period_start, data FROM user_fund_earnings_archive
+        WHERE fund_code IN (?) AND last_date >= ?
+    ''', ('', '')),
+    ('组合趋势图', '''
+        SELECT * FROM user_portfolio_daily
+        WHERE user_id = ? AND record_date >= ? AND record_date <= ?
+        ORDER BY record_date ASC
+    ''', (0, '', '')),
+    ('本金时间线', '''
+        SELECT fund_code, effective_date, invest_principal FROM user_principal_history
+        WHERE user_id = ? ORDER BY fund_code, effective_date
+    ''', (0,)),
+    ('基金行情', '''
+        SELECT record_date, gszzl, dwjz FROM fund_daily_trend
+        WHERE fund_code = ? AND record_date >= ? ORDER BY record_date
+    ''', (0, '')),
+]
+
+
+def check_query_plans(db):
+    """
+    EXPLAIN QUERY PLAN检查接口热点查询，出现全表扫描（SCAN 表名且未走索引）时告警
+    :return: 全表扫描的查询列表 [(查询名称, 执行计划明细)]
+    """
+    cur = db.cursor()
+    full_scans = []
+    for name, sql, params in HOT_QUERIES:
+        for row in cur.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall():
+            detail = row[3]
+            if detail.startswith('SCAN ') and 'INDEX' not in detail:
+                full_scans.append((name, detail))
+    for name, detail in full_scans:
+        print(f"⚠️ 查询计划检查：{name}存在全表扫描 - {detail}")
+    if not full_scans:
+        print("✅ 查询计划检查：接口热点查询均已走索引")
+    return full_scans
+
 
 def is_gztime_today(gztime_str):
     """
@@ -275,242 +1160,3164 @@ def login_required(f):
     return wrapper
 
 
+def admin_required(f):
+    """运维接口权限校验（放在login_required之后），非ADMIN_USERNAMES中的账号返回403"""
+
+    def wrapper(*args, **kwargs):
+        if session.get('username') not in ADMIN_USERNAMES:
+            return jsonify({'code': 403, 'msg': '无权限，仅管理员可访问', 'data': None}), 403
+        return f(*args, **kwargs)
+
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+
 # ---------------------- 基金接口工具（解析JSONP、拉取实时数据） ----------------------
-def fetch_fund_real(fund_code):
+# 复用长连接的HTTP会话，连接池大小与并发数一致
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=QUOTE_FETCH_WORKERS))
+HTTP_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=QUOTE_FETCH_WORKERS))
+QUOTE_EXECUTOR = ThreadPoolExecutor(max_workers=QUOTE_FETCH_WORKERS, thread_name_prefix='quote-fetch')
+QUOTE_INFLIGHT = {}  # 基金代码 -> 批量拉取中的Future，同一基金已在拉取时不重复提交
+QUOTE_INFLIGHT_LOCK = threading.Lock()
+QUOTE_FETCH_EXPIRES = contextvars.ContextVar('quote_fetch_expires', default=None)  # 批量拉取时限（monotonic时间）
+
+
+class FundNotFoundError(Exception):
+    """接口正常响应但没有该基金的数据（代码不存在/已下架，返回非标准JSONP）"""
+
+
+class FundFailureTracker:
     """
-    拉取真实基金接口数据，解析JSONP格式
-    :param fund_code: 基金代码（如004253）
-    :return: 解析后字典/None（失败）
+    按基金代码记录接口拉取失败（负缓存），退避期内不再请求接口：
+    - not_found：基金不存在，退避时间长（NEGATIVE_CACHE_NOT_FOUND_BASE起，连续失败翻倍）
+    - error：超时/网络错误，退避时间短（NEGATIVE_CACHE_ERROR_BASE起，连续失败翻倍）
+    拉取成功后清除记录
     """
-    try:
-        timestamp = int(time.time())
-        url = FUND_API_URL.format(fund_code=fund_code, timestamp=timestamp)
-        res = requests.get(url, headers=HEADERS, timeout=10)
-        res.raise_for_status()
-        # 解析JSONP：匹配jsonpgz({...})中的内容
-        content = res.text.strip()
-        match = re.search(r'jsonpgz\((\{.*\})\);', content)
-        if not match:
-            print(f"❌ 基金{fund_code}：接口返回非标准JSONP")
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # 基金代码 -> 失败记录，按最近失败时间排序
+        self._lock = threading.Lock()
+        self.skipped = 0  # 退避期内跳过的请求次数
+
+    def blocked(self, fund_code):
+        """基金处于退避期时返回失败类型（not_found/error），否则返回None"""
+        with self._lock:
+            entry = self._entries.get(fund_code)
+            if entry and entry['retry_at'] > time.time():
+                self.skipped += 1
+                return entry['kind']
             return None
-        # 数据类型转换（字符串→浮点数）
-        import json
-        fund_data = json.loads(match.group(1))
-        fund_data['dwjz'] = float(fund_data['dwjz']) if fund_data['dwjz'] else 0.0
-        fund_data['gsz'] = float(fund_data['gsz']) if fund_data['gsz'] else 0.0
-        fund_data['gszzl'] = float(fund_data['gszzl']) if fund_data['gszzl'] else 0.0
-        gztime = fund_data.get('gztime', '')
-        if not is_gztime_today(gztime):
-            print(f"⚠️ 基金{fund_code}：gztime({gztime})非今日，涨幅强制设为0")
-            fund_data['gszzl'] = 0.0
+
+    def last_kind(self, fund_code):
+        """基金最近一次失败的类型（not_found/error），无记录返回None（不计入跳过次数）"""
+        with self._lock:
+            entry = self._entries.get(fund_code)
+            return entry['kind'] if entry else None
+
+    def record_failure(self, fund_code, kind, error):
+        """记录一次失败并计算下次允许请求的时间，失败类型变化时重新计数"""
+        if kind == 'not_found':
+            base, max_delay = NEGATIVE_CACHE_NOT_FOUND_BASE, NEGATIVE_CACHE_NOT_FOUND_MAX
         else:
-            fund_data['gszzl'] = float(fund_data['gszzl']) if fund_data['gszzl'] else 0.0
+            base, max_delay = NEGATIVE_CACHE_ERROR_BASE, NEGATIVE_CACHE_ERROR_MAX
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(fund_code, None)
+            failures = entry['failures'] + 1 if entry and entry['kind'] == kind else 1
+            delay = min(base * 2 ** (failures - 1), max_delay)
+            self._entries[fund_code] = {
+                'kind': kind,
+                'failures': failures,
+                'retry_at': now + delay,
+                'last_error': error,
+                'last_failure': now
+            }
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return delay
 
-        return fund_data
-    except Exception as e:
-        print(f"❌ 基金{fund_code}：拉取失败 - {str(e)}")
-        return None
+    def record_success(self, fund_code):
+        """拉取成功，清除失败记录"""
+        with self._lock:
+            self._entries.pop(fund_code, None)
 
+    def clear(self, fund_code=None):
+        """手动清除指定基金（不传则全部）的失败记录"""
+        with self._lock:
+            if fund_code is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(fund_code, None)
 
-# ---------------------- 定时任务（每日22:30落库行情+收益数据） ----------------------
-def calculate_day_earn(user_id, fund_code, record_date, gszzl):
-    """
-    计算单基金单用户当日收益+累计收益
-    :return: (当日收益, 截至当日累计收益)
-    """
-    db = get_db()
-    cur = db.cursor()
-    # 1. 获取用户该基金的投入本金
-    cur.execute('''
-                SELECT invest_principal
-                FROM user_fund_relation
-                WHERE user_id = ?
-                  AND fund_code = ?
-                ''', (user_id, fund_code))
-    relation = cur.fetchone()
-    if not relation:
-        return (0.0, 0.0)
-    invest_principal = relation['invest_principal']
-    # 2. 当日收益 = 投入本金 × 涨幅（百分比转小数）
-    day_earn = round(invest_principal * (float(gszzl) / 100), 2)
-    # 3. 累计收益 = 昨日累计收益 + 当日收益（无昨日数据则为当日收益）
-    yesterday = (datetime.strptime(record_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-    cur.execute('''
-                SELECT total_earn
-                FROM user_fund_earnings
-                WHERE user_id = ?
-                  AND fund_code = ?
-                  AND record_date = ?
-                ''', (user_id, fund_code, yesterday))
-    yesterday_data = cur.fetchone()
-    total_earn = round((yesterday_data['total_earn'] if yesterday_data else 0) + day_earn, 2)
-    return (day_earn, total_earn)
+    def stats(self, limit=100):
+        """失败统计：各类型数量 + 最近失败的基金明细"""
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.items())
+            skipped = self.skipped
+        counts = {'not_found': 0, 'error': 0}
+        for _, entry in entries:
+            counts[entry['kind']] += 1
+        return {
+            'size': len(entries),
+            'max_size': self.max_size,
+            'not_found': counts['not_found'],
+            'error': counts['error'],
+            'skipped': skipped,
+            'funds': [{
+                'fund_code': fund_code,
+                'kind': entry['kind'],
+                'failures': entry['failures'],
+                'retry_in': max(round(entry['retry_at'] - now, 1), 0),
+                'last_error': entry['last_error'],
+                'last_failure': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_failure']))
+            } for fund_code, entry in reversed(entries[-limit:] if limit else [])]
+        }
 
 
-def auto_record_data():
+class CircuitBreaker:
     """
-    定时落库核心逻辑（每日15:30执行）
-    1. 拉取所有用户已添加基金的实时行情，落库到fund_daily_trend
-    2. 计算每个用户每只基金的当日收益，落库到user_fund_earnings
+    外部接口熔断器：连续failure_threshold次超时/网络错误后打开（open），期间直接失败不请求接口；
+    open_seconds后进入半开（half_open）只放行一个探测请求，成功则关闭（closed），失败则重新打开
     """
-    with app.app_context():
-        try:
-            db = get_db()
-            cur = db.cursor()
-            # 获取所有用户-基金关联数据（去重基金）
-            cur.execute('SELECT DISTINCT ufr.user_id, ufr.fund_code, ufr.invest_principal FROM user_fund_relation ufr')
-            user_fund_list = cur.fetchall()
-            if not user_fund_list:
-                print("ℹ️ 定时任务：暂无用户添加基金，无需落库")
-                return
-            today = date.today().strftime("%Y-%m-%d")
-            now = time.strftime("%Y-%m-%d %H:%M:%S")
-            success = 0
-            fail = 0
 
-            for item in user_fund_list:
-                user_id = item['user_id']
-                fund_code = item['fund_code']
-                # 1. 拉取实时行情数据
-                fund_data = fetch_fund_real(fund_code)
-                if not fund_data:
-                    fail += 1
-                    continue
-                gszzl = fund_data['gszzl']
-
-                # 行情落库（fund_daily_trend），避免重复
-                cur.execute('SELECT * FROM fund_daily_trend WHERE fund_code=? AND record_date=?', (fund_code, today))
-                if not cur.fetchone():
-                    cur.execute('''
-                                INSERT INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime, create_time)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                                ''', (
-                                    fund_code, today, fund_data['jzrq'], fund_data['dwjz'],
-                                    fund_data['gsz'], gszzl, fund_data['gztime'], now
-                                ))
-                # 2. 计算并落库收益数据（user_fund_earnings）
-                day_earn, total_earn = calculate_day_earn(user_id, fund_code, today, gszzl)
-                cur.execute('SELECT * FROM user_fund_earnings WHERE user_id=? AND fund_code=? AND record_date=?',
-                            (user_id, fund_code, today))
-                if not cur.fetchone():
-                    cur.execute('''
-                                INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal,
-                                                                day_gszzl, day_earn, total_earn, create_time)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                                ''', (
-                                    user_id, fund_code, today, item['invest_principal'],
-                                    gszzl, day_earn, total_earn, now
-                                ))
-                success += 1
-            db.commit()
-            print(f"✅ 定时任务完成：成功落库{success}条，失败{fail}条（{today}）")
-        except Exception as e:
-            print(f"❌ 定时任务失败：{str(e)}")
+    def __init__(self, failure_threshold, open_seconds):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False  # 半开状态下探测请求是否进行中
+        self.opened = 0  # 累计熔断次数
+        self.short_circuits = 0  # 熔断期间直接失败的请求次数
+        self._lock = threading.Lock()
 
+    def allow(self):
+        """是否允许请求接口"""
+        with self._lock:
+            if self.state == 'open' and time.time() >= self.open_until:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            self.short_circuits += 1
+            return False
 
-def start_schedule():
-    """启动定时任务守护线程，不阻塞Flask主进程"""
-    schedule.every().day.at("10:30").do(auto_record_data)
+    def record_success(self):
+        """接口正常响应（含基金不存在），关闭熔断"""
+        with self._lock:
+            if self.state != 'closed':
+                print("✅ 基金接口恢复，熔断关闭")
+            self.state = 'closed'
+            self.consecutive_failures = 0
+            self.probing = False
 
-    # 开发测试：每分钟执行，上线注释
-    # schedule.every(1).minutes.do(auto_record_data)
-    def run_schedule():
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+    def record_failure(self):
+        """接口超时/网络错误：连续失败达到阈值或半开探测失败时打开熔断"""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opened += 1
+                    print(f"⚠️ 基金接口连续失败{self.consecutive_failures}次，熔断{self.open_seconds}秒")
+                self.state = 'open'
+                self.open_until = time.time() + self.open_seconds
+                self.probing = False
 
-    t = threading.Thread(target=run_schedule, daemon=True)
-    t.start()
-    print("🚀 定时任务启动：每日10:30自动落库昨日基金行情+收益数据")
+    def stats(self):
+        """熔断器状态"""
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'open_seconds': self.open_seconds,
+                'retry_in': max(round(self.open_until - time.time(), 1), 0) if self.state == 'open' else 0,
+                'opened': self.opened,
+                'short_circuits': self.short_circuits
+            }
 
 
-# ---------------------- 核心计算工具（收益/本金/涨幅，严格按需求） ----------------------
-def get_fund_add_date(user_id, fund_code):
-    """获取基金添加日期（YYYY-MM-DD），用于筛选历史收益"""
-    db = get_db()
-    cur = db.cursor()
-    cur.execute('''
-                SELECT add_time
-                FROM user_fund_relation
-                WHERE user_id = ?
-                  AND fund_code = ?
-                ''', (user_id, fund_code))
-    add_time = cur.fetchone()['add_time']
-    return add_time.split(' ')[0]
+FUND_FAILURES = FundFailureTracker(NEGATIVE_CACHE_MAX_SIZE)
+UPSTREAM_BREAKER = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS)
 
 
-def calc_history_earn_sum(user_id, fund_code):
-    """计算基金添加日至今的历史收益之和（不含今日，今日为实时计算）"""
-    db = get_db()
-    cur = db.cursor()
-    add_date = get_fund_add_date(user_id, fund_code)
-    today = date.today().strftime("%Y-%m-%d")
-    cur.execute('''
-                SELECT SUM(day_earn) as sum_earn
-                FROM user_fund_earnings
-                WHERE user_id = ?
-                  AND fund_code = ?
-                  AND record_date >= ?
-                  AND record_date < ?
-                ''', (user_id, fund_code, add_date, today))
-    sum_earn = cur.fetchone()['sum_earn'] or 0.0
-    return round(sum_earn, 2)
+def request_fund_real(fund_code):
+    """
+    直接请求真实基金接口（不经过缓存），解析JSONP格式
+    :param fund_code: 基金代码（如004253）
+    :return: 解析后字典
+    :raises FundNotFoundError: 接口返回非标准JSONP（基金不存在）；超时/网络/HTTP错误抛出requests异常
+    """
+    timestamp = int(time.time())
+    url = FUND_API_URL.format(fund_code=fund_code, timestamp=timestamp)
+    timeout = QUOTE_FETCH_TIMEOUT
+    expires = QUOTE_FETCH_EXPIRES.get()
+    if expires is not None:
+        # 批量拉取中：超时不超过剩余时限，超过时限的请求不在后台继续占用拉取线程
+        timeout = max(min(timeout, expires - time.monotonic()), 0.1)
+    res = HTTP_SESSION.get(url, headers=HEADERS, timeout=timeout)
+    res.raise_for_status()
+    return parse_fund_jsonp(fund_code, res.text)
 
 
-def calc_total_earn(user_id, fund_code, today_earn):
-    """累计收益 = 历史收益之和 + 今日实时收益（需求3）"""
-    history_earn = calc_history_earn_sum(user_id, fund_code)
-    total_earn = round(history_earn + today_earn, 2)
-    return total_earn
+def parse_fund_jsonp(fund_code, content):
+    """
+    解析接口返回的JSONP内容（同步/异步拉取共用）
+    :raises FundNotFoundError: 非标准JSONP（基金不存在）
+    """
+    # 解析JSONP：匹配jsonpgz({...})中的内容
+    content = content.strip()
+    match = re.search(r'jsonpgz\((\{.*\})\);', content)
+    if not match:
+        raise FundNotFoundError('接口返回非标准JSONP')
+    # 数据类型转换（字符串→浮点数）
+    fund_data = json.loads(match.group(1))
+    fund_data['dwjz'] = float(fund_data['dwjz']) if fund_data['dwjz'] else 0.0
+    fund_data['gsz'] = float(fund_data['gsz']) if fund_data['gsz'] else 0.0
+    fund_data['gszzl'] = float(fund_data['gszzl']) if fund_data['gszzl'] else 0.0
+    gztime = fund_data.get('gztime', '')
+    if not is_gztime_today(gztime):
+        print(f"⚠️ 基金{fund_code}：gztime({gztime})非今日，涨幅强制设为0")
+        fund_data['gszzl'] = 0.0
+    else:
+        fund_data['gszzl'] = float(fund_data['gszzl']) if fund_data['gszzl'] else 0.0
 
+    return fund_data
 
-def calc_current_principal(invest_principal, total_earn):
-    """现存本金 = 投入本金 + 累计收益（需求4）"""
-    return round(invest_principal + total_earn, 2)
 
+def last_known_quote(fund_code):
+    """接口不可用时返回最近一次拉取到的行情（忽略缓存过期，标记stale=True），无则None"""
+    fund_data = QUOTE_CACHE.peek(fund_code)
+    if fund_data:
+        fund_data['stale'] = True
+    return fund_data
 
-def calc_today_earn(current_principal, today_gszzl):
-    """今日收益 = 现存本金 × 今日实时涨幅（需求5）"""
-    today_earn = round(current_principal * (float(today_gszzl) / 100), 2)
-    return today_earn
 
+def quote_fetch_allowed(fund_code):
+    """
+    请求接口前检查（同步/异步拉取共用）
+    - 代码格式错误、基金不存在且在退避期内：不请求，返回None
+    - 超时/网络错误退避期内或熔断打开：不请求，返回最近一次行情（stale）或None
+    :return: (是否请求接口, 不请求时的返回值)
+    """
+    if not re.fullmatch(r'\d{6}', fund_code):
+        return False, None
+    kind = FUND_FAILURES.blocked(fund_code)
+    if kind == 'not_found':
+        return False, None
+    if kind == 'error' or not UPSTREAM_BREAKER.allow():
+        return False, last_known_quote(fund_code)
+    return True, None
 
-# ---------------------- 前端页面路由 ----------------------
-@app.route('/')
-def serve_frontend():
-    """根路径返回前端页面"""
-    return send_from_directory(STATIC_FOLDER, 'index.html')
 
+def quote_fetch_finished(fund_code, start, fund_data=None, error=None):
+    """请求接口后更新熔断器、失败退避并记录耗时/结果（同步/异步拉取共用），返回最终行情"""
+    seconds = time.perf_counter() - start
+    if isinstance(error, FundNotFoundError):
+        # 接口本身正常，只是没有该基金
+        UPSTREAM_BREAKER.record_success()
+        delay = FUND_FAILURES.record_failure(fund_code, 'not_found', str(error))
+        record_upstream_call('failure', seconds)
+        print(f"❌ 基金{fund_code}：{str(error)}，{delay}秒内不再请求")
+        return None
+    if error is not None:
+        UPSTREAM_BREAKER.record_failure()
+        delay = FUND_FAILURES.record_failure(fund_code, 'error', str(error) or type(error).__name__)
+        record_upstream_call('failure', seconds)
+        print(f"❌ 基金{fund_code}：拉取失败 - {str(error) or type(error).__name__}，{delay}秒内不再请求")
+        return last_known_quote(fund_code)
+    UPSTREAM_BREAKER.record_success()
+    FUND_FAILURES.record_success(fund_code)
+    result = 'success' if is_gztime_today(fund_data.get('gztime', '')) else 'stale'
+    record_upstream_call(result, seconds)
+    return fund_data
 
-# ---------------------- 用户接口（登录/登出/当前用户） ----------------------
-@app.route('/api/login', methods=['POST'])
-def login():
-    """用户登录，验证后设置Session"""
+
+def fetch_fund_real_remote(fund_code):
+    """请求真实基金接口并记录耗时/结果（成功、失败、估值时间非今日），退避/熔断时不请求"""
+    allowed, fallback = quote_fetch_allowed(fund_code)
+    if not allowed:
+        return fallback
+    start = time.perf_counter()
     try:
-        data = request.get_json()
-        username = data.get('username', '').strip()
-        password = data.get('password', '').strip()
-        if not username or not password:
-            return jsonify({'code': 400, 'msg': '账号/密码不能为空', 'data': None})
-        # 验证用户
-        db = get_db()
-        cur = db.cursor()
-        cur.execute('SELECT id, username, password FROM users WHERE username=?', (username,))
-        user = cur.fetchone()
-        if not user or not check_password_hash(user['password'], password):
-            return jsonify({'code': 403, 'msg': '账号/密码错误', 'data': None})
-        # 设置Session
-        session['user_id'] = user['id']
-        session['username'] = user['username']
-        return jsonify({
-            'code': 200, 'msg': '登录成功',
-            'data': {'user_id': user['id'], 'username': user['username']}
-        })
+        fund_data = request_fund_real(fund_code)
     except Exception as e:
-        return jsonify({'code': 500, 'msg': f'登录失败：{str(e)}', 'data': None})
+        return quote_fetch_finished(fund_code, start, error=e)
+    return quote_fetch_finished(fund_code, start, fund_data)
 
 
-@app.route('/api/logout', methods=['GET'])
+def fetch_fund_real(fund_code):
+    """
+    拉取基金实时行情（优先读进程内缓存，未命中再请求接口）
+    :param fund_code: 基金代码（如004253）
+    :return: 解析后字典/None（失败）
+    """
+    return QUOTE_CACHE.get(fund_code)
+
+
+def fetch_funds_real(fund_codes, deadline=QUOTE_BATCH_DEADLINE):
+    """
+    并发批量拉取多只基金实时行情（经过缓存，同一基金只请求一次）
+    :param fund_codes: 基金代码列表（可重复）
+    :param deadline: 总时限（秒），None=等待全部完成；超时的基金不阻塞其他基金，
+                     有旧缓存则返回旧数据并标记stale=True，否则为None
+    :return: {基金代码: 行情字典/None}
+    """
+    codes = list(dict.fromkeys(fund_codes))
+    if not codes:
+        return {}
+    expires = time.monotonic() + deadline if deadline is not None else None
+    futures = {code: submit_quote_fetch(code, expires) for code in codes}
+    done, _ = wait(futures.values(), timeout=deadline)
+    result = {}
+    for code, future in futures.items():
+        if future in done:
+            try:
+                result[code] = future.result()
+            except Exception as e:
+                print(f"❌ 基金{code}：批量拉取失败 - {str(e)}")
+                result[code] = None
+        else:
+            # 超时：未完成的请求最多再执行到时限（接口超时已按剩余时限设置），本次先返回旧数据
+            stale = QUOTE_CACHE.peek(code)
+            if stale:
+                stale['stale'] = True
+            result[code] = stale
+            print(f"⚠️ 基金{code}：行情拉取超过{deadline}秒，返回{'旧数据' if stale else '空数据'}")
+    return result
+
+
+def submit_quote_fetch(fund_code, expires):
+    """
+    提交单只基金的拉取任务：该基金已有拉取在进行（其他请求提交的）时复用同一个Future，不重复占用拉取线程
+    复制当前上下文提交，拉取线程中的外部接口调用计入当前请求的性能统计
+    """
+    with QUOTE_INFLIGHT_LOCK:
+        future = QUOTE_INFLIGHT.get(fund_code)
+        if future is not None:
+            return future
+        future = QUOTE_INFLIGHT[fund_code] = QUOTE_EXECUTOR.submit(
+            contextvars.copy_context().run, fetch_fund_real_until, fund_code, expires)
+
+    def finished(_):
+        with QUOTE_INFLIGHT_LOCK:
+            if QUOTE_INFLIGHT.get(fund_code) is future:
+                del QUOTE_INFLIGHT[fund_code]
+
+    future.add_done_callback(finished)
+    return future
+
+
+def fetch_fund_real_until(fund_code, expires):
+    """拉取线程中执行：排队已超过时限的不再请求接口（调用方已返回旧数据），否则请求超时不超过剩余时限"""
+    if expires is not None:
+        if time.monotonic() >= expires:
+            return QUOTE_CACHE.get_cached(fund_code)
+        QUOTE_FETCH_EXPIRES.set(expires)
+    return fetch_fund_real(fund_code)
+
+
+def quote_unusable_for_add(fund_code, fund_data):
+    """
+    新增基金前检查拉取结果：可落库返回None，否则返回(状态码, 提示)
+    接口超时/熔断时的旧数据（stale）不能作为当日行情落库；拉取失败时区分基金不存在（404）和接口不可用（503）
+    """
+    if fund_data and not fund_data.get('stale'):
+        return None
+    if not fund_data and (not re.fullmatch(r'\d{6}', fund_code) or FUND_FAILURES.last_kind(fund_code) == 'not_found'):
+        return 404, '基金不存在，无法添加'
+    return 503, '基金行情接口暂不可用，请稍后再试'
+
+
+# ---------------------- 进程内缓存（行情/组合快照共用，TTL+LRU+同key请求合并） ----------------------
+def is_trading_time(now=None):
+    """判断当前是否为A股交易时段（工作日 9:30-11:30、13:00-15:00）"""
+    now = now or datetime.now()
+    if now.weekday() >= 5:
+        return False
+    hm = now.strftime("%H:%M")
+    return "09:30" <= hm <= "11:30" or "13:00" <= hm <= "15:00"
+
+
+def get_quote_cache_ttl():
+    """行情缓存有效期：交易时段短（估值实时变化），收盘后长"""
+    return QUOTE_CACHE_TTL_TRADING if is_trading_time() else QUOTE_CACHE_TTL_CLOSED
+
+
+class MemoryCacheBackend:
+    """进程内缓存存储（OrderedDict实现LRU），仅当前进程可见"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (过期时间戳, 结果字典)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        """返回(过期时间戳, 结果字典)，不存在返回None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, expires_at, value):
+        """写入缓存，超出容量时淘汰最久未访问的key"""
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key=None):
+        """删除指定key，不传则清空"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def size(self):
+        return len(self._data)
+
+    def acquire_lease(self, key, seconds):
+        """进程内请求合并已由TTLCache处理，无需跨进程租约"""
+        return True
+
+    def release_lease(self, key):
+        pass
+
+
+class SQLiteCacheBackend:
+    """
+    跨进程缓存存储（数据库shared_cache表），gunicorn多个worker共享同一份缓存
+    1. 每条记录自带过期时间，读到过期记录视为未命中
+    2. 按最近访问时间淘汰超出max_size的记录（每写入prune_every次清理一次）：
+       命中只在内存中记录访问时间，每touch_interval秒（及清理前）批量写回，读请求不逐条写库
+    3. 租约：同一key只有一个进程回源，其他进程等待租约持有者写入结果
+    """
+
+    def __init__(self, namespace, max_size, prune_every=100, touch_interval=5):
+        self.namespace = namespace  # key前缀，区分不同缓存
+        self.max_size = max_size
+        self.prune_every = prune_every
+        self.touch_interval = touch_interval
+        self.owner = f"{os.getpid()}-{id(self)}"
+        self._writes = 0
+        self._touched = {}  # cache_key -> 最近命中时间戳（待批量写回）
+        self._touch_flushed = time.time()
+        self._touch_lock = threading.Lock()
+        self.evictions = 0
+
+    def _execute(self, sql, params=(), commit=False):
+        """
+        从连接池取连接执行（缓存读写发生在拉取线程中，不依赖请求上下文）：
+        只读查询用只读连接池，写入（commit=True）用读写连接池
+        """
+        pool = get_db_pool(readonly=not commit)
+        db = pool.acquire()
+        try:
+            cur = db.execute(sql, params)
+            rows = cur.fetchall()
+            if commit:
+                db.commit()
+            return rows, cur.rowcount
+        finally:
+            pool.release(db)
+
+    def get(self, key):
+        rows, _ = self._execute('''
+                                SELECT payload, expires_at
+                                FROM shared_cache
+                                WHERE cache_key = ?
+                                  AND payload IS NOT NULL
+                                ''', (f"{self.namespace}:{key}",))
+        if not rows:
+            return None
+        self.touch(f"{self.namespace}:{key}")
+        return (rows[0]['expires_at'], json.loads(rows[0]['payload']))
+
+    def touch(self, cache_key):
+        """记录命中时间，距上次写回超过touch_interval秒时批量写回access_ts"""
+        now_ts = time.time()
+        with self._touch_lock:
+            self._touched[cache_key] = now_ts
+            if now_ts - self._touch_flushed < self.touch_interval:
+                return
+        self.flush_touches()
+
+    def flush_touches(self):
+        """把内存中记录的命中时间批量写回access_ts（只会调大）"""
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+            self._touch_flushed = time.time()
+        if not touched:
+            return
+        pool = get_db_pool(readonly=False)
+        db = pool.acquire()
+        try:
+            db.executemany('UPDATE shared_cache SET access_ts = MAX(access_ts, ?) WHERE cache_key = ?',
+                           [(access_ts, cache_key) for cache_key, access_ts in touched.items()])
+            db.commit()
+        finally:
+            pool.release(db)
+
+    def set(self, key, expires_at, value):
+        self._execute('''
+                      INSERT INTO shared_cache (cache_key, payload, expires_at, lease_owner, lease_until, access_ts)
+                      VALUES (?, ?, ?, NULL, 0, ?)
+                      ON CONFLICT(cache_key) DO UPDATE SET payload=excluded.payload,
+                                                           expires_at=excluded.expires_at,
+                                                           lease_owner=NULL,
+                                                           lease_until=0,
+                                                           access_ts=excluded.access_ts
+                      ''', (f"{self.namespace}:{key}", json.dumps(value, ensure_ascii=False), expires_at,
+                            time.time()), commit=True)
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        """淘汰最久未访问的记录，保留max_size条（先写回命中时间）"""
+        self.flush_touches()
+        _, deleted = self._execute('''
+                                   DELETE
+                                   FROM shared_cache
+                                   WHERE cache_key IN (SELECT cache_key
+                                                       FROM shared_cache
+                                                       WHERE cache_key LIKE ?
+                                                       ORDER BY access_ts DESC
+                                                       LIMIT -1 OFFSET ?)
+                                   ''', (f"{self.namespace}:%", self.max_size), commit=True)
+        self.evictions += max(deleted, 0)
+
+    def delete(self, key=None):
+        if key is None:
+            self._execute('DELETE FROM shared_cache WHERE cache_key LIKE ?', (f"{self.namespace}:%",), commit=True)
+        else:
+            self._execute('DELETE FROM shared_cache WHERE cache_key = ?', (f"{self.namespace}:{key}",), commit=True)
+
+    def size(self):
+        rows, _ = self._execute('SELECT COUNT(*) AS cnt FROM shared_cache WHERE cache_key LIKE ?',
+                                (f"{self.namespace}:%",))
+        return rows[0]['cnt']
+
+    def acquire_lease(self, key, seconds):
+        """抢占回源租约：无记录、租约过期或自己持有时成功"""
+        now_ts = time.time()
+        _, updated = self._execute('''
+                                   INSERT INTO shared_cache (cache_key, payload, expires_at, lease_owner, lease_until, access_ts)
+                                   VALUES (?, NULL, 0, ?, ?, ?)
+                                   ON CONFLICT(cache_key) DO UPDATE SET lease_owner=excluded.lease_owner,
+                                                                        lease_until=excluded.lease_until
+                                   WHERE shared_cache.lease_until < ?
+                                      OR shared_cache.lease_owner = excluded.lease_owner
+                                   ''', (f"{self.namespace}:{key}", self.owner, now_ts + seconds, now_ts, now_ts),
+                                   commit=True)
+        return updated > 0
+
+    def release_lease(self, key):
+        self._execute('''
+                      UPDATE shared_cache
+                      SET lease_owner=NULL,
+                          lease_until=0
+                      WHERE cache_key = ?
+                        AND lease_owner = ?
+                      ''', (f"{self.namespace}:{key}", self.owner), commit=True)
+
+
+class TTLCache:
+    """
+    TTL缓存（行情、组合快照共用），按key缓存loader(key)的结果，存储后端可插拔
+    1. TTL过期：有效期由ttl_func决定（如行情在交易时段/非交易时段不同）
+    2. LRU淘汰：超过容量时由存储后端淘汰最久未访问的key
+    3. 请求合并：同一key并发未命中时只调用一次loader，其余请求等待共享结果；
+       跨进程后端额外用租约保证多个进程同一时间只有一个回源
+    loader返回None（失败）或旧数据（stale=True）不缓存，下次访问重新加载
+    """
+
+    def __init__(self, loader, max_size, ttl_func, backend=None, lease_seconds=QUOTE_FETCH_TIMEOUT,
+                 lease_wait=QUOTE_BATCH_DEADLINE):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl_func = ttl_func
+        self.backend = backend or MemoryCacheBackend(max_size)
+        self.lease_seconds = lease_seconds  # 跨进程租约时长（应覆盖一次loader耗时）
+        self.lease_wait = min(lease_wait, lease_seconds)  # 等待其他进程回源的最长时间，不超过接口批量时限
+        self._inflight = {}  # key -> 进行中的加载（threading.Event + 结果）
+        self._generation = 0  # 每次invalidate递增，加载期间被失效的结果不写入缓存
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # 合并到其他请求上的次数
+
+    def _get_fresh(self, key):
+        """读取未过期的缓存结果，无则返回None"""
+        entry = self.backend.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def get(self, key):
+        """获取缓存结果，返回副本（调用方可安全修改）"""
+        value = self._get_fresh(key)
+        with self._lock:
+            if value is not None:
+                self.hits += 1
+                return dict(value)
+            flight = self._inflight.get(key)
+            if flight:
+                self.shared += 1
+                leader = False
+            else:
+                flight = self._inflight[key] = {'event': threading.Event(), 'result': None}
+                self.misses += 1
+                leader = True
+            generation = self._generation
+        if not leader:
+            flight['event'].wait()
+            return dict(flight['result']) if flight['result'] else None
+        try:
+            result = self._load(key, generation)
+            flight['result'] = result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight['event'].set()
+        return dict(result) if result else None
+
+    def _load(self, key, generation):
+        """
+        回源加载：跨进程租约被其他进程持有时，最多等待lease_wait秒（轮询间隔逐步加长）让对方写入结果，
+        超时后有过期结果返回过期结果（标记stale），没有再自己加载
+        """
+        if not self.backend.acquire_lease(key, self.lease_seconds):
+            wait_until = time.time() + self.lease_wait
+            interval = 0.02
+            while time.time() < wait_until:
+                time.sleep(min(interval, max(wait_until - time.time(), 0)))
+                interval = min(interval * 2, 0.5)
+                value = self._get_fresh(key)
+                if value is not None:
+                    return value
+            entry = self.backend.get(key)
+            if entry:
+                return dict(entry[1], stale=True)
+        try:
+            result = self.loader(key)
+            # loader返回旧数据（stale，如接口熔断时）不写入缓存，过期后仍会回源
+            if result and not result.get('stale') and generation == self._generation:
+                self.set(key, result)
+            return result
+        finally:
+            self.backend.release_lease(key)
+
+    def set(self, key, value):
+        """写入缓存"""
+        self.backend.set(key, time.time() + self.ttl_func(), dict(value))
+
+    def get_cached(self, key):
+        """只读未过期的缓存结果（不回源、不计入命中统计），无则返回None"""
+        value = self._get_fresh(key)
+        return dict(value) if value is not None else None
+
+    def peek(self, key):
+        """读取最近一次缓存的结果（忽略过期时间，不计入命中统计），无则返回None"""
+        entry = self.backend.get(key)
+        return dict(entry[1]) if entry else None
+
+    def invalidate(self, key=None):
+        """删除指定key的缓存，不传则清空"""
+        with self._lock:
+            self._generation += 1
+        self.backend.delete(key)
+
+    def stats(self):
+        """缓存统计：命中/未命中/淘汰/合并次数，用于评估容量"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'size': self.backend.size(),
+                'max_size': self.max_size,
+                'ttl': self.ttl_func(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.backend.evictions,
+                'shared': self.shared,
+                'inflight': len(self._inflight),
+                'hit_rate': round(self.hits / total, 4) if total else 0.0
+            }
+
+
+def create_quote_cache_backend():
+    """按QUOTE_CACHE_BACKEND创建行情缓存存储：memory=进程内，sqlite=多进程共享"""
+    if QUOTE_CACHE_BACKEND == 'sqlite':
+        return SQLiteCacheBackend('quote', QUOTE_CACHE_MAX_SIZE)
+    return MemoryCacheBackend(QUOTE_CACHE_MAX_SIZE)
+
+
+QUOTE_CACHE = TTLCache(fetch_fund_real_remote, QUOTE_CACHE_MAX_SIZE, get_quote_cache_ttl,
+                       backend=create_quote_cache_backend())
+
+
+# ---------------------- Session存储（SQLite表+进程内读缓存，替代文件Session） ----------------------
+class SQLiteSession(SecureCookieSession):
+    """服务端Session：Cookie只保存随机sid，数据保存在user_sessions表"""
+
+    def __init__(self, initial=None, sid=None, new=False, expires_at=0.0):
+        super().__init__(initial)
+        self.sid = sid
+        self.new = new  # 本次请求新建（库中没有）
+        self.expires_at = expires_at
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """
+    Session存储在user_sessions表（WAL，读写不互斥），读取经过进程内TTLCache，同一用户的并行请求不重复查库；
+    数据未变化且有效期充足时不写库，剩余有效期低于SESSION_RENEW_RATIO时才续期；
+    过期Session读取时忽略，每SESSION_SWEEP_INTERVAL秒随一次写入批量删除
+    """
+    serializer = TaggedJSONSerializer()
+    session_class = SQLiteSession
+
+    def __init__(self):
+        self.cache = TTLCache(self._load, SESSION_CACHE_MAX_SIZE, lambda: SESSION_CACHE_TTL)
+        self.last_sweep = 0.0
+        self.writes = 0  # 写库次数（新建/修改/续期/删除）
+        self.skipped_writes = 0  # 未变化跳过写库的次数
+        self.swept = 0  # 批量清理删除的过期Session数
+
+    def _load(self, sid):
+        """缓存未命中时查库（只读连接），不存在返回None"""
+        pool = get_db_pool(readonly=True)
+        db = pool.acquire()
+        try:
+            row = db.execute('SELECT data, expires_at FROM user_sessions WHERE sid = ?', (sid,)).fetchone()
+        finally:
+            pool.release(db)
+        return {'data': row['data'], 'expires_at': row['expires_at']} if row else None
+
+    def _write(self, sql, params):
+        """写库，距上次清理超过SESSION_SWEEP_INTERVAL时同一事务内批量删除过期Session"""
+        now = time.time()
+        pool = get_db_pool(readonly=False)
+        db = pool.acquire()
+        try:
+            db.execute(sql, params)
+            if now - self.last_sweep >= SESSION_SWEEP_INTERVAL:
+                self.last_sweep = now
+                self.swept += db.execute('DELETE FROM user_sessions WHERE expires_at < ?', (now,)).rowcount
+            db.commit()
+            self.writes += 1
+        finally:
+            pool.release(db)
+
+    def load_session_data(self, sid):
+        """按sid读取Session内容（经过读缓存）：返回(内容字典, 过期时间戳)，不存在/已过期/无法解析返回None"""
+        entry = self.cache.get(sid)
+        if entry and entry['expires_at'] > time.time():
+            try:
+                return self.serializer.loads(entry['data']), entry['expires_at']
+            except ValueError:
+                pass
+        return None
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        loaded = self.load_session_data(sid) if sid else None
+        if loaded:
+            return self.session_class(loaded[0], sid=sid, expires_at=loaded[1])
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # 清空的Session（登出）：删库+删Cookie；从未保存过的空Session不写库也不下发Cookie
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self._write('DELETE FROM user_sessions WHERE sid = ?', (session.sid,))
+                    self.cache.invalidate(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite,
+                                       httponly=httponly)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        expires_at = now + lifetime
+        data = self.serializer.dumps(dict(session))
+        if session.modified or session.new:
+            self._write('''
+                        INSERT INTO user_sessions (sid, data, expires_at)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(sid) DO UPDATE SET data=excluded.data,
+                                                       expires_at=excluded.expires_at
+                        ''', (session.sid, data, expires_at))
+        elif session.expires_at - now < lifetime * SESSION_RENEW_RATIO:
+            # 只续期：活跃用户每个续期周期最多写一次库
+            self._write('UPDATE user_sessions SET expires_at = ? WHERE sid = ?', (expires_at, session.sid))
+        else:
+            self.skipped_writes += 1
+            return
+        self.cache.set(session.sid, {'data': data, 'expires_at': expires_at})
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+            response.vary.add('Cookie')
+
+    def stats(self):
+        """Session存储统计：读缓存命中情况、写库/跳过写库/过期清理次数"""
+        cache_stats = self.cache.stats()
+        return {
+            'cache_size': cache_stats['size'],
+            'cache_hits': cache_stats['hits'],
+            'cache_misses': cache_stats['misses'],
+            'writes': self.writes,
+            'skipped_writes': self.skipped_writes,
+            'swept': self.swept
+        }
+
+
+SESSION_STORE = SQLiteSessionInterface()
+app.session_interface = TimedSessionInterface(SESSION_STORE)
+
+
+# ---------------------- 定时任务（每日22:30落库行情+收益数据） ----------------------
+def calc_record_earn(invest_principal, gszzl, prev_total_earn):
+    """
+    落库收益计算（纯计算，不查库）
+    当日收益 = 投入本金 × 涨幅（百分比转小数）；累计收益 = 上一条累计收益 + 当日收益
+    :return: (当日收益, 截至当日累计收益)
+    """
+    day_earn = round(invest_principal * (float(gszzl) / 100), 2)
+    total_earn = round((prev_total_earn or 0) + day_earn, 2)
+    return (day_earn, total_earn)
+
+
+def calculate_day_earn(user_id, fund_code, record_date, gszzl):
+    """
+    计算单基金单用户当日收益+累计收益
+    :return: (当日收益, 截至当日累计收益)
+    """
+    db = get_db()
+    cur = db.cursor()
+    # 1. 获取用户该基金的投入本金
+    cur.execute('''
+                SELECT invest_principal
+                FROM user_fund_relation
+                WHERE user_id = ?
+                  AND fund_code = ?
+                ''', (user_id, fund_code))
+    relation = cur.fetchone()
+    if not relation:
+        return (0.0, 0.0)
+    # 2. 累计收益 = 上一交易日累计收益 + 当日收益（取record_date之前最近一条，周末/节假日不断档）
+    prev_total_earn = summary_total_before(load_fund_summary(cur, user_id, fund_code), record_date)
+    if prev_total_earn is None:
+        # 补录早于最近记录的日期：回查明细（含归档）中该日期之前最近一条
+        prev_total_earn = earnings_total_before(cur, user_id, fund_code, record_date) or 0
+    return calc_record_earn(relation['invest_principal'], gszzl, prev_total_earn)
+
+
+def auto_record_data():
+    """
+    定时落库核心逻辑（每日15:30执行），分阶段批量处理，耗时随去重后的基金数增长而非用户×基金数
+    1. 拉取：所有持有基金去重后并发拉取一次行情
+    2. 行情落库：批量upsert到fund_daily_trend
+    3. 收益计算：预加载所有用户-基金的收益汇总行，内存计算当日收益/累计收益（上一交易日累计收益续算）
+    4. 收益落库：批量写入user_fund_earnings（汇总行由触发器同事务累加），
+       当日已存在且与计算结果不一致的记录（如添加基金后修改本金）只重算对应用户-基金
+    5. 组合汇总：增量重建今日有变化的用户组合每日汇总
+    derived模式只执行1、2（每只基金一行行情），收益按需计算
+    :return: 执行统计（成功/失败数、写入行数、各阶段耗时），无需落库或失败时返回None
+    """
+    with app.app_context():
+        try:
+            db = get_db()
+            cur = db.cursor()
+            timings = {}
+            # 获取所有用户-基金关联数据
+            cur.execute('SELECT DISTINCT ufr.user_id, ufr.fund_code, ufr.invest_principal FROM user_fund_relation ufr')
+            user_fund_list = cur.fetchall()
+            if not user_fund_list:
+                print("ℹ️ 定时任务：暂无用户添加基金，无需落库")
+                return None
+            today = date.today().strftime("%Y-%m-%d")
+            now = time.strftime("%Y-%m-%d %H:%M:%S")
+
+            # 1. 去重基金代码，并发拉取一次行情（定时任务等待全部完成）
+            stage_start = time.perf_counter()
+            fund_codes = list(dict.fromkeys(item['fund_code'] for item in user_fund_list))
+            quotes = fetch_funds_real(fund_codes, deadline=None)
+            # 接口熔断/退避时返回的旧行情（stale）不能作为今日数据落库，按失败处理
+            quotes = {code: None if fund_data and fund_data.get('stale') else fund_data
+                      for code, fund_data in quotes.items()}
+            timings['fetch'] = time.perf_counter() - stage_start
+
+            # 2. 行情批量写入（同一基金同一天以首次落库为准，如添加基金时写入的行情）
+            stage_start = time.perf_counter()
+            trend_rows = [
+                (fund_code, today, fund_data['jzrq'], fund_data['dwjz'], fund_data['gsz'],
+                 fund_data['gszzl'], fund_data['gztime'], now)
+                for fund_code, fund_data in quotes.items() if fund_data
+            ]
+            cur.executemany('''
+                            INSERT INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime, create_time)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(fund_code, record_date) DO NOTHING
+                            ''', trend_rows)
+            trend_written = cur.rowcount
+            save_intraday_quotes(cur, quotes)
+            timings['trend_upsert'] = time.perf_counter() - stage_start
+            if EARNINGS_STORAGE == 'derived':
+                # derived模式：每只基金只写一行行情，用户收益由行情序列+本金时间线按需计算
+                db.commit()
+                for fund_code in quotes:
+                    FUND_SERIES_CACHE.invalidate(fund_code)
+                invalidate_portfolio_snapshot()
+                fail = len(fund_codes) - len(trend_rows)
+                timing_text = '，'.join(f"{name} {cost * 1000:.1f}ms" for name, cost in timings.items())
+                print(f"✅ 定时任务完成（derived）：落库行情{len(trend_rows)}只基金，失败{fail}只（{today}）；"
+                      f"耗时：{timing_text}")
+                return {
+                    'success': len(trend_rows), 'fail': fail, 'funds': len(fund_codes), 'rows_written': trend_written,
+                    'timings': {name: round(cost, 4) for name, cost in timings.items()}
+                }
+
+            # 3. 预加载收益汇总行（上一交易日累计收益）、今日已落库的行情和收益，内存计算所有用户-基金的当日收益
+            stage_start = time.perf_counter()
+            cur.execute('SELECT * FROM user_fund_summary')
+            summary_map = {(row['user_id'], row['fund_code']): row for row in cur.fetchall()}
+            fetched_codes = [fund_code for fund_code, fund_data in quotes.items() if fund_data]
+            placeholders = ','.join('?' * len(fetched_codes))
+            cur.execute(f'''
+                        SELECT fund_code, gszzl
+                        FROM fund_daily_trend
+                        WHERE fund_code IN ({placeholders})
+                          AND record_date = ?
+                        ''', fetched_codes + [today])
+            today_gszzl = {row['fund_code']: row['gszzl'] for row in cur.fetchall()}
+            cur.execute(f'''
+                        SELECT user_id, fund_code, invest_principal, day_gszzl, day_earn, total_earn
+                        FROM user_fund_earnings
+                        WHERE fund_code IN ({placeholders})
+                          AND record_date = ?
+                        ''', fetched_codes + [today])
+            existing = {(row['user_id'], row['fund_code']): tuple(row)[2:] for row in cur.fetchall()}
+            earnings_rows = []
+            mismatched = []
+            fail = 0
+            for item in user_fund_list:
+                fund_data = quotes.get(item['fund_code'])
+                if not fund_data:
+                    fail += 1
+                    continue
+                gszzl = today_gszzl.get(item['fund_code'], fund_data['gszzl'])
+                day_earn, total_earn = calc_record_earn(
+                    item['invest_principal'], gszzl,
+                    summary_total_before(summary_map.get((item['user_id'], item['fund_code'])), today))
+                key = (item['user_id'], item['fund_code'])
+                if key in existing:
+                    # 重复执行时已存在的记录通常一致，不一致的才重算
+                    if existing[key] != (item['invest_principal'], gszzl, day_earn, total_earn):
+                        mismatched.append(item)
+                    continue
+                earnings_rows.append((
+                    item['user_id'], item['fund_code'], today, item['invest_principal'],
+                    gszzl, day_earn, total_earn, now
+                ))
+            timings['earn_calc'] = time.perf_counter() - stage_start
+
+            # 4. 收益批量写入（已存在的记录不覆盖），不一致的用户-基金按当前本金重算今日记录
+            stage_start = time.perf_counter()
+            cur.executemany('''
+                            INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal,
+                                                            day_gszzl, day_earn, total_earn, create_time)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(user_id, fund_code, record_date) DO NOTHING
+                            ''', earnings_rows)
+            rows_written = cur.rowcount
+            for item in mismatched:
+                rows_written += recompute_earnings(cur, [item['fund_code']], today,
+                                                   {item['user_id']: item['invest_principal']}, item['user_id'])
+            db.commit()
+            timings['earn_insert'] = time.perf_counter() - stage_start
+
+            # 5. 用户组合每日汇总（只重新聚合今日新增/变化的收益记录）
+            stage_start = time.perf_counter()
+            refresh_dirty_portfolio_dailies(db)
+            timings['portfolio_daily'] = time.perf_counter() - stage_start
+            invalidate_portfolio_snapshot()
+
+            success = len(user_fund_list) - fail
+            timing_text = '，'.join(f"{name} {cost * 1000:.1f}ms" for name, cost in timings.items())
+            print(f"✅ 定时任务完成：成功落库{success}条，失败{fail}条（{today}），"
+                  f"基金{len(fund_codes)}只，写入收益{rows_written}条（重算{len(mismatched)}个用户-基金）；"
+                  f"耗时：{timing_text}")
+            return {
+                'success': success, 'fail': fail, 'funds': len(fund_codes),
+                'rows_written': rows_written + trend_written,
+                'timings': {name: round(cost, 4) for name, cost in timings.items()}
+            }
+        except Exception as e:
+            print(f"❌ 定时任务失败：{str(e)}")
+            return None
+
+
+# ---------------------- 任务调度（跨进程租约，多worker只有一个进程执行） ----------------------
+JOB_OWNER = f"{socket.gethostname()}-{os.getpid()}"  # 当前进程标识
+
+
+def acquire_job_lease(lease_name, seconds):
+    """
+    抢占任务租约：无记录、租约已过期（且未完成）或当前进程已持有时成功，成功后租约延长seconds秒
+    :return: True=当前进程获得租约
+    """
+    now_ts = time.time()
+    with app.app_context():
+        db = get_db(readonly=False)
+        cur = db.cursor()
+        cur.execute('''
+                    INSERT INTO job_lease (lease_name, owner, lease_until, done)
+                    VALUES (?, ?, ?, 0)
+                    ON CONFLICT(lease_name) DO UPDATE SET owner=excluded.owner,
+                                                          lease_until=excluded.lease_until
+                    WHERE job_lease.done = 0
+                      AND (job_lease.lease_until < ? OR job_lease.owner = excluded.owner)
+                    ''', (lease_name, JOB_OWNER, now_ts + seconds, now_ts))
+        acquired = cur.rowcount > 0
+        db.commit()
+        return acquired
+
+
+def finish_job_lease(lease_name, done):
+    """结束租约：done=True标记已完成（同批次不再执行），否则立即释放供其他进程重试"""
+    with app.app_context():
+        db = get_db(readonly=False)
+        db.execute('''
+                   UPDATE job_lease
+                   SET lease_until=?,
+                       done=?
+                   WHERE lease_name = ?
+                     AND owner = ?
+                   ''', (0 if not done else time.time(), 1 if done else 0, lease_name, JOB_OWNER))
+        db.commit()
+
+
+def record_job_run(job_name, run_key, **fields):
+    """写入/更新任务执行记录，传run_id则更新，否则新增并返回run_id"""
+    with app.app_context():
+        db = get_db(readonly=False)
+        cur = db.cursor()
+        run_id = fields.pop('run_id', None)
+        if run_id is None:
+            cur.execute('''
+                        INSERT INTO job_runs (job_name, run_key, owner, start_time, status)
+                        VALUES (?, ?, ?, ?, 'running')
+                        ''', (job_name, run_key, JOB_OWNER, time.strftime("%Y-%m-%d %H:%M:%S")))
+            run_id = cur.lastrowid
+        else:
+            assignments = ', '.join(f"{name}=?" for name in fields)
+            cur.execute(f'UPDATE job_runs SET {assignments} WHERE id = ?', (*fields.values(), run_id))
+        db.commit()
+        return run_id
+
+
+def run_exclusive_job(job_name, job_func, run_key=None):
+    """
+    多进程互斥执行定时任务：同一任务同一批次（默认当天）只有抢到租约的进程执行一次
+    执行过程（开始/结束/耗时/写入行数/失败数）记录到job_runs
+    :param job_func: 任务函数，返回dict（可含rows_written、fail），返回None视为失败
+    """
+    run_key = run_key or date.today().strftime("%Y-%m-%d")
+    lease_name = f"{job_name}:{run_key}"
+    if not acquire_job_lease(lease_name, JOB_LEASE_SECONDS):
+        print(f"ℹ️ 定时任务{job_name}（{run_key}）已执行或正由其他进程执行，跳过")
+        return None
+    run_id = record_job_run(job_name, run_key)
+    start = time.perf_counter()
+    result = None
+    error = None
+    try:
+        result = job_func()
+    except Exception as e:
+        error = str(e)
+    status = 'success' if result is not None and error is None else 'failed'
+    record_job_run(job_name, run_key, run_id=run_id, end_time=time.strftime("%Y-%m-%d %H:%M:%S"),
+                   duration=round(time.perf_counter() - start, 3),
+                   rows_written=(result or {}).get('rows_written', 0),
+                   failures=(result or {}).get('fail', 0), status=status,
+                   error=error or (None if result is not None else '任务未返回结果'))
+    finish_job_lease(lease_name, done=status == 'success')
+    return result
+
+
+def start_schedule():
+    """启动定时任务守护线程，不阻塞Flask主进程；多进程部署时由租约保证每日任务只执行一次"""
+    schedule.every().day.at("10:30").do(run_exclusive_job, 'auto_record_data', auto_record_data)
+    schedule.every().day.at("11:00").do(run_exclusive_job, 'fill_trend_gaps', fill_trend_gaps)
+    schedule.every().day.at("11:30").do(run_exclusive_job, 'archive_earnings', archive_earnings)
+
+    # 开发测试：每分钟执行，上线注释
+    # schedule.every(1).minutes.do(run_exclusive_job, 'auto_record_data', auto_record_data)
+    def run_schedule():
+        while True:
+            schedule.run_pending()
+            time.sleep(60)
+
+    t = threading.Thread(target=run_schedule, daemon=True)
+    t.start()
+    print("🚀 定时任务启动：每日10:30自动落库昨日基金行情+收益数据")
+
+
+# ---------------------- 后台行情刷新（接口读本地行情表，不直接请求外部接口） ----------------------
+def get_quote_refresh_interval():
+    """后台行情刷新间隔：交易时段短，非交易时段长"""
+    return QUOTE_REFRESH_INTERVAL if is_trading_time() else QUOTE_REFRESH_INTERVAL_CLOSED
+
+
+def save_intraday_quotes(cur, quotes):
+    """
+    批量upsert实时行情到fund_intraday_quote（调用方负责提交事务）
+    :param quotes: {基金代码: 行情字典/None}，None和超时旧数据（stale）跳过
+    :return: 写入的基金代码列表
+    """
+    update_ts = time.time()
+    rows = [
+        (fund_code, fund_data.get('name', ''), fund_data['jzrq'], fund_data['dwjz'], fund_data['gsz'],
+         fund_data['gszzl'], fund_data['gztime'], update_ts)
+        for fund_code, fund_data in quotes.items() if fund_data and not fund_data.get('stale')
+    ]
+    cur.executemany('''
+                    INSERT INTO fund_intraday_quote (fund_code, fund_name, jzrq, dwjz, gsz, gszzl, gztime, update_ts)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(fund_code) DO UPDATE SET fund_name=excluded.fund_name,
+                                                         jzrq=excluded.jzrq,
+                                                         dwjz=excluded.dwjz,
+                                                         gsz=excluded.gsz,
+                                                         gszzl=excluded.gszzl,
+                                                         gztime=excluded.gztime,
+                                                         update_ts=excluded.update_ts
+                    ''', rows)
+    return [row[0] for row in rows]
+
+
+def refresh_intraday_quotes():
+    """
+    拉取所有用户持有基金（去重）的最新行情，写入本地行情表
+    :return: 本次写入的基金代码列表
+    """
+    with app.app_context():
+        db = get_db(readonly=False)
+        cur = db.cursor()
+        cur.execute('SELECT DISTINCT fund_code FROM user_fund_relation')
+        fund_codes = [row['fund_code'] for row in cur.fetchall()]
+        if not fund_codes:
+            return []
+        quotes = fetch_funds_real(fund_codes, deadline=None)
+        saved = save_intraday_quotes(cur, quotes)
+        db.commit()
+        invalidate_portfolio_snapshot()
+        QUOTE_BROKER.notify()
+        return saved
+
+
+def read_intraday_quotes(codes):
+    """
+    只读本地行情表
+    :return: (有效行情{基金代码: 行情字典}, 长时间未刷新的旧行情{基金代码: 行情字典（stale=True）})
+    """
+    if not codes:
+        return {}, {}
+    cur = get_db().cursor()
+    placeholders = ','.join('?' * len(codes))
+    cur.execute(f'''
+                SELECT fund_code, fund_name, jzrq, dwjz, gsz, gszzl, gztime, update_ts
+                FROM fund_intraday_quote
+                WHERE fund_code IN ({placeholders})
+                ''', codes)
+    max_age = get_quote_refresh_interval() * 3
+    now_ts = time.time()
+    result = {}
+    outdated = {}  # 长时间未刷新的行情，接口拉取失败时作为旧数据返回
+    for row in cur.fetchall():
+        quote = {
+            'fundcode': row['fund_code'],
+            'name': row['fund_name'],
+            'jzrq': row['jzrq'],
+            'dwjz': row['dwjz'],
+            'gsz': row['gsz'],
+            # 估值时间非今日（如次日开盘前）涨幅按0处理，与fetch_fund_real一致
+            'gszzl': row['gszzl'] if is_gztime_today(row['gztime']) else 0.0,
+            'gztime': row['gztime']
+        }
+        if now_ts - row['update_ts'] > max_age:
+            outdated[row['fund_code']] = dict(quote, stale=True)
+        else:
+            result[row['fund_code']] = quote
+    return result, outdated
+
+
+def load_intraday_quotes(fund_codes):
+    """
+    读取基金实时行情：优先读本地行情表，表中没有或长时间未刷新（后台刷新未运行）的基金再实时拉取
+    :return: {基金代码: 行情字典/None}，字段与fetch_fund_real一致
+    """
+    codes = list(dict.fromkeys(fund_codes))
+    result, outdated = read_intraday_quotes(codes)
+    missing = [code for code in codes if code not in result]
+    if not missing:
+        return result
+    if has_request_context() and request.environ.get(ASYNC_PREFETCHED_KEY):
+        # 异步模式：行情已在事件循环上拉取并写入行情缓存，工作线程只读缓存，不请求外部接口
+        fetched = {code: QUOTE_CACHE.get_cached(code) or last_known_quote(code) for code in missing}
+    else:
+        fetched = fetch_funds_real(missing)
+    for code in missing:
+        result[code] = fetched.get(code) or outdated.get(code)
+    return result
+
+
+def start_quote_refresher():
+    """启动后台行情刷新守护线程：交易时段按QUOTE_REFRESH_INTERVAL轮询，非交易时段降低频率"""
+
+    def run_refresher():
+        while True:
+            interval = get_quote_refresh_interval()
+            try:
+                # 多进程部署时只有租约持有者刷新，租约覆盖两个刷新周期，持有者退出后其他进程接管
+                if acquire_job_lease('quote_refresher', interval * 2):
+                    saved = refresh_intraday_quotes()
+                    print(f"🔄 行情刷新完成：{len(saved)}只基金")
+            except Exception as e:
+                print(f"❌ 行情刷新失败：{str(e)}")
+            time.sleep(interval)
+
+    t = threading.Thread(target=run_refresher, daemon=True)
+    t.start()
+    print(f"🚀 行情刷新启动：交易时段每{QUOTE_REFRESH_INTERVAL}秒刷新持有基金行情")
+
+
+# ---------------------- 核心计算工具（收益/本金/涨幅，严格按需求） ----------------------
+def get_fund_add_date(user_id, fund_code):
+    """获取基金添加日期（YYYY-MM-DD），用于筛选历史收益"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+                SELECT add_time
+                FROM user_fund_relation
+                WHERE user_id = ?
+                  AND fund_code = ?
+                ''', (user_id, fund_code))
+    add_time = cur.fetchone()['add_time']
+    return add_time.split(' ')[0]
+
+
+def calc_history_earn_sum(user_id, fund_code):
+    """计算基金添加日至今的历史收益之和（不含今日，今日为实时计算），读收益汇总行"""
+    cur = get_db().cursor()
+    today = date.today().strftime("%Y-%m-%d")
+    return summary_total_before(load_fund_summary(cur, user_id, fund_code), today) or 0.0
+
+
+def load_fund_summary(cur, user_id, fund_code):
+    """读取单只基金的收益汇总行，derived模式由收益序列生成，无收益记录返回None"""
+    if EARNINGS_STORAGE == 'derived':
+        return derived_summary(fund_code, load_derived_fund_earnings(user_id, fund_code))
+    cur.execute('SELECT * FROM user_fund_summary WHERE user_id = ? AND fund_code = ?', (user_id, fund_code))
+    return cur.fetchone()
+
+
+def summary_total_before(summary, record_date):
+    """
+    由收益汇总行推算record_date之前（不含）的累计收益
+    :param summary: user_fund_summary行（None表示尚无收益记录）
+    :return: 累计收益；record_date早于汇总行最近记录日时无法推算，返回None
+    """
+    if not summary:
+        return 0.0
+    if summary['last_record_date'] < record_date:
+        return summary['total_earn']
+    if summary['last_record_date'] == record_date:
+        return round(summary['total_earn'] - summary['last_day_earn'], 2)
+    return None
+
+
+def summary_yesterday(summary, today):
+    """由收益汇总行取今日之前最近一个交易日的涨幅/收益：(涨幅, 收益)，无记录为(0, 0)"""
+    if not summary:
+        return (0.0, 0.0)
+    if summary['last_record_date'] < today:
+        return (summary['last_day_gszzl'], summary['last_day_earn'])
+    if summary['prev_record_date']:
+        return (summary['prev_day_gszzl'], summary['prev_day_earn'])
+    return (0.0, 0.0)
+
+
+def rebuild_fund_summaries(cur, user_id=None, fund_codes=None, archived=True):
+    """
+    按收益明细重建收益汇总行（迁移回填、收益明细批量修改后调用），只统计添加日之后的记录，
+    累计收益加上归档周期的收益之和（归档行已汇总，不解包）
+    :param user_id: 只重建指定用户，None=全部用户
+    :param fund_codes: 只重建指定基金列表，None=全部基金
+    :param archived: 是否累加归档表（迁移v9之前的迁移步骤调用时归档表尚未创建）
+    """
+    archived_earn = '''
+                    + coalesce((SELECT SUM(sum_day_earn)
+                                FROM user_fund_earnings_archive v
+                                WHERE v.user_id = a.user_id
+                                  AND v.fund_code = a.fund_code), 0)''' if archived else ''
+    conditions = ''
+    params = []
+    if user_id is not None:
+        conditions += ' AND r.user_id = ?'
+        params.append(user_id)
+    if fund_codes is not None:
+        conditions += f" AND r.fund_code IN ({','.join('?' * len(fund_codes))})"
+        params.extend(fund_codes)
+    cur.execute('DELETE FROM user_fund_summary WHERE 1 = 1' + conditions.replace('r.', ''), params)
+    # 按(用户, 基金)顺序聚合（走唯一索引免排序），最近/上一条记录按索引回查
+    cur.execute(f'''
+                INSERT INTO user_fund_summary (user_id, fund_code, last_record_date, total_earn, last_day_gszzl,
+                                               last_day_earn, prev_record_date, prev_day_gszzl, prev_day_earn,
+                                               update_time)
+                SELECT a.user_id, a.fund_code, a.last_date,
+                       round(a.total_earn{archived_earn}, 2),
+                       l.day_gszzl, l.day_earn, p.record_date, p.day_gszzl, p.day_earn, ?
+                FROM (SELECT e.user_id, e.fund_code, MIN(e.record_date) AS first_date,
+                             MAX(e.record_date) AS last_date, round(SUM(e.day_earn), 2) AS total_earn
+                      FROM user_fund_earnings e
+                               JOIN user_fund_relation r
+                                    ON r.user_id = e.user_id AND r.fund_code = e.fund_code
+                      WHERE e.record_date >= substr(r.add_time, 1, 10){conditions}
+                      GROUP BY e.user_id, e.fund_code) a
+                         JOIN user_fund_earnings l
+                              ON l.user_id = a.user_id AND l.fund_code = a.fund_code AND l.record_date = a.last_date
+                         LEFT JOIN user_fund_earnings p
+                                   ON p.user_id = a.user_id AND p.fund_code = a.fund_code
+                                       AND p.record_date = (SELECT MAX(record_date)
+                                                            FROM user_fund_earnings
+                                                            WHERE user_id = a.user_id
+                                                              AND fund_code = a.fund_code
+                                                              AND record_date >= a.first_date
+                                                              AND record_date < a.last_date)
+                ''', [time.strftime("%Y-%m-%d %H:%M:%S")] + params)
+
+
+def calc_total_earn(user_id, fund_code, today_earn):
+    """累计收益 = 历史收益之和 + 今日实时收益（需求3）"""
+    history_earn = calc_history_earn_sum(user_id, fund_code)
+    total_earn = round(history_earn + today_earn, 2)
+    return total_earn
+
+
+def calc_current_principal(invest_principal, total_earn):
+    """现存本金 = 投入本金 + 累计收益（需求4）"""
+    return round(invest_principal + total_earn, 2)
+
+
+def calc_today_earn(current_principal, today_gszzl):
+    """今日收益 = 现存本金 × 今日实时涨幅（需求5）"""
+    today_earn = round(current_principal * (float(today_gszzl) / 100), 2)
+    return today_earn
+
+
+# ---------------------- 收益重算引擎（本金修改/行情修正后按序列整体重算） ----------------------
+def calc_earnings_series(principals, gszzls, base_total=None):
+    """
+    整段计算收益序列，与calc_record_earn一致：当日收益保留2位，累计收益逐日累加后保留2位
+    :param base_total: 序列之前最后一条累计收益
+    :return: (当日收益数组, 累计收益数组)
+    """
+    day_earn_arr = array('d', (round(principal * (gszzl / 100), 2) for principal, gszzl in zip(principals, gszzls)))
+    total_earn_arr = array('d', accumulate(day_earn_arr, lambda total, earn: round(total + earn, 2),
+                                           initial=base_total or 0))[1:]
+    return (day_earn_arr, total_earn_arr)
+
+
+def recompute_earnings(cur, fund_codes, from_date=None, principals=None, user_id=None):
+    """
+    重算指定基金from_date（含）之后的收益明细：按基金一次加载行情序列和所有持有用户的收益序列，
+    每个用户-基金整段计算当日收益（本金×涨幅）和累计收益（前缀和），最后一次executemany写回并重建汇总行
+    :param fund_codes: 基金代码列表
+    :param from_date: 起始日期（YYYY-MM-DD），None=全部历史
+    :param principals: {用户ID: 新投入本金}，指定的用户从from_date起按新本金重算，其余沿用记录中的本金
+    :param user_id: 只重算指定用户，None=持有这些基金的全部用户
+    :return: 有变化并写回的收益记录条数
+    """
+    fund_codes = list(dict.fromkeys(fund_codes))
+    if not fund_codes:
+        return 0
+    from_date = from_date or ''
+    principals = principals or {}
+    placeholders = ','.join('?' * len(fund_codes))
+    user_condition = ' AND user_id = ?' if user_id is not None else ''
+    user_params = [user_id] if user_id is not None else []
+    # 0. 需要改写的归档周期先还原为在线明细
+    unarchive_earnings(cur, fund_codes, from_date, user_id=user_id)
+    # 1. 行情序列（以fund_daily_trend为准，修正后的涨幅在此生效）
+    cur.execute(f'''
+                SELECT fund_code, record_date, gszzl
+                FROM fund_daily_trend
+                WHERE fund_code IN ({placeholders})
+                  AND record_date >= ?
+                ''', fund_codes + [from_date])
+    gszzl_map = {(row['fund_code'], row['record_date']): row['gszzl'] for row in cur.fetchall()}
+    # 2. 起始日期前最后一条累计收益（在线明细与归档取较晚的一条），作为前缀和的初始值
+    cur.execute(f'''
+                SELECT v.user_id, v.fund_code, v.last_date AS record_date, v.close_total AS total_earn
+                FROM user_fund_earnings_archive v
+                         JOIN (SELECT user_id, fund_code, MAX(period_start) AS period_start
+                               FROM user_fund_earnings_archive
+                               WHERE fund_code IN ({placeholders})
+                                 AND last_date < ?{user_condition}
+                               GROUP BY user_id, fund_code) m
+                              ON m.user_id = v.user_id AND m.fund_code = v.fund_code
+                                  AND m.period_start = v.period_start
+                ''', fund_codes + [from_date] + user_params)
+    base_rows = cur.fetchall()
+    cur.execute(f'''
+                SELECT e.user_id, e.fund_code, e.record_date, e.total_earn
+                FROM user_fund_earnings e
+                         JOIN (SELECT user_id, fund_code, MAX(record_date) AS max_date
+                               FROM user_fund_earnings
+                               WHERE fund_code IN ({placeholders})
+                                 AND record_date < ?{user_condition}
+                               GROUP BY user_id, fund_code) m
+                              ON m.user_id = e.user_id AND m.fund_code = e.fund_code AND m.max_date = e.record_date
+                ''', fund_codes + [from_date] + user_params)
+    base_map = {(row['user_id'], row['fund_code']): row['total_earn']
+                for row in sorted(base_rows + cur.fetchall(), key=lambda row: row['record_date'])}
+    # 3. 待重算的收益序列，按基金-用户-日期排序后分段
+    cur.execute(f'''
+                SELECT id, user_id, fund_code, record_date, invest_principal, day_gszzl, day_earn, total_earn
+                FROM user_fund_earnings
+                WHERE fund_code IN ({placeholders})
+                  AND record_date >= ?{user_condition}
+                ORDER BY fund_code, user_id, record_date
+                ''', fund_codes + [from_date] + user_params)
+    updates = []
+    changed_funds = set()
+    for (fund_code, row_user_id), rows in groupby(cur.fetchall(), key=lambda row: (row['fund_code'], row['user_id'])):
+        rows = list(rows)
+        new_principal = principals.get(row_user_id)
+        principal_arr = array('d', (new_principal if new_principal is not None else row['invest_principal']
+                                    for row in rows))
+        gszzl_arr = array('d', (gszzl_map.get((fund_code, row['record_date']), row['day_gszzl']) for row in rows))
+        day_earn_arr, total_earn_arr = calc_earnings_series(principal_arr, gszzl_arr,
+                                                            base_map.get((row_user_id, fund_code)))
+        # 只写回有变化的记录（行情修正通常只影响少数记录）
+        update_count = len(updates)
+        updates.extend(
+            (principal, gszzl, day_earn, total_earn, row['id'])
+            for row, principal, gszzl, day_earn, total_earn
+            in zip(rows, principal_arr, gszzl_arr, day_earn_arr, total_earn_arr)
+            if (principal, gszzl, day_earn, total_earn) != (row['invest_principal'], row['day_gszzl'],
+                                                            row['day_earn'], row['total_earn'])
+        )
+        if len(updates) > update_count:
+            changed_funds.add(fund_code)
+    if not updates:
+        return 0
+    cur.executemany('''
+                    UPDATE user_fund_earnings
+                    SET invest_principal=?,
+                        day_gszzl=?,
+                        day_earn=?,
+                        total_earn=?
+                    WHERE id = ?
+                    ''', updates)
+    rebuild_fund_summaries(cur, user_id, sorted(changed_funds))
+    return len(updates)
+
+
+# ---------------------- 收益周/月汇总（趋势图长区间降采样） ----------------------
+ROLLUP_PERIODS = ('week', 'month')
+ROLLUP_COLUMNS = ('user_id', 'fund_code', 'period', 'period_start', 'first_date', 'last_date', 'days', 'open_total',
+                  'high_total', 'low_total', 'close_total', 'sum_day_earn', 'period_gszzl')
+
+
+def period_start_of(record_date, period):
+    """日期所在周期的起始日期：week=所在周周一，month=所在月1日"""
+    if period == 'month':
+        return record_date[:8] + '01'
+    day = datetime.strptime(record_date, "%Y-%m-%d").date()
+    return (day - timedelta(days=day.weekday())).strftime("%Y-%m-%d")
+
+
+def build_rollup_row(user_id, fund_code, period, period_start, rows):
+    """由一个周期内按日期升序的收益明细生成汇总行（OHLC取累计收益，涨幅按日复利）"""
+    totals = [row['total_earn'] for row in rows]
+    growth = 1.0
+    for row in rows:
+        growth *= 1 + row['day_gszzl'] / 100
+    return (user_id, fund_code, period, period_start, rows[0]['record_date'], rows[-1]['record_date'], len(rows),
+            totals[0], max(totals), min(totals), totals[-1], round(sum(row['day_earn'] for row in rows), 2),
+            round((growth - 1) * 100, 4))
+
+
+def refresh_earnings_rollups(cur, user_id, fund_code):
+    """
+    重建收益明细有变化（earnings_rollup_dirty有标记）的用户-基金的周/月汇总，
+    只重新聚合最早变化日期所在周期及之后的明细（调用方负责事务）
+    :return: 是否有重建
+    """
+    cur.execute('SELECT from_date FROM earnings_rollup_dirty WHERE user_id = ? AND fund_code = ?',
+                (user_id, fund_code))
+    dirty = cur.fetchone()
+    if not dirty:
+        return False
+    starts = {period: period_start_of(dirty['from_date'], period) for period in ROLLUP_PERIODS}
+    rows = load_earnings_rows(cur, user_id, fund_code, min(starts.values()))
+    rollup_rows = []
+    for period, start in starts.items():
+        cur.execute('''
+                    DELETE FROM user_fund_earnings_rollup
+                    WHERE user_id = ? AND fund_code = ? AND period = ? AND period_start >= ?
+                    ''', (user_id, fund_code, period, start))
+        period_rows = (row for row in rows if row['record_date'] >= start)
+        for period_start, group in groupby(period_rows, key=lambda row: period_start_of(row['record_date'], period)):
+            rollup_rows.append(build_rollup_row(user_id, fund_code, period, period_start, list(group)))
+    cur.executemany('''
+                    INSERT INTO user_fund_earnings_rollup (user_id, fund_code, period, period_start, first_date,
+                                                           last_date, days, open_total, high_total, low_total,
+                                                           close_total, sum_day_earn, period_gszzl)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', rollup_rows)
+    cur.execute('DELETE FROM earnings_rollup_dirty WHERE user_id = ? AND fund_code = ?', (user_id, fund_code))
+    return True
+
+
+def ensure_earnings_rollups(user_id, fund_code):
+    """
+    趋势图读取周/月汇总前调用：只读连接检查有无待重建标记，有则取读写连接在写事务内重建
+    （BEGIN IMMEDIATE保证重建期间没有新写入的明细被漏掉）
+    """
+    cur = get_db().cursor()
+    cur.execute('SELECT 1 FROM earnings_rollup_dirty WHERE user_id = ? AND fund_code = ?', (user_id, fund_code))
+    if not cur.fetchone():
+        return False
+    db = get_db(readonly=False)
+    db.execute('BEGIN IMMEDIATE')
+    refreshed = refresh_earnings_rollups(db.cursor(), user_id, fund_code)
+    db.commit()
+    return refreshed
+
+
+def choose_trend_granularity(start_date, end_date, points):
+    """按区间天数选择趋势图粒度：天数不超过目标点数按日，周数不超过按周，否则按月"""
+    span_days = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    if span_days <= points:
+        return 'day'
+    if span_days / 7 <= points:
+        return 'week'
+    return 'month'
+
+
+def rollup_point(row):
+    """周/月汇总行转趋势图数据点（date为周期起始日，day_earn为周期收益之和，gszzl为周期复合涨幅）"""
+    return {
+        'date': row['period_start'],
+        'end_date': row['last_date'],
+        'days': row['days'],
+        'gszzl': round(row['period_gszzl'], 2),
+        'day_earn': round(row['sum_day_earn'], 2),
+        'total_earn': round(row['close_total'], 2),
+        'open': round(row['open_total'], 2),
+        'high': round(row['high_total'], 2),
+        'low': round(row['low_total'], 2)
+    }
+
+
+# ---------------------- 收益明细归档（已结束的整月压缩为一行，读取时与在线明细合并） ----------------------
+ARCHIVE_FORMAT_VERSION = 1
+ARCHIVE_COLUMNS = ('invest_principal', 'day_gszzl', 'day_earn', 'total_earn')
+
+
+def pack_earnings_period(period_start, rows):
+    """
+    一个周期内按日期升序的收益明细打包为压缩数组：
+    版本号+条数，日期偏移（距周期起始日天数，uint16），每列一个类型字节+数组
+    （全部为2位小数的列存整数分int64，否则存double，保证解包后数值与原记录完全一致）
+    """
+    base = datetime.strptime(period_start, "%Y-%m-%d").date()
+    offsets = array('H', ((datetime.strptime(row['record_date'], "%Y-%m-%d").date() - base).days for row in rows))
+    parts = [struct.pack('<BH', ARCHIVE_FORMAT_VERSION, len(rows))]
+    for column in (offsets,) + tuple(array('d', (row[name] for row in rows)) for name in ARCHIVE_COLUMNS):
+        if column.typecode == 'd':
+            cents = array('q', (round(value * 100) for value in column))
+            if all(cent / 100 == value for cent, value in zip(cents, column)):
+                column = cents
+            parts.append(column.typecode.encode())
+        if sys.byteorder != 'little':
+            column.byteswap()
+        parts.append(column.tobytes())
+    return zlib.compress(b''.join(parts), 9)
+
+
+def unpack_earnings_period(period_start, data):
+    """解包pack_earnings_period的结果：按日期升序的明细dict列表（record_date + ARCHIVE_COLUMNS）"""
+    raw = zlib.decompress(data)
+    version, count = struct.unpack_from('<BH', raw)
+    if version != ARCHIVE_FORMAT_VERSION:
+        raise ValueError(f'不支持的归档格式版本：{version}')
+    pos = struct.calcsize('<BH')
+    columns = []
+    for typecode in ['H'] + [None] * len(ARCHIVE_COLUMNS):
+        if typecode is None:
+            typecode = chr(raw[pos])
+            pos += 1
+        column = array(typecode)
+        column.frombytes(raw[pos:pos + column.itemsize * count])
+        pos += column.itemsize * count
+        if sys.byteorder != 'little':
+            column.byteswap()
+        columns.append([value / 100 for value in column] if typecode == 'q' else column.tolist())
+    base = date.fromisoformat(period_start).toordinal()
+    return [dict(zip(ARCHIVE_COLUMNS, values), record_date=date.fromordinal(base + offset).isoformat())
+            for offset, *values in zip(*columns)]
+
+
+def build_archive_row(user_id, fund_code, period_start, rows):
+    """归档行：月汇总字段（与周/月汇总表同口径）+ 压缩明细"""
+    rollup_row = build_rollup_row(user_id, fund_code, 'month', period_start, rows)
+    return rollup_row[:2] + rollup_row[3:] + (pack_earnings_period(period_start, rows),)
+
+
+def load_earnings_rows(cur, user_id, fund_code, start_date='', end_date='9999-12-31', after='', limit=None):
+    """
+    读取用户-基金[start_date, end_date]内且晚于after的收益明细（按日期升序，最多limit条），
+    归档周期与在线明细在同一条SQL中按日期合并（读快照一致，归档任务并发搬移时不漏读），取够limit条即停止解包
+    :return: dict列表：record_date/day_gszzl/day_earn/total_earn（归档记录另含invest_principal）
+    """
+    if EARNINGS_STORAGE == 'derived':
+        memo = load_derived_fund_earnings(user_id, fund_code)
+        return derived_rows(memo, start_date, end_date, after, limit) if memo else []
+    lower = max(start_date, after)
+    cur.execute('''
+                SELECT period_start AS sort_date, data, NULL AS day_gszzl, NULL AS day_earn, NULL AS total_earn
+                FROM user_fund_earnings_archive
+                WHERE user_id = ?
+                  AND fund_code = ?
+                  AND period_start >= ?
+                  AND period_start <= ?
+                UNION ALL
+                SELECT record_date, NULL, day_gszzl, day_earn, total_earn
+                FROM user_fund_earnings
+                WHERE user_id = ?
+                  AND fund_code = ?
+                  AND record_date >= ?
+                  AND record_date <= ?
+                  AND record_date > ?
+                ORDER BY sort_date
+                ''', (user_id, fund_code, period_start_of(lower or '0001-01-01', 'month'), end_date,
+                      user_id, fund_code, start_date, end_date, after))
+    rows = {}
+    dates = []  # rows的日期，有序维护（归档解包的日期可能早于已读到的在线记录）
+    for item in cur:
+        # 后续记录日期都不早于sort_date，已取够limit条且第limit条更早时可以停止
+        if limit and len(dates) >= limit and item['sort_date'] > dates[limit - 1]:
+            break
+        if item['data'] is None:
+            if item['sort_date'] not in rows:
+                insort(dates, item['sort_date'])
+            rows[item['sort_date']] = {'record_date': item['sort_date'], 'day_gszzl': item['day_gszzl'],
+                                       'day_earn': item['day_earn'], 'total_earn': item['total_earn']}
+            continue
+        for row in unpack_earnings_period(item['sort_date'], item['data']):
+            if start_date <= row['record_date'] <= end_date and row['record_date'] > after \
+                    and row['record_date'] not in rows:
+                rows[row['record_date']] = row
+                insort(dates, row['record_date'])
+    return [rows[record_date] for record_date in dates[:limit]]
+
+
+def earnings_total_before(cur, user_id, fund_code, record_date):
+    """record_date之前（不含）最近一条收益记录的累计收益（在线明细+归档），无记录返回None"""
+    cur.execute('''
+                SELECT *
+                FROM (SELECT record_date AS last_date, NULL AS period_start, NULL AS data, total_earn
+                      FROM user_fund_earnings
+                      WHERE user_id = ?
+                        AND fund_code = ?
+                        AND record_date < ?
+                      ORDER BY record_date DESC
+                      LIMIT 1)
+                UNION ALL
+                SELECT *
+                FROM (SELECT last_date, period_start, data, close_total
+                      FROM user_fund_earnings_archive
+                      WHERE user_id = ?
+                        AND fund_code = ?
+                        AND period_start < ?
+                      ORDER BY period_start DESC
+                      LIMIT 2)
+                ''', (user_id, fund_code, record_date, user_id, fund_code, record_date))
+    candidates = []
+    for item in cur.fetchall():
+        if item['last_date'] < record_date:
+            candidates.append((item['last_date'], item['total_earn']))
+        elif item['data'] is not None:
+            # record_date落在该归档周期内：解包取其之前最近一条
+            candidates.extend((row['record_date'], row['total_earn'])
+                              for row in unpack_earnings_period(item['period_start'], item['data'])
+                              if row['record_date'] < record_date)
+    return max(candidates)[1] if candidates else None
+
+
+def load_derived_dirty(cur, pairs):
+    """
+    读取用户-基金的周/月汇总、用户组合每日汇总的待重建标记
+    :return: ({(用户ID, 基金代码): from_date}, {用户ID: from_date})
+    """
+    fund_dirty = {}
+    user_dirty = {}
+    for user_id, fund_code in pairs:
+        cur.execute('SELECT from_date FROM earnings_rollup_dirty WHERE user_id = ? AND fund_code = ?',
+                    (user_id, fund_code))
+        row = cur.fetchone()
+        if row:
+            fund_dirty[(user_id, fund_code)] = row['from_date']
+    for user_id in {pair[0] for pair in pairs}:
+        cur.execute('SELECT from_date FROM portfolio_daily_dirty WHERE user_id = ?', (user_id,))
+        row = cur.fetchone()
+        if row:
+            user_dirty[user_id] = row['from_date']
+    return (fund_dirty, user_dirty)
+
+
+def restore_derived_dirty(cur, pairs, dirty):
+    """归档/解档只搬移明细、数值不变，撤销明细触发器因此打上的待重建标记（恢复为搬移前的状态）"""
+    fund_dirty, user_dirty = dirty
+    user_ids = {pair[0] for pair in pairs}
+    cur.executemany('DELETE FROM earnings_rollup_dirty WHERE user_id = ? AND fund_code = ?',
+                    [pair for pair in pairs if pair not in fund_dirty])
+    cur.executemany('UPDATE earnings_rollup_dirty SET from_date = ? WHERE user_id = ? AND fund_code = ?',
+                    [(from_date,) + pair for pair, from_date in fund_dirty.items()])
+    cur.executemany('DELETE FROM portfolio_daily_dirty WHERE user_id = ?',
+                    [(user_id,) for user_id in user_ids if user_id not in user_dirty])
+    cur.executemany('UPDATE portfolio_daily_dirty SET from_date = ? WHERE user_id = ?',
+                    [(from_date, user_id) for user_id, from_date in user_dirty.items()])
+
+
+def unarchive_earnings(cur, fund_codes, from_date, to_date=None, user_id=None):
+    """
+    把包含[from_date, to_date]内日期的归档周期还原为在线明细（重算/回填改写历史明细前调用，调用方负责事务），
+    还原后重建收益汇总行（明细插入触发器会重复累加）
+    :return: 还原的收益记录条数
+    """
+    fund_codes = list(dict.fromkeys(fund_codes))
+    if not fund_codes:
+        return 0
+    conditions = ''
+    params = fund_codes + [from_date or '']
+    if to_date:
+        conditions += ' AND period_start <= ?'
+        params.append(to_date)
+    if user_id is not None:
+        conditions += ' AND user_id = ?'
+        params.append(user_id)
+    cur.execute(f'''
+                SELECT user_id, fund_code, period_start, data
+                FROM user_fund_earnings_archive
+                WHERE fund_code IN ({','.join('?' * len(fund_codes))})
+                  AND last_date >= ?{conditions}
+                ''', params)
+    periods = cur.fetchall()
+    if not periods:
+        return 0
+    pairs = sorted({(row['user_id'], row['fund_code']) for row in periods})
+    dirty = load_derived_dirty(cur, pairs)
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    restored = [(row['user_id'], row['fund_code'], item['record_date'], item['invest_principal'], item['day_gszzl'],
+                 item['day_earn'], item['total_earn'], now)
+                for row in periods for item in unpack_earnings_period(row['period_start'], row['data'])]
+    cur.executemany('''
+                    INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal, day_gszzl,
+                                                    day_earn, total_earn, create_time)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, fund_code, record_date) DO NOTHING
+                    ''', restored)
+    cur.executemany('DELETE FROM user_fund_earnings_archive WHERE user_id = ? AND fund_code = ? AND period_start = ?',
+                    [(row['user_id'], row['fund_code'], row['period_start']) for row in periods])
+    restore_derived_dirty(cur, pairs, dirty)
+    for row_user_id, user_pairs in groupby(pairs, key=lambda pair: pair[0]):
+        rebuild_fund_summaries(cur, row_user_id, [fund_code for _, fund_code in user_pairs])
+    return len(restored)
+
+
+def archive_user_fund(cur, user_id, fund_code, add_date, cutoff):
+    """
+    把用户-基金添加日之后、cutoff之前的在线明细按月打包写入归档表并删除（调用方负责事务），
+    月份已有归档（解档后又补录）时合并
+    :return: (归档周期数, 归档记录条数, 压缩后字节数)
+    """
+    cur.execute('''
+                SELECT record_date, invest_principal, day_gszzl, day_earn, total_earn
+                FROM user_fund_earnings
+                WHERE user_id = ?
+                  AND fund_code = ?
+                  AND record_date >= ?
+                  AND record_date < ?
+                ORDER BY record_date
+                ''', (user_id, fund_code, add_date, cutoff))
+    rows = cur.fetchall()
+    if not rows:
+        return (0, 0, 0)
+    archive_rows = []
+    for period_start, group in groupby(rows, key=lambda row: period_start_of(row['record_date'], 'month')):
+        merged = {row['record_date']: dict(row) for row in group}
+        cur.execute('''
+                    SELECT data
+                    FROM user_fund_earnings_archive
+                    WHERE user_id = ?
+                      AND fund_code = ?
+                      AND period_start = ?
+                    ''', (user_id, fund_code, period_start))
+        existing = cur.fetchone()
+        if existing:
+            merged = {row['record_date']: row for row in unpack_earnings_period(period_start, existing['data'])} | merged
+        archive_rows.append(build_archive_row(user_id, fund_code, period_start,
+                                              [merged[record_date] for record_date in sorted(merged)]))
+    cur.executemany('''
+                    INSERT OR REPLACE INTO user_fund_earnings_archive (user_id, fund_code, period_start, first_date,
+                                                                      last_date, days, open_total, high_total,
+                                                                      low_total, close_total, sum_day_earn,
+                                                                      period_gszzl, data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', archive_rows)
+    cur.execute('''
+                DELETE
+                FROM user_fund_earnings
+                WHERE user_id = ?
+                  AND fund_code = ?
+                  AND record_date >= ?
+                  AND record_date < ?
+                ''', (user_id, fund_code, add_date, cutoff))
+    return (len(archive_rows), len(rows), sum(len(row[-1]) for row in archive_rows))
+
+
+def archive_earnings(keep_months=ARCHIVE_KEEP_MONTHS):
+    """
+    定时归档：收益明细在线保留最近keep_months个整月（含当月），更早的按用户-基金-月压缩为归档行，
+    每批ARCHIVE_BATCH_PAIRS个用户-基金一个写事务；只归档最近两条记录都在保留期内的用户-基金
+    （收益汇总行的最近/上一条记录始终在线），归档后空闲页过多时VACUUM回收文件空间
+    :return: 归档统计，rows_written/fail供任务记录使用
+    """
+    today = date.today()
+    month_index = today.year * 12 + today.month - max(keep_months, 1)
+    cutoff = f"{month_index // 12:04d}-{month_index % 12 + 1:02d}-01"
+    stats = {'cutoff': cutoff, 'pairs': 0, 'periods': 0, 'rows': 0, 'bytes': 0, 'fail': 0, 'vacuumed': False}
+    start = time.perf_counter()
+    with app.app_context():
+        db = get_db(readonly=False)
+        cur = db.cursor()
+        cur.execute('''
+                    SELECT s.user_id, s.fund_code, substr(r.add_time, 1, 10) AS add_date
+                    FROM user_fund_summary s
+                             JOIN user_fund_relation r ON r.user_id = s.user_id AND r.fund_code = s.fund_code
+                    WHERE s.prev_record_date >= ?
+                      AND EXISTS (SELECT 1
+                                  FROM user_fund_earnings e
+                                  WHERE e.user_id = s.user_id
+                                    AND e.fund_code = s.fund_code
+                                    AND e.record_date >= substr(r.add_time, 1, 10)
+                                    AND e.record_date < ?)
+                    ''', (cutoff, cutoff))
+        pairs = [tuple(row) for row in cur.fetchall()]
+        for i in range(0, len(pairs), ARCHIVE_BATCH_PAIRS):
+            batch = pairs[i:i + ARCHIVE_BATCH_PAIRS]
+            try:
+                cur.execute('BEGIN IMMEDIATE')
+                dirty = load_derived_dirty(cur, [pair[:2] for pair in batch])
+                for user_id, fund_code, add_date in batch:
+                    periods, rows, size = archive_user_fund(cur, user_id, fund_code, add_date, cutoff)
+                    stats['periods'] += periods
+                    stats['rows'] += rows
+                    stats['bytes'] += size
+                restore_derived_dirty(cur, [pair[:2] for pair in batch], dirty)
+                db.commit()
+                stats['pairs'] += len(batch)
+            except sqlite3.Error as e:
+                db.rollback()
+                stats['fail'] += len(batch)
+                print(f"❌ 收益明细归档失败（{len(batch)}个用户-基金）：{str(e)}")
+        if ARCHIVE_VACUUM_RATIO and stats['rows']:
+            page_count = cur.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = cur.execute('PRAGMA freelist_count').fetchone()[0]
+            if page_count and freelist_count / page_count > ARCHIVE_VACUUM_RATIO:
+                db.execute('VACUUM')
+                stats['vacuumed'] = True
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    stats['rows_written'] = stats['periods']
+    print(f"✅ 收益明细归档完成：{cutoff}之前{stats['pairs']}个用户-基金，{stats['rows']}条明细压缩为"
+          f"{stats['periods']}个月（{stats['bytes']}字节），失败{stats['fail']}个，耗时{stats['seconds']}s")
+    return stats
+
+
+# ---------------------- 用户组合每日汇总（组合趋势图，一次主键范围读取） ----------------------
+def refresh_portfolio_daily(cur, user_id):
+    """
+    重建收益明细有变化（portfolio_daily_dirty有标记）的用户组合每日汇总：
+    只重新聚合最早变化日期及之后的收益明细（含归档月份），累计收益接续该日期之前的最后一行（调用方负责事务）
+    :return: 是否有重建
+    """
+    cur.execute('SELECT from_date FROM portfolio_daily_dirty WHERE user_id = ?', (user_id,))
+    dirty = cur.fetchone()
+    if not dirty:
+        return False
+    from_date = dirty['from_date']
+    # CROSS JOIN固定以基金关系为外表：按(用户, 基金, 日期)范围查明细，定时任务增量重建只读当日记录
+    cur.execute('''
+                SELECT e.record_date, NULL AS data, e.invest_principal, e.day_earn
+                FROM user_fund_relation r
+                         CROSS JOIN user_fund_earnings e ON e.user_id = r.user_id AND e.fund_code = r.fund_code
+                WHERE r.user_id = ?
+                  AND e.record_date >= ?
+                  AND e.record_date >= substr(r.add_time, 1, 10)
+                UNION ALL
+                SELECT v.period_start, v.data, NULL, NULL
+                FROM user_fund_relation r
+                         CROSS JOIN user_fund_earnings_archive v
+                                    ON v.user_id = r.user_id AND v.fund_code = r.fund_code
+                WHERE r.user_id = ?
+                  AND v.period_start >= ?
+                ''', (user_id, from_date, user_id, period_start_of(from_date, 'month') if from_date else ''))
+    days = {}  # 日期 -> [本金之和, 收益之和, 基金数]
+    for item in cur.fetchall():
+        rows = [item] if item['data'] is None else unpack_earnings_period(item['record_date'], item['data'])
+        for row in rows:
+            if row['record_date'] >= from_date:
+                day = days.setdefault(row['record_date'], [0.0, 0.0, 0])
+                day[0] += row['invest_principal']
+                day[1] += row['day_earn']
+                day[2] += 1
+    cur.execute('''
+                SELECT total_earn
+                FROM user_portfolio_daily
+                WHERE user_id = ?
+                  AND record_date < ?
+                ORDER BY record_date DESC
+                LIMIT 1
+                ''', (user_id, from_date))
+    base = cur.fetchone()
+    total_earn = base['total_earn'] if base else 0.0
+    daily_rows = []
+    for record_date in sorted(days):
+        invest_principal, day_earn, funds = days[record_date]
+        day_earn = round(day_earn, 2)
+        total_earn = round(total_earn + day_earn, 2)
+        daily_rows.append((user_id, record_date, round(invest_principal, 2), day_earn, total_earn, funds))
+    cur.execute('DELETE FROM user_portfolio_daily WHERE user_id = ? AND record_date >= ?', (user_id, from_date))
+    cur.executemany('''
+                    INSERT INTO user_portfolio_daily (user_id, record_date, invest_principal, day_earn, total_earn,
+                                                      funds)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ''', daily_rows)
+    cur.execute('DELETE FROM portfolio_daily_dirty WHERE user_id = ?', (user_id,))
+    return True
+
+
+def refresh_dirty_portfolio_dailies(db):
+    """
+    定时落库/历史回填写入收益后调用：重建所有有待重建标记的用户组合每日汇总（每个用户一个短写事务）
+    :return: 重建的用户数
+    """
+    cur = db.cursor()
+    cur.execute('SELECT user_id FROM portfolio_daily_dirty')
+    user_ids = [row['user_id'] for row in cur.fetchall()]
+    for user_id in user_ids:
+        cur.execute('BEGIN IMMEDIATE')
+        refresh_portfolio_daily(cur, user_id)
+        db.commit()
+    return len(user_ids)
+
+
+def ensure_portfolio_daily(user_id):
+    """组合趋势图读取前调用：只读连接检查有无待重建标记（本金修改、增删基金后），有则取读写连接在写事务内重建"""
+    cur = get_db().cursor()
+    cur.execute('SELECT 1 FROM portfolio_daily_dirty WHERE user_id = ?', (user_id,))
+    if not cur.fetchone():
+        return False
+    db = get_db(readonly=False)
+    db.execute('BEGIN IMMEDIATE')
+    refreshed = refresh_portfolio_daily(db.cursor(), user_id)
+    db.commit()
+    return refreshed
+
+
+# ---------------------- 派生收益模式（EARNINGS_STORAGE='derived'：收益由共享行情+本金时间线按需计算） ----------------------
+FUND_SERIES_VERSION = count(1)  # 基金行情序列每次加载的版本号，用户收益序列缓存据此判断是否过期
+
+
+def load_fund_series(fund_code):
+    """加载基金全部日行情涨幅（按日期升序），所有持有该基金的用户共用"""
+    cur = get_db().cursor()
+    cur.execute('''
+                SELECT record_date, gszzl
+                FROM fund_daily_trend
+                WHERE fund_code = ?
+                ORDER BY record_date
+                ''', (fund_code,))
+    rows = cur.fetchall()
+    dates = tuple(row['record_date'] for row in rows)
+    gszzl = array('d', (row['gszzl'] for row in rows))
+    # 内容摘要：ETag用，与版本号不同，跨进程、重新加载后内容不变则不变
+    digest = hashlib.sha1(','.join(dates).encode() + gszzl.tobytes()).hexdigest()
+    return {'version': next(FUND_SERIES_VERSION), 'dates': dates, 'gszzl': gszzl, 'digest': digest}
+
+
+FUND_SERIES_CACHE = TTLCache(load_fund_series, FUND_SERIES_CACHE_MAX_SIZE, lambda: DERIVED_CACHE_TTL)
+
+
+def load_principal_timelines(cur, user_id, fund_codes=None):
+    """读取用户本金时间线：{基金代码: ((生效日期, 投入本金), ...)}，按生效日期升序"""
+    fund_condition = f" AND fund_code IN ({','.join('?' * len(fund_codes))})" if fund_codes is not None else ''
+    cur.execute(f'''
+                SELECT fund_code, effective_date, invest_principal
+                FROM user_principal_history
+                WHERE user_id = ?{fund_condition}
+                ORDER BY fund_code, effective_date
+                ''', [user_id] + list(fund_codes or []))
+    return {fund_code: tuple((row['effective_date'], row['invest_principal']) for row in rows)
+            for fund_code, rows in groupby(cur.fetchall(), key=lambda row: row['fund_code'])}
+
+
+def update_principal_timeline(cur, user_id, fund_code, new_principal, effective_date=None):
+    """
+    本金修改写入时间线（两种存储模式都维护，便于切换）：effective_date及之后的旧记录被新本金覆盖，
+    None=全部历史（时间线只保留添加日一条）
+    """
+    if effective_date is None:
+        cur.execute('SELECT add_time FROM user_fund_relation WHERE user_id = ? AND fund_code = ?',
+                    (user_id, fund_code))
+        effective_date = cur.fetchone()['add_time'][:10]
+        cur.execute('DELETE FROM user_principal_history WHERE user_id = ? AND fund_code = ?', (user_id, fund_code))
+    else:
+        cur.execute('''
+                    DELETE
+                    FROM user_principal_history
+                    WHERE user_id = ?
+                      AND fund_code = ?
+                      AND effective_date >= ?
+                    ''', (user_id, fund_code, effective_date))
+    cur.execute('''
+                INSERT INTO user_principal_history (user_id, fund_code, effective_date, invest_principal)
+                VALUES (?, ?, ?, ?)
+                ''', (user_id, fund_code, effective_date, new_principal))
+
+
+def seed_principal_history(cur):
+    """迁移：由已落库的收益明细（含归档）生成本金时间线（本金每变化一次一条），无收益记录的基金取添加日+当前本金"""
+    cur.execute('''
+                INSERT OR REPLACE INTO user_principal_history (user_id, fund_code, effective_date, invest_principal)
+                SELECT user_id, fund_code, record_date, invest_principal
+                FROM (SELECT e.user_id, e.fund_code, e.record_date, e.invest_principal,
+                             lag(e.invest_principal) OVER (PARTITION BY e.user_id, e.fund_code
+                                 ORDER BY e.record_date) AS prev_principal
+                      FROM user_fund_earnings e
+                               JOIN user_fund_relation r ON r.user_id = e.user_id AND r.fund_code = e.fund_code
+                      WHERE e.record_date >= substr(r.add_time, 1, 10))
+                WHERE prev_principal IS NULL
+                   OR prev_principal != invest_principal
+                ''')
+    cur.execute('''
+                SELECT user_id, fund_code, period_start, data
+                FROM user_fund_earnings_archive
+                ORDER BY user_id, fund_code, period_start
+                ''')
+    changes = []
+    for (user_id, fund_code), periods in groupby(cur.fetchall(), key=lambda row: (row['user_id'], row['fund_code'])):
+        prev_principal = None
+        for period in periods:
+            for row in unpack_earnings_period(period['period_start'], period['data']):
+                if row['invest_principal'] != prev_principal:
+                    changes.append((user_id, fund_code, row['record_date'], row['invest_principal']))
+                    prev_principal = row['invest_principal']
+    cur.executemany('''
+                    INSERT OR REPLACE INTO user_principal_history (user_id, fund_code, effective_date,
+                                                                   invest_principal)
+                    VALUES (?, ?, ?, ?)
+                    ''', changes)
+    cur.execute('''
+                INSERT INTO user_principal_history (user_id, fund_code, effective_date, invest_principal)
+                SELECT r.user_id, r.fund_code, substr(r.add_time, 1, 10), r.invest_principal
+                FROM user_fund_relation r
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM user_principal_history h
+                                  WHERE h.user_id = r.user_id
+                                    AND h.fund_code = r.fund_code)
+                ''')
+
+
+def derive_earnings_series(series, timeline, add_date):
+    """
+    由基金行情序列+本金时间线计算添加日之后的收益序列（公式与recompute_earnings一致），
+    早于时间线第一条的日期按第一条本金计算
+    """
+    start = bisect_left(series['dates'], add_date)
+    dates = series['dates'][start:]
+    principals = array('d')
+    index = 0
+    principal = timeline[0][1] if timeline else 0.0
+    for record_date in dates:
+        while index < len(timeline) and timeline[index][0] <= record_date:
+            principal = timeline[index][1]
+            index += 1
+        principals.append(principal)
+    day_earn_arr, total_earn_arr = calc_earnings_series(principals, series['gszzl'][start:])
+    return {'series_version': series['version'], 'timeline': timeline, 'add_date': add_date, 'dates': dates,
+            'principal': principals, 'gszzl': series['gszzl'][start:], 'day_earn': day_earn_arr,
+            'total_earn': total_earn_arr}
+
+
+def derive_user_fund_earnings(key):
+    """收益序列缓存的回源加载：key=(用户ID, 基金代码)，基金不属于该用户返回None"""
+    user_id, fund_code = key
+    cur = get_db().cursor()
+    cur.execute('SELECT add_time FROM user_fund_relation WHERE user_id = ? AND fund_code = ?', (user_id, fund_code))
+    relation = cur.fetchone()
+    if not relation:
+        return None
+    timeline = load_principal_timelines(cur, user_id, [fund_code]).get(fund_code, ())
+    return derive_earnings_series(FUND_SERIES_CACHE.get(fund_code), timeline, relation['add_time'][:10])
+
+
+# 用户-基金收益序列缓存（记忆化）：本金时间线、添加日或基金行情序列版本变化后重新计算
+DERIVED_EARNINGS_CACHE = TTLCache(derive_user_fund_earnings, DERIVED_CACHE_MAX_SIZE, lambda: DERIVED_CACHE_TTL)
+
+
+def load_derived_earnings(user_id, relations):
+    """
+    批量获取用户多只基金的收益序列：本金时间线一次查询，用于校验缓存的序列是否仍有效
+    （其他进程修改本金后立即生效，不依赖缓存过期）
+    :param relations: user_fund_relation行列表
+    :return: {基金代码: 收益序列}
+    """
+    timelines = load_principal_timelines(get_db().cursor(), user_id,
+                                         [relation['fund_code'] for relation in relations])
+    result = {}
+    for relation in relations:
+        key = (user_id, relation['fund_code'])
+        memo = DERIVED_EARNINGS_CACHE.get(key)
+        series_version = FUND_SERIES_CACHE.get(relation['fund_code'])['version']
+        if memo is None or (memo['series_version'], memo['timeline'], memo['add_date']) != (
+                series_version, timelines.get(relation['fund_code'], ()), relation['add_time'][:10]):
+            DERIVED_EARNINGS_CACHE.invalidate(key)
+            memo = DERIVED_EARNINGS_CACHE.get(key)
+        if memo is not None:
+            result[relation['fund_code']] = memo
+    return result
+
+
+def load_derived_fund_earnings(user_id, fund_code):
+    """获取单只基金的收益序列，基金不属于该用户返回None"""
+    cur = get_db().cursor()
+    cur.execute('SELECT * FROM user_fund_relation WHERE user_id = ? AND fund_code = ?', (user_id, fund_code))
+    relation = cur.fetchone()
+    return load_derived_earnings(user_id, [relation]).get(fund_code) if relation else None
+
+
+def derived_rows(memo, start_date='', end_date='9999-12-31', after='', limit=None):
+    """从收益序列切出[start_date, end_date]内且晚于after的明细（格式同load_earnings_rows），二分定位不逐条扫描"""
+    dates = memo['dates']
+    low = max(bisect_left(dates, start_date), bisect_right(dates, after))
+    high = bisect_right(dates, end_date)
+    if limit:
+        high = min(high, low + limit)
+    return [{'record_date': dates[i], 'invest_principal': memo['principal'][i], 'day_gszzl': memo['gszzl'][i],
+             'day_earn': memo['day_earn'][i], 'total_earn': memo['total_earn'][i]} for i in range(low, high)]
+
+
+def derived_summary(fund_code, memo):
+    """由收益序列生成与user_fund_summary行同结构的汇总（最近/上一条记录、累计收益），无记录返回None"""
+    if not memo or not memo['dates']:
+        return None
+    summary = {'fund_code': fund_code, 'last_record_date': memo['dates'][-1], 'total_earn': memo['total_earn'][-1],
+               'last_day_gszzl': memo['gszzl'][-1], 'last_day_earn': memo['day_earn'][-1],
+               'prev_record_date': None, 'prev_day_gszzl': None, 'prev_day_earn': None}
+    if len(memo['dates']) > 1:
+        summary.update(prev_record_date=memo['dates'][-2], prev_day_gszzl=memo['gszzl'][-2],
+                       prev_day_earn=memo['day_earn'][-2])
+    return summary
+
+
+def derived_rollup_rows(memo, period, start_date, end_date, after='', limit=None):
+    """由收益序列内存聚合周/月汇总行（格式同user_fund_earnings_rollup，周期按起始日筛选、分页）"""
+    rows = derived_rows(memo, period_start_of(start_date, period))
+    result = []
+    for period_start, group in groupby(rows, key=lambda row: period_start_of(row['record_date'], period)):
+        if period_start > end_date or (limit and len(result) >= limit):
+            break
+        if period_start > after:
+            result.append(dict(zip(ROLLUP_COLUMNS, build_rollup_row(None, None, period, period_start, list(group)))))
+    return result
+
+
+def derived_portfolio_daily(user_id, start_date='', end_date='9999-12-31', after='', limit=None):
+    """由各基金收益序列按日期聚合组合每日汇总（格式同user_portfolio_daily），累计收益从全部历史累加"""
+    days = {}  # 日期 -> [本金之和, 收益之和, 基金数]
+    for memo in load_derived_earnings(user_id, load_user_relations(user_id)).values():
+        for record_date, invest_principal, day_earn in zip(memo['dates'], memo['principal'], memo['day_earn']):
+            day = days.setdefault(record_date, [0.0, 0.0, 0])
+            day[0] += invest_principal
+            day[1] += day_earn
+            day[2] += 1
+    result = []
+    total_earn = 0.0
+    for record_date in sorted(days):
+        invest_principal, day_earn, funds = days[record_date]
+        day_earn = round(day_earn, 2)
+        total_earn = round(total_earn + day_earn, 2)
+        if start_date <= record_date <= end_date and record_date > after:
+            result.append({'record_date': record_date, 'invest_principal': round(invest_principal, 2),
+                           'day_earn': day_earn, 'total_earn': total_earn, 'funds': funds})
+            if limit and len(result) >= limit:
+                break
+    return result
+
+
+def change_principal(cur, user_id, fund_code, new_principal, effective_date=None):
+    """
+    修改投入本金（调用方已更新user_fund_relation并负责事务）：写入本金时间线，
+    rows模式按新本金重算已落库的收益明细+汇总，derived模式收益按需计算无需重算
+    :return: 重算写回的收益记录条数
+    """
+    update_principal_timeline(cur, user_id, fund_code, new_principal, effective_date)
+    if EARNINGS_STORAGE == 'derived':
+        return 0
+    return recompute_earnings(cur, [fund_code], effective_date, {user_id: new_principal}, user_id)
+
+
+# ---------------------- 历史净值回填（新增基金补历史、补齐定时任务漏跑的日期） ----------------------
+# 数据源逐行产出历史净值：{'fund_code', 'record_date', 'dwjz', 'gszzl'(可选), 'jzrq'(可选)}，同一基金按日期升序
+class CSVHistorySource:
+    """CSV文件数据源（表头：fund_code,record_date,dwjz[,gszzl][,jzrq]），逐行读取不整体加载"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def iter_rows(self, fund_codes, start_date, end_date):
+        codes = set(fund_codes)
+        with open(self.path, newline='', encoding='utf-8') as f:
+            for raw in csv.DictReader(f):
+                if raw['fund_code'] in codes and start_date <= raw['record_date'] <= end_date:
+                    yield raw
+
+
+class JSONHistorySource:
+    """JSON文件数据源：.json为行数组，.jsonl为每行一个对象（逐行读取）"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def iter_rows(self, fund_codes, start_date, end_date):
+        codes = set(fund_codes)
+        with open(self.path, encoding='utf-8') as f:
+            rows = (json.loads(line) for line in f if line.strip()) if self.path.endswith('.jsonl') else json.load(f)
+            for raw in rows:
+                if raw['fund_code'] in codes and start_date <= raw['record_date'] <= end_date:
+                    yield raw
+
+
+class HTTPHistorySource:
+    """HTTP数据源：每只基金请求一次，返回该基金的行数组（JSON），多只基金并发拉取、按顺序产出"""
+
+    def __init__(self, url_template):
+        self.url_template = url_template
+
+    def fetch(self, fund_code, start_date, end_date):
+        url = self.url_template.format(fund_code=fund_code, start=start_date, end=end_date)
+        try:
+            response = HTTP_SESSION.get(url, headers=HEADERS, timeout=QUOTE_FETCH_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            print(f"❌ 历史净值拉取失败：{fund_code} - {str(e)}")
+            return []
+
+    def iter_rows(self, fund_codes, start_date, end_date):
+        results = QUOTE_EXECUTOR.map(lambda code: self.fetch(code, start_date, end_date), fund_codes)
+        for fund_code, rows in zip(fund_codes, results):
+            for raw in rows:
+                raw.setdefault('fund_code', fund_code)
+                yield raw
+
+
+def create_history_source(spec=None):
+    """按配置创建历史净值数据源，未配置返回None"""
+    spec = HISTORY_SOURCE if spec is None else spec
+    if not spec:
+        return None
+    if spec.startswith('csv:'):
+        return CSVHistorySource(spec[len('csv:'):])
+    if spec.startswith('json:'):
+        return JSONHistorySource(spec[len('json:'):])
+    if spec.startswith(('http://', 'https://')):
+        return HTTPHistorySource(spec)
+    raise ValueError(f"不支持的历史净值数据源：{spec}")
+
+
+def fill_missing_earnings(cur, fund_code, start_date, end_date):
+    """
+    按已有行情补齐持有用户在[start_date, end_date]内缺失的收益记录（只补添加日之后），
+    当日收益按记录中的本金计算，累计收益由recompute_earnings统一重算
+    :return: 新增的收益记录条数
+    """
+    # 区间内已归档的月份先还原，避免已有日期被当作缺失重复插入
+    unarchive_earnings(cur, [fund_code], start_date, end_date)
+    cur.execute('''
+                INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal, day_gszzl,
+                                                day_earn, total_earn, create_time)
+                SELECT r.user_id, t.fund_code, t.record_date, r.invest_principal, t.gszzl,
+                       round(r.invest_principal * t.gszzl / 100, 2), 0, ?
+                FROM fund_daily_trend t
+                         JOIN user_fund_relation r ON r.fund_code = t.fund_code
+                WHERE t.fund_code = ?
+                  AND t.record_date >= ?
+                  AND t.record_date <= ?
+                  AND t.record_date >= substr(r.add_time, 1, 10)
+                ON CONFLICT(user_id, fund_code, record_date) DO NOTHING
+                ''', (time.strftime("%Y-%m-%d %H:%M:%S"), fund_code, start_date, end_date))
+    return cur.rowcount
+
+
+def load_nav_before(cur, fund_codes, record_date):
+    """各基金record_date之前（不含）最近一条行情的净值（回填行gsz即当日净值，实时行为当日估值），用于计算首行涨幅"""
+    if not fund_codes:
+        return {}
+    cur.execute(f'''
+                SELECT t.fund_code, t.gsz
+                FROM fund_daily_trend t
+                         JOIN (SELECT fund_code, MAX(record_date) AS record_date
+                               FROM fund_daily_trend
+                               WHERE fund_code IN ({','.join('?' * len(fund_codes))})
+                                 AND record_date < ?
+                               GROUP BY fund_code) m
+                              ON m.fund_code = t.fund_code AND m.record_date = t.record_date
+                ''', list(fund_codes) + [record_date])
+    return {row['fund_code']: row['gsz'] for row in cur.fetchall() if row['gsz']}
+
+
+def backfill_history(source, fund_codes, start_date, end_date, overwrite=True, only_dates=None):
+    """
+    从数据源流式导入历史净值到fund_daily_trend（按BACKFILL_BATCH_SIZE分批写入，每批单独提交），
+    导入后按基金补齐持有用户缺失的收益记录，从涨幅实际变化（含新增）的最早日期起重算收益，
+    最后增量重建涉及用户的组合每日汇总
+    缺涨幅时按前一日净值计算（首行取start_date之前最近一条行情），仍无法计算时：已有行情保留原涨幅，没有则跳过该行
+    :param overwrite: 已有日期是否按数据源修正（手动回填），False=只插入缺失日期（缺口补齐、新增基金回填）
+    :param only_dates: {基金代码: 日期集合}，只写入这些日期（缺口补齐），None=区间内全部
+    :return: 导入统计（行数、批次、补齐/重算的收益条数、耗时），rows_written/fail供任务记录使用
+    """
+    stats = {'rows': 0, 'batches': 0, 'funds': 0, 'skipped': 0, 'earnings_inserted': 0, 'recomputed': 0,
+             'fail': 0}
+    start = time.perf_counter()
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    changed_from = {}  # 基金代码 -> 涨幅变化（含新增）的最早日期，只从这里开始补齐/重算收益
+    with app.app_context():
+        db = get_db(readonly=False)
+        cur = db.cursor()
+
+        def flush(batch):
+            """写入一批：新日期插入，已有日期按overwrite修正净值/涨幅（涨幅缺失时保留原值）"""
+            codes = list(dict.fromkeys(row[0] for row in batch))
+            cur.execute(f'''
+                        SELECT fund_code, record_date, dwjz, gszzl
+                        FROM fund_daily_trend
+                        WHERE fund_code IN ({','.join('?' * len(codes))})
+                          AND record_date >= ?
+                          AND record_date <= ?
+                        ''', codes + [min(row[1] for row in batch), max(row[1] for row in batch)])
+            existing = {(row['fund_code'], row['record_date']): (row['dwjz'], row['gszzl']) for row in cur.fetchall()}
+            inserts = []
+            updates = []
+            for fund_code, record_date, jzrq, dwjz, gszzl in batch:
+                stored = existing.get((fund_code, record_date))
+                if stored is None:
+                    if gszzl is None:
+                        stats['skipped'] += 1
+                        continue
+                    inserts.append((fund_code, record_date, jzrq, dwjz, dwjz, gszzl, f"{record_date} 15:00", now))
+                elif overwrite:
+                    gszzl = stored[1] if gszzl is None else gszzl
+                    if (dwjz, gszzl) == stored:
+                        continue
+                    updates.append((jzrq, dwjz, dwjz, gszzl, fund_code, record_date))
+                    if gszzl == stored[1]:
+                        continue
+                else:
+                    continue
+                changed_from[fund_code] = min(changed_from.get(fund_code, record_date), record_date)
+            cur.executemany('''
+                            INSERT INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime,
+                                                          create_time)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(fund_code, record_date) DO NOTHING
+                            ''', inserts)
+            cur.executemany('''
+                            UPDATE fund_daily_trend
+                            SET jzrq=?,
+                                dwjz=?,
+                                gsz=?,
+                                gszzl=?
+                            WHERE fund_code = ?
+                              AND record_date = ?
+                            ''', updates)
+            db.commit()
+            stats['rows'] += len(inserts) + len(updates)
+            stats['batches'] += 1
+
+        # 1. 分批写入行情（缺涨幅时按前一日净值计算）
+        funds = set()
+        prev_dwjz = load_nav_before(cur, fund_codes, start_date)
+        batch = []
+        for raw in source.iter_rows(fund_codes, start_date, end_date):
+            try:
+                fund_code = raw['fund_code']
+                record_date = raw['record_date']
+                dwjz = float(raw['dwjz'])
+                if raw.get('gszzl') not in (None, ''):
+                    gszzl = float(raw['gszzl'])
+                elif prev_dwjz.get(fund_code):
+                    gszzl = round((dwjz / prev_dwjz[fund_code] - 1) * 100, 2)
+                else:
+                    gszzl = None
+            except (KeyError, TypeError, ValueError):
+                stats['fail'] += 1
+                continue
+            prev_dwjz[fund_code] = dwjz
+            if only_dates is not None and record_date not in only_dates.get(fund_code, ()):
+                continue
+            funds.add(fund_code)
+            batch.append((fund_code, record_date, raw.get('jzrq') or record_date, dwjz, gszzl))
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        stats['funds'] = len(funds)
+        if EARNINGS_STORAGE == 'derived':
+            # derived模式：收益按需计算，只需让缓存的行情序列失效
+            for fund_code in changed_from:
+                FUND_SERIES_CACHE.invalidate(fund_code)
+        else:
+            # 2. 按基金补齐收益记录，有新增或涨幅变化时才重算（每只基金一个事务）
+            for fund_code, first_date in changed_from.items():
+                stats['earnings_inserted'] += fill_missing_earnings(cur, fund_code, first_date, end_date)
+                stats['recomputed'] += recompute_earnings(cur, [fund_code], first_date)
+                db.commit()
+            # 3. 补齐/重算涉及的用户组合每日汇总
+            stats['portfolios'] = refresh_dirty_portfolio_dailies(db)
+    if changed_from:
+        invalidate_portfolio_snapshot()
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    stats['rows_written'] = stats['rows'] + stats['earnings_inserted']
+    print(f"✅ 历史净值回填完成：{stats['funds']}只基金，写入{stats['rows']}条行情（{stats['batches']}批），"
+          f"无法计算涨幅跳过{stats['skipped']}行，补齐收益{stats['earnings_inserted']}条，"
+          f"重算收益{stats['recomputed']}条，无效{stats['fail']}行，耗时{stats['seconds']}s")
+    return stats
+
+
+def find_trend_gaps(cur, fund_codes, end_date):
+    """
+    检测持有基金从最早添加日（最多往前HISTORY_BACKFILL_DAYS天）到end_date之间缺失行情的工作日，
+    已尝试TREND_GAP_MAX_ATTEMPTS次仍补不到的日期（工作日休市等）不再算作缺口
+    :return: {基金代码: [缺失日期列表]}，无缺失的基金不在结果中
+    """
+    placeholders = ','.join('?' * len(fund_codes))
+    cur.execute(f'''
+                SELECT fund_code, MIN(substr(add_time, 1, 10)) AS start_date
+                FROM user_fund_relation
+                WHERE fund_code IN ({placeholders})
+                GROUP BY fund_code
+                ''', fund_codes)
+    end_day = datetime.strptime(end_date, "%Y-%m-%d").date()
+    earliest = (end_day - timedelta(days=HISTORY_BACKFILL_DAYS)).strftime("%Y-%m-%d")
+    start_map = {row['fund_code']: max(row['start_date'], earliest) for row in cur.fetchall()}
+    if not start_map:
+        return {}
+    cur.execute(f'''
+                SELECT fund_code, record_date
+                FROM fund_daily_trend
+                WHERE fund_code IN ({placeholders})
+                  AND record_date >= ?
+                  AND record_date <= ?
+                UNION ALL
+                SELECT fund_code, record_date
+                FROM trend_gap_attempts
+                WHERE fund_code IN ({placeholders})
+                  AND attempts >= ?
+                ''', fund_codes + [min(start_map.values()), end_date] + fund_codes + [TREND_GAP_MAX_ATTEMPTS])
+    existing = {(row['fund_code'], row['record_date']) for row in cur.fetchall()}
+    gaps = {}
+    for fund_code, start in start_map.items():
+        day = datetime.strptime(start, "%Y-%m-%d").date()
+        while day <= end_day:
+            record_date = day.strftime("%Y-%m-%d")
+            if day.weekday() < 5 and (fund_code, record_date) not in existing:
+                gaps.setdefault(fund_code, []).append(record_date)
+            day += timedelta(days=1)
+    return gaps
+
+
+def fill_trend_gaps(source=None):
+    """
+    补齐所有持有基金截至昨日的行情缺口（定时任务漏跑、容器重启等），缺口范围相同的基金合并一次回填，
+    只插入缺失日期（已有行情不改写）；回填后仍缺失的日期记一次尝试，达到TREND_GAP_MAX_ATTEMPTS次后不再重试
+    :return: 回填统计汇总，未配置数据源返回None
+    """
+    source = source or create_history_source()
+    if source is None:
+        print("ℹ️ 行情缺口补齐：未配置历史净值数据源（HISTORY_SOURCE），跳过")
+        return None
+    yesterday = (date.today() - timedelta(days=1)).strftime("%Y-%m-%d")
+    with app.app_context():
+        cur = get_db(readonly=True).cursor()
+        cur.execute('SELECT DISTINCT fund_code FROM user_fund_relation')
+        fund_codes = [row['fund_code'] for row in cur.fetchall()]
+        gaps = find_trend_gaps(cur, fund_codes, yesterday) if fund_codes else {}
+    ranges = {}
+    for fund_code, dates in gaps.items():
+        ranges.setdefault((dates[0], dates[-1]), []).append(fund_code)
+    total = {'gap_funds': len(gaps), 'gap_days': sum(len(dates) for dates in gaps.values()),
+             'rows_written': 0, 'fail': 0}
+    for (start_date, end_date), codes in ranges.items():
+        stats = backfill_history(source, codes, start_date, end_date, overwrite=False,
+                                 only_dates={fund_code: set(gaps[fund_code]) for fund_code in codes})
+        total['rows_written'] += stats['rows_written']
+        total['fail'] += stats['fail']
+    if gaps:
+        record_gap_attempts(gaps)
+    print(f"✅ 行情缺口补齐完成：{total['gap_funds']}只基金缺{total['gap_days']}个工作日")
+    return total
+
+
+def record_gap_attempts(gaps):
+    """回填后仍没有行情的缺口日期尝试次数+1（补到的日期不记录）"""
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    with app.app_context():
+        db = get_db(readonly=False)
+        cur = db.cursor()
+        rows = []
+        for fund_code, dates in gaps.items():
+            cur.execute('''
+                        SELECT record_date
+                        FROM fund_daily_trend
+                        WHERE fund_code = ?
+                          AND record_date >= ?
+                          AND record_date <= ?
+                        ''', (fund_code, dates[0], dates[-1]))
+            filled = {row['record_date'] for row in cur.fetchall()}
+            rows.extend((fund_code, record_date, now) for record_date in dates if record_date not in filled)
+        cur.executemany('''
+                        INSERT INTO trend_gap_attempts (fund_code, record_date, attempts, last_attempt)
+                        VALUES (?, ?, 1, ?)
+                        ON CONFLICT(fund_code, record_date) DO UPDATE SET attempts=attempts + 1,
+                                                                          last_attempt=excluded.last_attempt
+                        ''', rows)
+        db.commit()
+
+
+def start_fund_history_backfill(fund_code):
+    """新增基金后台回填近HISTORY_BACKFILL_DAYS天历史行情（不阻塞添加接口），未配置数据源则跳过"""
+    source = create_history_source()
+    if source is None:
+        return None
+    start_date = (date.today() - timedelta(days=HISTORY_BACKFILL_DAYS)).strftime("%Y-%m-%d")
+    end_date = (date.today() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    def run_backfill():
+        try:
+            backfill_history(source, [fund_code], start_date, end_date, overwrite=False)
+        except Exception as e:
+            print(f"❌ 历史净值回填失败：{fund_code} - {str(e)}")
+
+    t = threading.Thread(target=run_backfill, daemon=True)
+    t.start()
+    return t
+
+
+# ---------------------- 数据访问层（按用户集合查询，查询次数与基金数量无关） ----------------------
+def load_user_relations(user_id):
+    """获取用户所有基金关系（按添加时间倒序）"""
+    cur = get_db().cursor()
+    cur.execute('''
+                SELECT *
+                FROM user_fund_relation
+                WHERE user_id = ?
+                ORDER BY add_time DESC
+                ''', (user_id,))
+    return cur.fetchall()
+
+
+def load_fund_summaries(user_id):
+    """
+    一次查询用户所有基金的收益汇总行（累计收益、最近两个交易日涨幅/收益），derived模式由收益序列生成
+    :return: {基金代码: user_fund_summary行}，无收益记录的基金不在结果中
+    """
+    if EARNINGS_STORAGE == 'derived':
+        memos = load_derived_earnings(user_id, load_user_relations(user_id))
+        return {fund_code: summary for fund_code, summary
+                in ((fund_code, derived_summary(fund_code, memo)) for fund_code, memo in memos.items()) if summary}
+    cur = get_db().cursor()
+    cur.execute('''
+                SELECT s.*
+                FROM user_fund_summary s
+                         JOIN user_fund_relation r
+                              ON r.user_id = s.user_id AND r.fund_code = s.fund_code
+                WHERE s.user_id = ?
+                ''', (user_id,))
+    return {row['fund_code']: row for row in cur.fetchall()}
+
+
+# ---------------------- 用户组合快照（列表/统计/饼图共用一次计算） ----------------------
+def build_portfolio_snapshot(user_id):
+    """
+    计算用户组合快照：一次性加载所有基金关系、收益汇总行（集合查询，与基金数量无关），
+    每只基金的今日收益/累计收益/现存本金只计算一次，供列表、统计、饼图接口共用
+    :return: {'funds': 基金列表（按添加时间倒序）, 'stat': 总统计, 'pie': 饼图数据, 'etag': 计算所用输入的ETag}
+    """
+    today = date.today().strftime("%Y-%m-%d")
+    # 先取ETag再读数据：期间有写入时快照只会比ETag新，客户端下次请求拿到200而不是过期的304
+    etag = portfolio_etag(user_id)
+    # 1. 所有基金关系、收益汇总行（历史累计收益、上一交易日涨幅/收益）：每项一次集合查询
+    relation_list = load_user_relations(user_id)
+    summary_map = load_fund_summaries(user_id)
+    # 2. 所有基金实时行情（读本地行情表）
+    quotes = load_intraday_quotes([relation['fund_code'] for relation in relation_list])
+
+    funds = []
+    total_invest = 0.0
+    total_current = 0.0
+    total_today_earn = 0.0
+    total_total_earn = 0.0
+    for relation in relation_list:
+        fund_code = relation['fund_code']
+        invest_principal = relation['invest_principal']
+        today_real = quotes.get(fund_code) or {}
+        today_gszzl = today_real.get('gszzl', 0.0)
+        summary = summary_map.get(fund_code)
+        history_earn_sum = summary_total_before(summary, today) or 0.0
+        yesterday_gszzl, yesterday_earn = summary_yesterday(summary, today)
+        # 今日收益/累计收益/现存本金（计算链与calc_*函数一致：先按投入本金估算，再按现存本金修正）
+        temp_today_earn = calc_today_earn(invest_principal, today_gszzl)
+        total_earn = round(history_earn_sum + temp_today_earn, 2)
+        current_principal = calc_current_principal(invest_principal, total_earn)
+        today_earn = calc_today_earn(current_principal, today_gszzl)
+        total_earn = round(history_earn_sum + today_earn, 2)
+        funds.append({
+            'fund_code': fund_code,
+            'fund_name': relation['fund_name'],
+            'invest_principal': invest_principal,  # 投入本金
+            'total_earn': total_earn,  # 累计收益
+            'current_principal': current_principal,  # 现存本金
+            'yesterday_gszzl': yesterday_gszzl,  # 昨日涨幅（上一交易日）
+            'yesterday_earn': yesterday_earn,  # 昨日收益（上一交易日）
+            'today_gszzl': today_gszzl,  # 今日涨幅
+            'today_earn': today_earn,  # 今日收益
+            'today_dwjz': today_real.get('dwjz', 0.0),
+            'today_gztime': today_real.get('gztime', ''),
+            'add_time': relation['add_time']
+        })
+        total_invest += invest_principal
+        total_current += current_principal
+        total_today_earn += today_earn
+        total_total_earn += total_earn
+
+    # 饼图：本金比例、今日收益比例（保留2位小数）
+    principal_pie = []
+    today_earn_pie = []
+    for fund in funds:
+        principal_pct = round((fund['invest_principal'] / total_invest) * 100, 2) if total_invest > 0 else 0.0
+        principal_pie.append({
+            'name': fund['fund_name'],
+            'value': round(fund['invest_principal'], 2),
+            'pct': principal_pct
+        })
+        earn_pct = round((fund['today_earn'] / total_today_earn) * 100, 2) if abs(total_today_earn) > 0 else 0.0
+        today_earn_pie.append({
+            'name': fund['fund_name'],
+            'value': round(fund['today_earn'], 2),
+            'pct': earn_pct
+        })
+    return {
+        'funds': funds,
+        'stat': {
+            'total_invest': round(total_invest, 2),  # 总投入本金
+            'total_current': round(total_current, 2),  # 总现存本金
+            'total_today_earn': round(total_today_earn, 2),  # 总今日收益
+            'total_total_earn': round(total_total_earn, 2)  # 总累计收益
+        },
+        'pie': {'principal_pie': principal_pie, 'today_earn_pie': today_earn_pie},
+        'etag': etag
+    }
+
+
+# 用户组合快照缓存：同一用户短时间内的多个请求共用一次计算，并发请求只计算一次
+PORTFOLIO_SNAPSHOT_CACHE = TTLCache(build_portfolio_snapshot, PORTFOLIO_SNAPSHOT_MAX_SIZE,
+                                    lambda: PORTFOLIO_SNAPSHOT_TTL)
+
+
+def get_portfolio_snapshot(user_id):
+    """
+    获取用户组合快照（优先复用缓存）
+    条件请求中（g.portfolio_etag）缓存的快照与本次ETag不一致时（其他进程写入，本进程缓存未失效）重新计算，
+    并把g.portfolio_etag改为实际返回快照的ETag，保证响应体与ETag对应
+    """
+    snapshot = PORTFOLIO_SNAPSHOT_CACHE.get(user_id)
+    if 'portfolio_etag' not in g:
+        return snapshot
+    if g.portfolio_etag and snapshot['etag'] != g.portfolio_etag:
+        PORTFOLIO_SNAPSHOT_CACHE.invalidate(user_id)
+        snapshot = PORTFOLIO_SNAPSHOT_CACHE.get(user_id)
+    g.portfolio_etag = snapshot['etag']
+    return snapshot
+
+
+def invalidate_portfolio_snapshot(user_id=None):
+    """用户基金/本金/收益数据变更后使快照失效，不传user_id则全部失效；指定用户时通知其实时推送连接"""
+    PORTFOLIO_SNAPSHOT_CACHE.invalidate(user_id)
+    if user_id is not None:
+        QUOTE_BROKER.notify_user(user_id)
+
+
+# ---------------------- 用户基金写操作（单个/批量接口共用，调用方负责提交事务） ----------------------
+def insert_user_funds(cur, user_id, funds):
+    """
+    添加基金到用户关系表+本金时间线，同时首次落库当日行情+收益（已存在的当日行情/收益不覆盖，
+    derived模式不写收益明细）
+    :param funds: [(基金代码, 投入本金, 实时行情)]
+    """
+    if not funds:
+        return
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    today = date.today().strftime("%Y-%m-%d")
+    # 1. 用户-基金关系表
+    cur.executemany('''
+                    INSERT INTO user_fund_relation (user_id, fund_code, fund_name, invest_principal, add_time)
+                    VALUES (?, ?, ?, ?, ?)
+                    ''', [(user_id, fund_code, fund_data['name'], invest_principal, now)
+                          for fund_code, invest_principal, fund_data in funds])
+    # 2. 当日行情（fund_daily_trend）
+    cur.executemany('''
+                    INSERT INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime, create_time)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(fund_code, record_date) DO NOTHING
+                    ''', [(fund_code, today, fund_data['jzrq'], fund_data['dwjz'], fund_data['gsz'],
+                          fund_data['gszzl'], fund_data['gztime'], now)
+                         for fund_code, invest_principal, fund_data in funds])
+    save_intraday_quotes(cur, {fund_code: fund_data for fund_code, invest_principal, fund_data in funds})
+    cur.executemany('''
+                    INSERT OR REPLACE INTO user_principal_history (user_id, fund_code, effective_date,
+                                                                   invest_principal)
+                    VALUES (?, ?, ?, ?)
+                    ''', [(user_id, fund_code, today, invest_principal) for fund_code, invest_principal, _ in funds])
+    if EARNINGS_STORAGE == 'derived':
+        for fund_code, _, _ in funds:
+            FUND_SERIES_CACHE.invalidate(fund_code)
+        return
+    # 3. 当日收益（user_fund_earnings），累计收益按收益汇总行续算
+    cur.execute('SELECT * FROM user_fund_summary WHERE user_id = ?', (user_id,))
+    summary_map = {row['fund_code']: row for row in cur.fetchall()}
+    earnings_rows = []
+    for fund_code, invest_principal, fund_data in funds:
+        day_earn, total_earn = calc_record_earn(invest_principal, fund_data['gszzl'],
+                                                summary_total_before(summary_map.get(fund_code), today))
+        earnings_rows.append((user_id, fund_code, today, invest_principal, fund_data['gszzl'], day_earn,
+                              total_earn, now))
+    cur.executemany('''
+                    INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal, day_gszzl,
+                                                    day_earn, total_earn, create_time)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, fund_code, record_date) DO NOTHING
+                    ''', earnings_rows)
+
+
+def delete_user_funds(cur, user_id, fund_codes):
+    """删除用户基金关系+收益数据（含归档）+本金时间线+收益汇总+周/月汇总，并标记组合每日汇总重建（行情表共享，不删除）"""
+    params = [(user_id, fund_code) for fund_code in fund_codes]
+    cur.executemany('DELETE FROM user_fund_relation WHERE user_id=? AND fund_code=?', params)
+    cur.executemany('DELETE FROM user_fund_earnings WHERE user_id=? AND fund_code=?', params)
+    cur.executemany('DELETE FROM user_fund_earnings_archive WHERE user_id=? AND fund_code=?', params)
+    cur.executemany('DELETE FROM user_principal_history WHERE user_id=? AND fund_code=?', params)
+    cur.executemany('DELETE FROM user_fund_summary WHERE user_id=? AND fund_code=?', params)
+    cur.executemany('DELETE FROM user_fund_earnings_rollup WHERE user_id=? AND fund_code=?', params)
+    cur.executemany('DELETE FROM earnings_rollup_dirty WHERE user_id=? AND fund_code=?', params)
+    # 归档月份的收益没有逐条删除触发器，组合每日汇总整体重建
+    cur.execute('''
+                INSERT INTO portfolio_daily_dirty (user_id, from_date)
+                VALUES (?, '')
+                ON CONFLICT(user_id) DO UPDATE SET from_date = ''
+                ''', (user_id,))
+
+
+def load_owned_fund_codes(user_id, fund_codes):
+    """一次查询fund_codes中属于用户的基金代码集合"""
+    if not fund_codes:
+        return set()
+    cur = get_db().cursor()
+    cur.execute(f'''
+                SELECT fund_code
+                FROM user_fund_relation
+                WHERE user_id = ?
+                  AND fund_code IN ({','.join('?' * len(fund_codes))})
+                ''', [user_id] + list(fund_codes))
+    return {row['fund_code'] for row in cur.fetchall()}
+
+
+def batch_item_result(fund_code, code, msg, data=None):
+    """批量接口单项结果"""
+    return {'fund_code': fund_code, 'code': code, 'msg': msg, 'data': data}
+
+
+def batch_results_in_order(fund_items, results):
+    """按请求中的基金顺序返回单项结果（重复的基金代码只返回一次）"""
+    fund_codes = dict.fromkeys(str(item.get('fundcode', '')).strip() for item in fund_items)
+    return [results[fund_code] for fund_code in fund_codes if fund_code in results]
+
+
+# ---------------------- 实时推送（SSE：行情变化时推送持有该基金用户的收益变化） ----------------------
+class StreamSubscriber:
+    """一个推送连接：记录用户及其持有基金，收到通知后由连接线程重新计算组合快照"""
+
+    def __init__(self, user_id, fund_codes):
+        self.user_id = user_id
+        self.fund_codes = set(fund_codes)
+        self.reload = False  # 用户基金变更（增删/改本金），需重新读取持有基金
+        self.event = threading.Event()
+
+    def notify(self, reload=False):
+        self.reload = self.reload or reload
+        self.event.set()
+
+    def wait(self, timeout):
+        """等待通知，超时返回False"""
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
+
+
+class QuoteBroker:
+    """
+    行情变化广播：每个进程一个观察线程轮询本地行情表（后台刷新只在一个进程执行，其他进程也能感知），
+    一次行情刷新只查一次变化，只通知持有变化基金的连接
+    """
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.last_quotes = {}  # 基金代码 -> (估值时间, 涨幅, 净值)
+        self.last_update_ts = 0.0
+
+    def subscribe(self, user_id, fund_codes):
+        """新增推送连接，超过STREAM_MAX_CLIENTS返回None"""
+        with self.lock:
+            if len(self.subscribers) >= STREAM_MAX_CLIENTS:
+                return None
+            subscriber = StreamSubscriber(user_id, fund_codes)
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def notify(self):
+        """本进程行情已刷新，立即检查变化"""
+        self.wakeup.set()
+
+    def notify_user(self, user_id):
+        """用户基金数据变更，通知该用户的所有连接"""
+        with self.lock:
+            subscribers = [subscriber for subscriber in self.subscribers if subscriber.user_id == user_id]
+        for subscriber in subscribers:
+            subscriber.notify(reload=True)
+
+    def check_changes(self):
+        """读取上次检查后刷新过的行情，返回估值时间/涨幅/净值有变化的基金代码"""
+        with app.app_context():
+            cur = get_db(readonly=True).cursor()
+            cur.execute('''
+                        SELECT fund_code, gztime, gszzl, dwjz, update_ts
+                        FROM fund_intraday_quote
+                        WHERE update_ts > ?
+                        ''', (self.last_update_ts,))
+            changed = []
+            for row in cur.fetchall():
+                self.last_update_ts = max(self.last_update_ts, row['update_ts'])
+                quote_key = (row['gztime'], row['gszzl'], row['dwjz'])
+                if self.last_quotes.get(row['fund_code']) != quote_key:
+                    self.last_quotes[row['fund_code']] = quote_key
+                    changed.append(row['fund_code'])
+            return changed
+
+    def publish(self, fund_codes):
+        """通知持有变化基金的连接，并使这些用户的组合快照失效"""
+        changed = set(fund_codes)
+        with self.lock:
+            subscribers = [subscriber for subscriber in self.subscribers if subscriber.fund_codes & changed]
+        for user_id in {subscriber.user_id for subscriber in subscribers}:
+            PORTFOLIO_SNAPSHOT_CACHE.invalidate(user_id)
+        for subscriber in subscribers:
+            subscriber.notify()
+        return len(subscribers)
+
+    def run(self):
+        try:
+            self.check_changes()  # 记录当前行情作为基线
+        except Exception as e:
+            print(f"❌ 实时推送行情基线读取失败：{str(e)}")
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            if not self.subscribers:
+                continue
+            try:
+                changed = self.check_changes()
+                if changed:
+                    self.publish(changed)
+            except Exception as e:
+                print(f"❌ 实时推送检查行情失败：{str(e)}")
+
+
+QUOTE_BROKER = QuoteBroker(STREAM_POLL_INTERVAL)
+
+
+def format_sse(event, data):
+    """SSE消息格式"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def generate_portfolio_stream(subscriber):
+    """
+    推送连接内容：以连接建立时的组合快照为基线，收到行情/基金变更通知后重新计算快照，
+    推送有变化的基金（涨幅/今日收益/累计收益等）、已删除的基金及最新总统计/饼图；空闲时发送心跳
+    """
+    deadline = time.time() + STREAM_MAX_SECONDS
+    last_funds = None
+    try:
+        yield f"retry: {STREAM_HEARTBEAT * 1000}\n\n"
+        while time.time() < deadline:
+            if last_funds is not None and not subscriber.wait(min(STREAM_HEARTBEAT, deadline - time.time())):
+                yield ': ping\n\n'
+                continue
+            with app.app_context():
+                snapshot = get_portfolio_snapshot(subscriber.user_id)
+            funds = {fund['fund_code']: fund for fund in snapshot['funds']}
+            if subscriber.reload or last_funds is None:
+                subscriber.fund_codes = set(funds)
+                subscriber.reload = False
+            if last_funds is not None:
+                changed = [fund for fund_code, fund in funds.items() if last_funds.get(fund_code) != fund]
+                removed = [fund_code for fund_code in last_funds if fund_code not in funds]
+                if changed or removed:
+                    yield format_sse('update', {'funds': changed, 'removed': removed,
+                                                'stat': snapshot['stat'], 'pie': snapshot['pie']})
+            last_funds = funds
+    finally:
+        QUOTE_BROKER.unsubscribe(subscriber)
+
+
+# ---------------------- 条件请求（ETag/304）与压缩 ----------------------
+COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+PRECOMPRESSED_SUFFIX = {'br': '.br', 'gzip': '.gz'}
+
+
+def portfolio_etag(user_id, fund_code=None):
+    """
+    按组合快照的输入生成ETag：基金关系、收益汇总、本地行情（估值时间/涨幅/净值）及当前日期，
+    输入不变则快照结果不变；行情表缺失或过期（接口会实时拉取）时返回None，不做条件请求
+    derived模式没有收益汇总，改用计算所用的基金行情序列摘要和本金时间线
+    :param fund_code: 只取单只基金（趋势图），另含添加日之前的历史净值摘要（回填后趋势图nav_list变化）
+    """
+    cur = get_db().cursor()
+    fund_condition = ' AND r.fund_code = ?' if fund_code else ''
+    cur.execute(f'''
+                SELECT r.fund_code, r.fund_name, r.invest_principal, r.add_time,
+                       s.last_record_date, s.total_earn, s.update_time,
+                       q.gztime, q.gszzl, q.dwjz, q.update_ts
+                FROM user_fund_relation r
+                         LEFT JOIN user_fund_summary s ON s.user_id = r.user_id AND s.fund_code = r.fund_code
+                         LEFT JOIN fund_intraday_quote q ON q.fund_code = r.fund_code
+                WHERE r.user_id = ?{fund_condition}
+                ORDER BY r.fund_code
+                ''', [user_id, fund_code] if fund_code else [user_id])
+    rows = cur.fetchall()
+    max_age = get_quote_refresh_interval() * 3
+    now_ts = time.time()
+    if any(row['update_ts'] is None or now_ts - row['update_ts'] > max_age for row in rows):
+        return None
+    digest = hashlib.sha1(date.today().isoformat().encode())
+    for row in rows:
+        digest.update(repr(tuple(row)[:-1]).encode())
+    if fund_code and rows:
+        cur.execute('''
+                    SELECT COUNT(*), MIN(record_date), SUM(gsz), SUM(gszzl)
+                    FROM fund_daily_trend
+                    WHERE fund_code = ?
+                      AND record_date < ?
+                    ''', (fund_code, rows[0]['add_time'][:10]))
+        digest.update(repr(tuple(cur.fetchone())).encode())
+    if EARNINGS_STORAGE == 'derived':
+        # 与接口读取同一份序列缓存：其他进程写入的行情在缓存过期（DERIVED_CACHE_TTL）后数据和ETag一起更新
+        timelines = load_principal_timelines(cur, user_id, [row['fund_code'] for row in rows])
+        for row in rows:
+            digest.update(FUND_SERIES_CACHE.get(row['fund_code'])['digest'].encode())
+            digest.update(repr(timelines.get(row['fund_code'], ())).encode())
+    return digest.hexdigest()[:32]
+
+
+def portfolio_conditional(f):
+    """
+    组合数据接口的条件请求：ETag未变化返回304，否则正常返回并附带ETag（只对成功结果设置）
+    响应体来自组合快照缓存时，附带的是该快照计算时的ETag（见get_portfolio_snapshot）
+    """
+
+    def wrapper(*args, **kwargs):
+        fund_code = kwargs.get('fund_code')
+        etag = portfolio_etag(session['user_id'], fund_code)
+        if etag and request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            if fund_code is None:
+                g.portfolio_etag = etag
+            response = app.make_response(f(*args, **kwargs))
+            if fund_code is None:
+                etag = g.pop('portfolio_etag', etag)
+            if etag and response.status_code == 200 and (response.get_json(silent=True) or {}).get('code') == 200:
+                response.set_etag(etag, weak=True)  # 弱ETag：压缩前后内容等价
+        if etag:
+            response.headers['Cache-Control'] = 'private, no-cache'  # 浏览器缓存但每次校验
+        return response
+
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+
+def choose_encoding():
+    """按请求Accept-Encoding选择压缩方式：br（已安装brotli）> gzip，不支持返回None"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_bytes(data, encoding, level=COMPRESS_LEVEL):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=min(level, 9))
+
+
+def ensure_precompressed(filename, encoding):
+    """
+    生成/更新静态文件的预压缩版本（源文件更新后自动重建），返回预压缩文件名；目录不可写时返回None
+    """
+    source = os.path.join(STATIC_FOLDER, filename)
+    target_name = filename + PRECOMPRESSED_SUFFIX[encoding]
+    target = os.path.join(STATIC_FOLDER, target_name)
+    try:
+        if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source):
+            with open(source, 'rb') as f:
+                data = compress_bytes(f.read(), encoding, level=11)
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        return target_name
+    except OSError as e:
+        print(f"⚠️ 静态文件预压缩失败：{filename} - {str(e)}")
+        return None
+
+
+def send_static_precompressed(filename):
+    """返回静态文件：客户端支持压缩时返回预压缩版本，支持ETag/Last-Modified条件请求"""
+    encoding = choose_encoding()
+    compressed_name = ensure_precompressed(filename, encoding) if encoding else None
+    if compressed_name:
+        response = send_from_directory(STATIC_FOLDER, compressed_name, mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(STATIC_FOLDER, filename)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """压缩JSON/文本响应（文件、流式响应、已压缩响应不处理）"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if not encoding or (response.content_length or 0) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress_bytes(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# ---------------------- 前端页面路由 ----------------------
+@app.route('/')
+def serve_frontend():
+    """根路径返回前端页面（预压缩），每次校验ETag，页面更新后立即生效"""
+    response = send_static_precompressed('index.html')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# ---------------------- 用户接口（登录/登出/当前用户） ----------------------
+@app.route('/api/login', methods=['POST'])
+def login():
+    """用户登录，验证后设置Session"""
+    try:
+        data = request.get_json()
+        username = data.get('username', '').strip()
+        password = data.get('password', '').strip()
+        if not username or not password:
+            return jsonify({'code': 400, 'msg': '账号/密码不能为空', 'data': None})
+        # 验证用户
+        db = get_db()
+        cur = db.cursor()
+        cur.execute('SELECT id, username, password FROM users WHERE username=?', (username,))
+        user = cur.fetchone()
+        if not user or not check_password_hash(user['password'], password):
+            return jsonify({'code': 403, 'msg': '账号/密码错误', 'data': None})
+        # 设置Session
+        session['user_id'] = user['id']
+        session['username'] = user['username']
+        return jsonify({
+            'code': 200, 'msg': '登录成功',
+            'data': {'user_id': user['id'], 'username': user['username']}
+        })
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'登录失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/logout', methods=['GET'])
 def logout():
     """登出，清除Session"""
     session.clear()
@@ -555,8 +4362,9 @@ def fund_add():
             return jsonify({'code': 400, 'msg': '基金代码不能为空，本金必须大于0', 'data': None})
         # 验证基金存在
         fund_data = fetch_fund_real(fund_code)
-        if not fund_data:
-            return jsonify({'code': 404, 'msg': '基金不存在，无法添加', 'data': None})
+        unusable = quote_unusable_for_add(fund_code, fund_data)
+        if unusable:
+            return jsonify({'code': unusable[0], 'msg': unusable[1], 'data': None})
         # 校验是否已添加
         db = get_db()
         cur = db.cursor()
@@ -568,37 +4376,12 @@ def fund_add():
                     ''', (session['user_id'], fund_code))
         if cur.fetchone():
             return jsonify({'code': 409, 'msg': '已添加该基金，无需重复添加', 'data': None})
-        # 1. 添加到用户-基金关系表
-        now = time.strftime("%Y-%m-%d %H:%M:%S")
-        cur.execute('''
-                    INSERT INTO user_fund_relation (user_id, fund_code, fund_name, invest_principal, add_time)
-                    VALUES (?, ?, ?, ?, ?)
-                    ''', (session['user_id'], fund_code, fund_data['name'], invest_principal, now))
-        # 2. 首次落库当日行情（fund_daily_trend）
-        today = date.today().strftime("%Y-%m-%d")
-        cur.execute('SELECT * FROM fund_daily_trend WHERE fund_code=? AND record_date=?', (fund_code, today))
-        if not cur.fetchone():
-            cur.execute('''
-                        INSERT INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime, create_time)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            fund_code, today, fund_data['jzrq'], fund_data['dwjz'],
-                            fund_data['gsz'], fund_data['gszzl'], fund_data['gztime'], now
-                        ))
-        # 3. 首次落库当日收益（user_fund_earnings）
-        day_earn, total_earn = calculate_day_earn(session['user_id'], fund_code, today, fund_data['gszzl'])
-        cur.execute('SELECT * FROM user_fund_earnings WHERE user_id=? AND fund_code=? AND record_date=?',
-                    (session['user_id'], fund_code, today))
-        if not cur.fetchone():
-            cur.execute('''
-                        INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal, day_gszzl,
-                                                        day_earn, total_earn, create_time)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            session['user_id'], fund_code, today, invest_principal,
-                            fund_data['gszzl'], day_earn, total_earn, now
-                        ))
+        # 1~3. 添加到用户-基金关系表，首次落库当日行情+收益
+        insert_user_funds(cur, session['user_id'], [(fund_code, invest_principal, fund_data)])
         db.commit()
+        invalidate_portfolio_snapshot(session['user_id'])
+        # 4. 后台回填历史行情（配置了HISTORY_SOURCE时）
+        start_fund_history_backfill(fund_code)
         return jsonify({
             'code': 200, 'msg': '基金添加成功',
             'data': {'fund_code': fund_code, 'fund_name': fund_data['name'], 'invest_principal': invest_principal}
@@ -607,79 +4390,159 @@ def fund_add():
         return jsonify({'code': 500, 'msg': f'添加失败：{str(e)}', 'data': None})
 
 
+@app.route('/api/fund/batch', methods=['POST'])
+@login_required
+def fund_batch_add():
+    """
+    批量新增基金：并发校验基金存在，所有基金一个事务落库，返回每只基金的结果
+    参数：funds=[{fundcode, invest_principal}]
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = session['user_id']
+        results = {}
+        items = {}
+        fund_items = data.get('funds') or []
+        for item in fund_items:
+            fund_code = str(item.get('fundcode', '')).strip()
+            try:
+                invest_principal = round(float(item.get('invest_principal', 0.0)), 2)
+            except (TypeError, ValueError):
+                invest_principal = 0.0
+            if not fund_code or invest_principal <= 0:
+                results[fund_code] = batch_item_result(fund_code, 400, '基金代码不能为空，本金必须大于0')
+            elif fund_code in items or fund_code in results:
+                results[fund_code] = batch_item_result(fund_code, 400, '基金代码重复')
+                items.pop(fund_code, None)
+            else:
+                items[fund_code] = invest_principal
+        if not items and not results:
+            return jsonify({'code': 400, 'msg': '请提供要添加的基金', 'data': None})
+        # 已添加的基金不再校验
+        for fund_code in load_owned_fund_codes(user_id, items):
+            results[fund_code] = batch_item_result(fund_code, 409, '已添加该基金，无需重复添加')
+            del items[fund_code]
+        # 并发校验基金存在：不设总时限（单只基金受QUOTE_FETCH_TIMEOUT限制），避免慢接口被误判为基金不存在
+        quotes = fetch_funds_real(list(items), deadline=None)
+        funds = []
+        for fund_code, invest_principal in items.items():
+            fund_data = quotes.get(fund_code)
+            unusable = quote_unusable_for_add(fund_code, fund_data)
+            if unusable:
+                results[fund_code] = batch_item_result(fund_code, *unusable)
+                continue
+            funds.append((fund_code, invest_principal, fund_data))
+            results[fund_code] = batch_item_result(fund_code, 200, '基金添加成功', {
+                'fund_code': fund_code, 'fund_name': fund_data['name'], 'invest_principal': invest_principal})
+        if funds:
+            db = get_db()
+            insert_user_funds(db.cursor(), user_id, funds)
+            db.commit()
+            invalidate_portfolio_snapshot(user_id)
+            for fund_code, invest_principal, fund_data in funds:
+                start_fund_history_backfill(fund_code)
+        return jsonify({'code': 200, 'msg': f'批量添加完成：成功{len(funds)}只，失败{len(results) - len(funds)}只',
+                        'data': batch_results_in_order(fund_items, results)})
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'批量添加失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/fund/batch', methods=['DELETE'])
+@login_required
+def fund_batch_delete():
+    """批量删除基金：一次校验归属，一个事务删除，返回每只基金的结果；参数：fund_codes=[基金代码]"""
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = session['user_id']
+        fund_codes = list(dict.fromkeys(str(code).strip() for code in data.get('fund_codes') or []))
+        if not fund_codes:
+            return jsonify({'code': 400, 'msg': '请提供要删除的基金', 'data': None})
+        owned = load_owned_fund_codes(user_id, fund_codes)
+        if owned:
+            db = get_db()
+            delete_user_funds(db.cursor(), user_id, [code for code in fund_codes if code in owned])
+            db.commit()
+            invalidate_portfolio_snapshot(user_id)
+        results = [batch_item_result(code, 200, '删除成功', code) if code in owned
+                   else batch_item_result(code, 404, '基金不存在') for code in fund_codes]
+        return jsonify({'code': 200, 'msg': f'批量删除完成：成功{len(owned)}只，失败{len(fund_codes) - len(owned)}只',
+                        'data': results})
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'批量删除失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/fund/batch/principal', methods=['PUT'])
+@login_required
+def fund_batch_update_principal():
+    """
+    批量修改投入本金：一次校验归属，一个事务更新本金并重算收益，返回每只基金的结果
+    参数：funds=[{fundcode, invest_principal, effective_date(可选)}]
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = session['user_id']
+        results = {}
+        items = {}
+        fund_items = data.get('funds') or []
+        for item in fund_items:
+            fund_code = str(item.get('fundcode', '')).strip()
+            try:
+                new_principal = round(float(item.get('invest_principal', 0.0)), 2)
+            except (TypeError, ValueError):
+                new_principal = 0.0
+            effective_date = (item.get('effective_date') or '').strip() or None
+            try:
+                if effective_date:
+                    datetime.strptime(effective_date, "%Y-%m-%d")
+            except ValueError:
+                results[fund_code] = batch_item_result(fund_code, 400, '生效日期格式应为YYYY-MM-DD')
+                continue
+            if not fund_code or new_principal <= 0:
+                results[fund_code] = batch_item_result(fund_code, 400, '基金代码不能为空，本金必须大于0')
+            else:
+                items[fund_code] = (new_principal, effective_date)
+        if not items and not results:
+            return jsonify({'code': 400, 'msg': '请提供要修改的基金', 'data': None})
+        owned = load_owned_fund_codes(user_id, items)
+        updated = [(fund_code, new_principal, effective_date)
+                   for fund_code, (new_principal, effective_date) in items.items() if fund_code in owned]
+        for fund_code in items:
+            if fund_code not in owned:
+                results[fund_code] = batch_item_result(fund_code, 404, '基金不存在')
+        if updated:
+            db = get_db()
+            cur = db.cursor()
+            cur.executemany('''
+                            UPDATE user_fund_relation
+                            SET invest_principal=?
+                            WHERE user_id = ?
+                              AND fund_code = ?
+                            ''', [(new_principal, user_id, fund_code) for fund_code, new_principal, _ in updated])
+            for fund_code, new_principal, effective_date in updated:
+                recomputed = change_principal(cur, user_id, fund_code, new_principal, effective_date)
+                results[fund_code] = batch_item_result(fund_code, 200, '本金修改成功', {
+                    'fund_code': fund_code, 'new_invest_principal': new_principal, 'recomputed_rows': recomputed})
+            db.commit()
+            invalidate_portfolio_snapshot(user_id)
+        return jsonify({'code': 200, 'msg': f'批量修改完成：成功{len(updated)}只，失败{len(results) - len(updated)}只',
+                        'data': batch_results_in_order(fund_items, results)})
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'批量修改失败：{str(e)}', 'data': None})
+
+
 @app.route('/api/fund/list', methods=['GET'])
 @login_required
+@portfolio_conditional
 def fund_list():
     """
     获取我的基金数据列表（核心接口，严格按需求计算所有字段）
     返回字段：投入本金、累计收益、现存本金、昨日涨幅/收益、今日涨幅/收益
     """
     try:
-        db = get_db()
-        cur = db.cursor()
-        user_id = session['user_id']
-        # 获取用户所有基金关系数据
-        cur.execute('''
-                    SELECT *
-                    FROM user_fund_relation
-                    WHERE user_id = ?
-                    ORDER BY add_time DESC
-                    ''', (user_id,))
-        relation_list = cur.fetchall()
-        if not relation_list:
+        snapshot = get_portfolio_snapshot(session['user_id'])
+        if not snapshot['funds']:
             return jsonify({'code': 200, 'msg': '暂无基金数据', 'data': []})
-
-        fund_list = []
-        yesterday = (date.today() - timedelta(days=1)).strftime("%Y-%m-%d")
-        for relation in relation_list:
-            fund_code = relation['fund_code']
-            invest_principal = relation['invest_principal']
-            fund_name = relation['fund_name']
-            add_time = relation['add_time']
-            # 1. 拉取今日实时行情数据
-            today_real = fetch_fund_real(fund_code) or {}
-            today_gszzl = today_real.get('gszzl', 0.0)
-            today_dwjz = today_real.get('dwjz', 0.0)
-            today_gztime = today_real.get('gztime', '')
-            # 2. 计算今日实时收益（需求5）
-            # 先临时计算今日收益（无累计收益时，今日收益=投入本金×今日涨幅）
-            temp_today_earn = calc_today_earn(invest_principal, today_gszzl)
-            # 3. 计算累计收益（需求3）= 历史收益之和 + 今日实时收益
-            history_earn_sum = calc_history_earn_sum(user_id, fund_code)
-            total_earn = calc_total_earn(user_id, fund_code, temp_today_earn)
-            # 4. 计算现存本金（需求4）= 投入本金 + 累计收益
-            current_principal = calc_current_principal(invest_principal, total_earn)
-            # 5. 重新计算今日收益（用最终的现存本金，需求5）
-            today_earn = calc_today_earn(current_principal, today_gszzl)
-            # 6. 重新计算累计收益（确保精准）
-            total_earn = calc_total_earn(user_id, fund_code, today_earn)
-            # 7. 获取昨日涨幅/收益（从历史收益表取）
-            cur.execute('''
-                        SELECT day_gszzl, day_earn
-                        FROM user_fund_earnings
-                        WHERE user_id = ?
-                          AND fund_code = ?
-                          AND record_date = ?
-                        ''', (user_id, fund_code, yesterday))
-            yesterday_data = cur.fetchone() or {}
-            yesterday_gszzl = yesterday_data.get('day_gszzl', 0.0)
-            yesterday_earn = yesterday_data.get('day_earn', 0.0)
-            # 组装数据
-            fund_list.append({
-                'fund_code': fund_code,
-                'fund_name': fund_name,
-                'invest_principal': invest_principal,  # 投入本金
-                'total_earn': total_earn,  # 累计收益
-                'current_principal': current_principal,  # 现存本金
-                'yesterday_gszzl': yesterday_gszzl,  # 昨日涨幅
-                'yesterday_earn': yesterday_earn,  # 昨日收益
-                'today_gszzl': today_gszzl,  # 今日涨幅
-                'today_earn': today_earn,  # 今日收益
-                'today_dwjz': today_dwjz,
-                'today_gztime': today_gztime,
-                'add_time': add_time
-            })
-        return jsonify({'code': 200, 'msg': '获取成功', 'data': fund_list})
+        return jsonify({'code': 200, 'msg': '获取成功', 'data': snapshot['funds']})
     except Exception as e:
         return jsonify({'code': 500, 'msg': f'获取失败：{str(e)}', 'data': []})
 
@@ -702,9 +4565,9 @@ def fund_delete(fund_code):
         if not cur.fetchone():
             return jsonify({'code': 404, 'msg': '基金不存在', 'data': None})
         # 删除关系表+收益表数据（行情表共享，不删除）
-        cur.execute('DELETE FROM user_fund_relation WHERE user_id=? AND fund_code=?', (user_id, fund_code))
-        cur.execute('DELETE FROM user_fund_earnings WHERE user_id=? AND fund_code=?', (user_id, fund_code))
+        delete_user_funds(cur, user_id, [fund_code])
         db.commit()
+        invalidate_portfolio_snapshot(user_id)
         return jsonify({'code': 200, 'msg': '删除成功', 'data': fund_code})
     except Exception as e:
         return jsonify({'code': 500, 'msg': f'删除失败：{str(e)}', 'data': None})
@@ -713,12 +4576,18 @@ def fund_delete(fund_code):
 @app.route('/api/fund/<fund_code>/principal', methods=['PUT'])
 @login_required
 def fund_update_principal(fund_code):
-    """修改基金投入本金"""
+    """修改基金投入本金，并按新本金重算已落库的收益（可选effective_date：从该日起生效，默认全部历史）"""
     try:
         data = request.get_json()
         new_principal = round(float(data.get('invest_principal', 0.0)), 2)
         if new_principal <= 0:
             return jsonify({'code': 400, 'msg': '本金必须大于0', 'data': None})
+        effective_date = (data.get('effective_date') or '').strip() or None
+        if effective_date:
+            try:
+                datetime.strptime(effective_date, "%Y-%m-%d")
+            except ValueError:
+                return jsonify({'code': 400, 'msg': '生效日期格式应为YYYY-MM-DD', 'data': None})
         db = get_db()
         cur = db.cursor()
         user_id = session['user_id']
@@ -738,10 +4607,13 @@ def fund_update_principal(fund_code):
                     WHERE user_id = ?
                       AND fund_code = ?
                     ''', (new_principal, user_id, fund_code))
+        # 写入本金时间线，按新本金重算收益明细+汇总（同一事务）
+        recomputed = change_principal(cur, user_id, fund_code, new_principal, effective_date)
         db.commit()
+        invalidate_portfolio_snapshot(user_id)
         return jsonify({
             'code': 200, 'msg': '本金修改成功',
-            'data': {'fund_code': fund_code, 'new_invest_principal': new_principal}
+            'data': {'fund_code': fund_code, 'new_invest_principal': new_principal, 'recomputed_rows': recomputed}
         })
     except Exception as e:
         return jsonify({'code': 500, 'msg': f'修改失败：{str(e)}', 'data': None})
@@ -749,6 +4621,7 @@ def fund_update_principal(fund_code):
 
 @app.route('/api/fund/chart/pie', methods=['GET'])
 @login_required
+@portfolio_conditional
 def fund_chart_pie():
     """
     新增：获取饼图数据（需求1）
@@ -761,15 +4634,10 @@ def fund_chart_pie():
         2. 今日收益比例饼图：各基金今日收益/总今日收益
         """
     try:
-        db = get_db()
-        cur = db.cursor()
-        user_id = session['user_id']
-        # 获取基金关系数据
-        cur.execute('SELECT * FROM user_fund_relation WHERE user_id=?', (user_id,))
-        relation_list = cur.fetchall()
+        snapshot = get_portfolio_snapshot(session['user_id'])
 
         # ---------- 新增：空数据兜底 ----------
-        if not relation_list:
+        if not snapshot['funds']:
             return jsonify({
                 'code': 200, 'msg': '暂无饼图数据',
                 'data': {
@@ -780,72 +4648,25 @@ def fund_chart_pie():
             })
         # ---------- 空数据兜底结束 ----------
 
-        # 初始化数据
-        principal_pie = []  # 本金比例饼图
-        today_earn_pie = []  # 今日收益比例饼图
-        total_invest = 0.0  # 总投入本金
-        total_today_earn = 0.0  # 总今日收益
-
-        # 关键修复：将sqlite3.Row对象转换为可修改的字典，并存储今日收益
-        relation_dict_list = []
-        # 先计算总投入和总今日收益
-        for relation in relation_list:
-            # 将Row对象转为字典，支持赋值操作
-            relation_dict = dict(relation)
-            fund_code = relation_dict['fund_code']
-            invest_principal = relation_dict['invest_principal']
-            total_invest += invest_principal
-
-            # 计算今日收益
-            today_real = fetch_fund_real(fund_code) or {}
-            today_gszzl = today_real.get('gszzl', 0.0)
-            history_earn = calc_history_earn_sum(user_id, fund_code)
-            temp_today_earn = calc_today_earn(invest_principal, today_gszzl)
-            total_earn = calc_total_earn(user_id, fund_code, temp_today_earn)
-            current_principal = calc_current_principal(invest_principal, total_earn)
-            today_earn = calc_today_earn(current_principal, today_gszzl)
-
-            # 现在可以安全赋值，因为是字典对象
-            relation_dict['today_earn'] = today_earn
-            total_today_earn += today_earn
-            relation_dict_list.append(relation_dict)
-
-        # 组装饼图数据（保留2位小数）
-        for relation in relation_dict_list:
-            fund_name = relation['fund_name']
-            invest_principal = relation['invest_principal']
-            today_earn = relation['today_earn']
-
-            # 本金比例
-            principal_pct = round((invest_principal / total_invest) * 100, 2) if total_invest > 0 else 0.0
-            principal_pie.append({
-                'name': fund_name,
-                'value': round(invest_principal, 2),
-                'pct': principal_pct
-            })
-
-            # 今日收益比例（总收益为0时比例为0）
-            earn_pct = round((today_earn / total_today_earn) * 100, 2) if abs(total_today_earn) > 0 else 0.0
-            today_earn_pie.append({
-                'name': fund_name,
-                'value': round(today_earn, 2),
-                'pct': earn_pct
-            })
-
-        return jsonify({
-            'code': 200, 'msg': '获取饼图数据成功',
-            'data': {'principal_pie': principal_pie, 'today_earn_pie': today_earn_pie}
-        })
+        return jsonify({'code': 200, 'msg': '获取饼图数据成功', 'data': snapshot['pie']})
     except Exception as e:
         return jsonify({'code': 500, 'msg': f'获取饼图数据失败：{str(e)}', 'data': None})
 
 
 @app.route('/api/fund/chart/trend/<fund_code>', methods=['GET'])
 @login_required
+@portfolio_conditional
 def fund_chart_trend(fund_code):
     """
     新增：获取基金趋势图数据（需求6）
     返回：添加后分天的日期、收益、涨幅，用于折线图
+    参数（均可选）：
+    - from/to：日期区间（YYYY-MM-DD），默认添加日至今日
+    - granularity：day/week/month，默认auto（按points选择，长区间读周/月汇总表）
+    - points：auto时的目标点数，默认TREND_MAX_POINTS
+    - limit/cursor：分页，cursor为上一页返回的next_cursor（最后一个点的日期）
+    按天查询的第一页另返回nav_list：添加日之前的历史净值走势（from之后，默认近HISTORY_BACKFILL_DAYS天），
+    新增基金回填历史净值后即可展示
     """
     try:
         db = get_db()
@@ -861,88 +4682,386 @@ def fund_chart_trend(fund_code):
         relation = cur.fetchone()
         if not relation:
             return jsonify({'code': 404, 'msg': '基金不存在', 'data': None})
-        # 获取基金添加日期
-        add_date = get_fund_add_date(user_id, fund_code)
+        # 基金添加日期
+        add_date = relation['add_time'].split(' ')[0]
         today = date.today().strftime("%Y-%m-%d")
-        # 查询添加日至今的收益数据（含涨幅、收益）
-        cur.execute('''
-                    SELECT record_date, day_gszzl, day_earn, total_earn
-                    FROM user_fund_earnings
-                    WHERE user_id = ?
-                      AND fund_code = ?
-                      AND record_date >= ?
-                      AND record_date <= ?
-                    ORDER BY record_date ASC
-                    ''', (user_id, fund_code, add_date, today))
-        trend_data = cur.fetchall()
-        if not trend_data:
-            return jsonify({'code': 200, 'msg': '暂无趋势数据（添加后未到统计时间）', 'data': []})
-        # 组装趋势图数据（适配前端折线图）
-        result = []
-        for item in trend_data:
-            result.append({
+        start_date = request.args.get('from', '').strip() or add_date
+        end_date = request.args.get('to', '').strip() or today
+        cursor = request.args.get('cursor', '').strip()
+        try:
+            for value in (start_date, end_date) + ((cursor,) if cursor else ()):
+                datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            return jsonify({'code': 400, 'msg': '日期格式应为YYYY-MM-DD', 'data': None})
+        add_day = datetime.strptime(add_date, "%Y-%m-%d").date()
+        nav_start = request.args.get('from', '').strip() or \
+            (add_day - timedelta(days=HISTORY_BACKFILL_DAYS)).strftime("%Y-%m-%d")
+        nav_end = min(end_date, (add_day - timedelta(days=1)).strftime("%Y-%m-%d"))
+        start_date = max(start_date, add_date)
+        end_date = min(end_date, today)
+        if start_date > end_date:
+            return jsonify({'code': 400, 'msg': '起始日期不能晚于结束日期', 'data': None})
+        points = min(max(request.args.get('points', TREND_MAX_POINTS, type=int), 10), TREND_PAGE_MAX)
+        limit = min(max(request.args.get('limit', TREND_PAGE_MAX, type=int), 1), TREND_PAGE_MAX)
+        granularity = request.args.get('granularity', 'auto').strip()
+        if granularity == 'auto':
+            granularity = choose_trend_granularity(start_date, end_date, points)
+        elif granularity not in ('day',) + ROLLUP_PERIODS:
+            return jsonify({'code': 400, 'msg': 'granularity应为auto/day/week/month', 'data': None})
+
+        if granularity == 'day':
+            # 查询区间内的每日收益数据（含涨幅、收益，归档月份解包合并）
+            rows = load_earnings_rows(cur, user_id, fund_code, start_date, end_date, cursor, limit + 1)
+            # 组装趋势图数据（适配前端折线图）
+            result = [{
                 'date': item['record_date'],
                 'gszzl': round(item['day_gszzl'], 2),  # 当日涨幅
                 'day_earn': round(item['day_earn'], 2),  # 当日收益
                 'total_earn': round(item['total_earn'], 2)  # 累计收益
-            })
-        # 补充今日实时数据（如果今日数据未落库）
-        last_date = result[-1]['date']
-        if last_date != today:
-            today_real = fetch_fund_real(fund_code) or {}
+            } for item in rows[:limit]]
+        elif EARNINGS_STORAGE == 'derived':
+            # 派生模式：由记忆化的收益序列内存聚合周/月
+            rows = derived_rollup_rows(load_derived_fund_earnings(user_id, fund_code), granularity, start_date,
+                                       end_date, cursor, limit + 1)
+            result = [rollup_point(row) for row in rows[:limit]]
+        else:
+            # 长区间：读周/月汇总表（明细有变化时先重建变化的周期）
+            ensure_earnings_rollups(user_id, fund_code)
+            cur.execute('''
+                        SELECT *
+                        FROM user_fund_earnings_rollup
+                        WHERE user_id = ?
+                          AND fund_code = ?
+                          AND period = ?
+                          AND period_start >= ?
+                          AND period_start <= ?
+                          AND period_start > ?
+                        ORDER BY period_start ASC
+                        LIMIT ?
+                        ''', (user_id, fund_code, granularity, period_start_of(start_date, granularity), end_date,
+                              cursor, limit + 1))
+            rows = cur.fetchall()
+            result = [rollup_point(row) for row in rows[:limit]]
+        next_cursor = result[-1]['date'] if len(rows) > limit else None
+        nav_list = []
+        if granularity == 'day' and not cursor and nav_start <= nav_end:
+            # 添加日之前的历史净值（回填行情），取区间内最近TREND_PAGE_MAX个点
+            cur.execute('''
+                        SELECT record_date, gsz, gszzl
+                        FROM fund_daily_trend
+                        WHERE fund_code = ?
+                          AND record_date >= ?
+                          AND record_date <= ?
+                        ORDER BY record_date DESC
+                        LIMIT ?
+                        ''', (fund_code, nav_start, nav_end, TREND_PAGE_MAX))
+            nav_list = [{'date': row['record_date'], 'dwjz': row['gsz'], 'gszzl': round(row['gszzl'], 2)}
+                        for row in reversed(cur.fetchall())]
+        if not result and not nav_list and not cursor:
+            return jsonify({'code': 200, 'msg': '暂无趋势数据（添加后未到统计时间）', 'data': []})
+
+        # 补充今日实时数据（区间包含今日、最后一页且今日数据未落库）
+        summary = load_fund_summary(cur, user_id, fund_code)
+        if end_date == today and next_cursor is None and (not summary or summary['last_record_date'] != today):
+            today_real = load_intraday_quotes([fund_code]).get(fund_code) or {}
             today_gszzl = round(today_real.get('gszzl', 0.0), 2)
-            # 计算今日实时收益
+            # 计算今日实时收益（今日未落库，收益汇总行即为全部历史收益）
             invest_principal = relation['invest_principal']
-            history_earn = calc_history_earn_sum(user_id, fund_code)
+            history_earn = summary_total_before(summary, today)
             temp_today_earn = calc_today_earn(invest_principal, today_gszzl)
-            total_earn = calc_total_earn(user_id, fund_code, temp_today_earn)
+            total_earn = round(history_earn + temp_today_earn, 2)
             current_principal = calc_current_principal(invest_principal, total_earn)
             today_earn = round(calc_today_earn(current_principal, today_gszzl), 2)
-            result.append({
-                'date': today,
-                'gszzl': today_gszzl,
-                'day_earn': today_earn,
-                'total_earn': round(total_earn, 2)
-            })
+            if granularity == 'day' or not result or result[-1]['date'] != period_start_of(today, granularity):
+                result.append({
+                    'date': today if granularity == 'day' else period_start_of(today, granularity),
+                    'gszzl': today_gszzl,
+                    'day_earn': today_earn,
+                    'total_earn': round(total_earn, 2)
+                })
+                if granularity != 'day':
+                    result[-1].update({'end_date': today, 'days': 1, 'open': result[-1]['total_earn'],
+                                       'high': result[-1]['total_earn'], 'low': result[-1]['total_earn']})
+            else:
+                # 今日并入所在周期
+                point = result[-1]
+                point['gszzl'] = round(((1 + point['gszzl'] / 100) * (1 + today_gszzl / 100) - 1) * 100, 2)
+                point['day_earn'] = round(point['day_earn'] + today_earn, 2)
+                point['total_earn'] = round(total_earn, 2)
+                point['high'] = max(point['high'], point['total_earn'])
+                point['low'] = min(point['low'], point['total_earn'])
+                point['end_date'] = today
+                point['days'] += 1
         return jsonify({
             'code': 200, 'msg': '获取趋势图数据成功',
-            'data': {'fund_name': relation['fund_name'], 'trend_list': result}
+            'data': {'fund_name': relation['fund_name'], 'trend_list': result, 'nav_list': nav_list,
+                     'granularity': granularity, 'next_cursor': next_cursor}
         })
     except Exception as e:
         return jsonify({'code': 500, 'msg': f'获取趋势图数据失败：{str(e)}', 'data': None})
 
 
+@app.route('/api/portfolio/trend', methods=['GET'])
+@login_required
+@portfolio_conditional
+def portfolio_trend():
+    """
+    组合趋势图：每日总投入本金、总收益、总累计收益（读用户组合每日汇总，一次主键范围读取）
+    参数（均可选）：
+    - from/to：日期区间（YYYY-MM-DD），默认全部历史至今日
+    - limit/cursor：分页，cursor为上一页返回的next_cursor（最后一个点的日期）
+    """
+    try:
+        user_id = session['user_id']
+        today = date.today().strftime("%Y-%m-%d")
+        start_date = request.args.get('from', '').strip()
+        end_date = request.args.get('to', '').strip() or today
+        cursor = request.args.get('cursor', '').strip()
+        try:
+            for value in (end_date,) + tuple(value for value in (start_date, cursor) if value):
+                datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            return jsonify({'code': 400, 'msg': '日期格式应为YYYY-MM-DD', 'data': None})
+        end_date = min(end_date, today)
+        if start_date > end_date:
+            return jsonify({'code': 400, 'msg': '起始日期不能晚于结束日期', 'data': None})
+        limit = min(max(request.args.get('limit', TREND_PAGE_MAX, type=int), 1), TREND_PAGE_MAX)
+
+        if EARNINGS_STORAGE == 'derived':
+            rows = derived_portfolio_daily(user_id, start_date, end_date, cursor, limit + 1)
+        else:
+            # 收益明细有变化（本金修改、增删基金）时先重建变化日期之后的汇总
+            ensure_portfolio_daily(user_id)
+            cur = get_db().cursor()
+            cur.execute('''
+                        SELECT record_date, invest_principal, day_earn, total_earn, funds
+                        FROM user_portfolio_daily
+                        WHERE user_id = ?
+                          AND record_date >= ?
+                          AND record_date <= ?
+                          AND record_date > ?
+                        ORDER BY record_date ASC
+                        LIMIT ?
+                        ''', (user_id, start_date, end_date, cursor, limit + 1))
+            rows = cur.fetchall()
+        result = [{
+            'date': row['record_date'],
+            'invest_principal': round(row['invest_principal'], 2),  # 投入本金之和
+            'day_earn': round(row['day_earn'], 2),  # 当日收益之和
+            'total_earn': round(row['total_earn'], 2),  # 累计收益
+            'funds': row['funds']  # 当日有收益记录的基金数
+        } for row in rows[:limit]]
+        next_cursor = result[-1]['date'] if len(rows) > limit else None
+
+        # 补充今日实时数据（区间包含今日、最后一页且今日数据未落库），与总统计接口共用组合快照
+        if end_date == today and next_cursor is None and (not result or result[-1]['date'] != today):
+            snapshot = get_portfolio_snapshot(user_id)
+            if snapshot['funds']:
+                stat = snapshot['stat']
+                result.append({
+                    'date': today,
+                    'invest_principal': stat['total_invest'],
+                    'day_earn': stat['total_today_earn'],
+                    'total_earn': stat['total_total_earn'],
+                    'funds': len(snapshot['funds'])
+                })
+        if not result and not cursor:
+            return jsonify({'code': 200, 'msg': '暂无趋势数据（添加后未到统计时间）', 'data': []})
+        return jsonify({
+            'code': 200, 'msg': '获取组合趋势数据成功',
+            'data': {'trend_list': result, 'next_cursor': next_cursor}
+        })
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'获取组合趋势数据失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/fund/stream', methods=['GET'])
+@login_required
+def fund_stream():
+    """实时推送（SSE）：行情或基金数据变化时推送 update 事件 {funds, removed, stat, pie}"""
+    user_id = session['user_id']
+    subscriber = QUOTE_BROKER.subscribe(user_id, [relation['fund_code'] for relation in load_user_relations(user_id)])
+    if subscriber is None:
+        return jsonify({'code': 503, 'msg': '实时推送连接数已满，请稍后重试', 'data': None}), 503
+    return app.response_class(generate_portfolio_stream(subscriber), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/api/fund/refresh', methods=['GET'])
 @login_required
 def fund_refresh():
     """
     刷新数据接口（需求2：替换手动记录）
-    无实际落库，仅触发全量数据重新计算，返回刷新成功
+    拉取当前用户持有基金的最新行情写入本地行情表，实时推送连接随之收到变化
     """
     try:
-        # 主动拉取一个基金数据触发接口请求，验证接口连通性（可选，核心是前端重新加载）
-        db = get_db()
-        cur = db.cursor()
-        cur.execute('SELECT fund_code FROM user_fund_relation WHERE user_id=? LIMIT 1', (session['user_id'],))
-        fund_code = cur.fetchone()
-        if fund_code:
-            fetch_fund_real(fund_code['fund_code'])  # 拉取实时数据，更新缓存
+        user_id = session['user_id']
+        db = get_db(readonly=False)
+        fund_codes = [relation['fund_code'] for relation in load_user_relations(user_id)]
+        if fund_codes:
+            save_intraday_quotes(db.cursor(), fetch_funds_real(fund_codes))
+            db.commit()
+            invalidate_portfolio_snapshot(user_id)
+            QUOTE_BROKER.notify()
         return jsonify({'code': 200, 'msg': '数据刷新成功', 'data': None})
     except Exception as e:
         return jsonify({'code': 500, 'msg': f'刷新失败：{str(e)}', 'data': None})
 
 
+@app.route('/api/fund/backfill', methods=['POST'])
+@login_required
+@admin_required
+def fund_backfill():
+    """
+    从配置的历史净值数据源回填基金行情，并补齐/重算收益（仅管理员）
+    回填在后台线程中按定时任务方式执行（租约+job_runs记录），接口立即返回202，进度见/api/jobs/runs
+    参数：fund_codes（默认全部用户持有的基金）、start_date/end_date（默认近HISTORY_BACKFILL_DAYS天至昨日）
+    """
+    try:
+        source = create_history_source()
+        if source is None:
+            return jsonify({'code': 400, 'msg': '未配置历史净值数据源', 'data': None})
+        data = request.get_json(silent=True) or {}
+        cur = get_db().cursor()
+        cur.execute('SELECT DISTINCT fund_code FROM user_fund_relation')
+        held_codes = [row['fund_code'] for row in cur.fetchall()]
+        fund_codes = [code for code in (data.get('fund_codes') or held_codes) if code in held_codes]
+        if not fund_codes:
+            return jsonify({'code': 404, 'msg': '没有可回填的持有基金', 'data': None})
+        start_date = data.get('start_date') or (date.today() - timedelta(days=HISTORY_BACKFILL_DAYS)).strftime(
+            "%Y-%m-%d")
+        end_date = data.get('end_date') or (date.today() - timedelta(days=1)).strftime("%Y-%m-%d")
+        try:
+            datetime.strptime(start_date, "%Y-%m-%d")
+            datetime.strptime(end_date, "%Y-%m-%d")
+        except ValueError:
+            return jsonify({'code': 400, 'msg': '日期格式应为YYYY-MM-DD', 'data': None})
+        run_key = f"{start_date}~{end_date}@{time.strftime('%Y%m%d%H%M%S')}"
+        t = threading.Thread(target=run_exclusive_job, daemon=True, args=(
+            'backfill_history', lambda: backfill_history(source, fund_codes, start_date, end_date), run_key))
+        t.start()
+        return jsonify({'code': 202, 'msg': '回填任务已提交，进度见任务执行记录', 'data': {
+            'job': 'backfill_history', 'run_key': run_key, 'funds': len(fund_codes)}}), 202
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'回填失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/fund/archive/stats', methods=['GET'])
+@login_required
+def fund_archive_stats():
+    """当前用户收益明细在线/归档条数、归档月份数及压缩后字节数"""
+    try:
+        user_id = session['user_id']
+        cur = get_db().cursor()
+        cur.execute('SELECT COUNT(*) AS live_rows FROM user_fund_earnings WHERE user_id = ?', (user_id,))
+        stats = dict(cur.fetchone())
+        cur.execute('''
+                    SELECT COUNT(*)                        AS archived_periods,
+                           coalesce(SUM(days), 0)          AS archived_rows,
+                           coalesce(SUM(length(data)), 0)  AS archived_bytes,
+                           MAX(last_date)                  AS archived_until
+                    FROM user_fund_earnings_archive
+                    WHERE user_id = ?
+                    ''', (user_id,))
+        stats.update(dict(cur.fetchone()))
+        return jsonify({'code': 200, 'msg': '获取成功', 'data': stats})
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'获取归档统计失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/fund/cache/stats', methods=['GET'])
+@login_required
+def fund_cache_stats():
+    """行情缓存统计（命中/未命中/淘汰次数、当前容量），用于评估缓存大小"""
+    return jsonify({'code': 200, 'msg': '获取成功', 'data': QUOTE_CACHE.stats()})
+
+
+@app.route('/api/fund/upstream/status', methods=['GET'])
+@login_required
+def fund_upstream_status():
+    """基金接口熔断器状态 + 拉取失败的基金（负缓存）明细，limit控制返回的基金数（默认100）"""
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    return jsonify({'code': 200, 'msg': '获取成功', 'data': {
+        'breaker': UPSTREAM_BREAKER.stats(),
+        'failures': FUND_FAILURES.stats(limit)
+    }})
+
+
+@app.route('/api/fund/upstream/reset', methods=['POST'])
+@login_required
+@admin_required
+def fund_upstream_reset():
+    """清除基金拉取失败记录（可传fund_code只清除一只），下次访问立即重新请求接口（仅管理员，影响所有用户）"""
+    fund_code = (request.get_json(silent=True) or {}).get('fund_code', '').strip() or None
+    FUND_FAILURES.clear(fund_code)
+    return jsonify({'code': 200, 'msg': '已清除失败记录', 'data': None})
+
+
+@app.route('/api/jobs/runs', methods=['GET'])
+@login_required
+@admin_required
+def job_run_list():
+    """定时任务执行记录（仅管理员）（开始/结束/耗时/写入行数/失败数），可按job过滤，默认最近20条"""
+    try:
+        job_name = request.args.get('job', '').strip()
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+        cur = get_db().cursor()
+        if job_name:
+            cur.execute('''
+                        SELECT *
+                        FROM job_runs
+                        WHERE job_name = ?
+                        ORDER BY start_time DESC, id DESC
+                        LIMIT ?
+                        ''', (job_name, limit))
+        else:
+            cur.execute('SELECT * FROM job_runs ORDER BY start_time DESC, id DESC LIMIT ?', (limit,))
+        return jsonify({'code': 200, 'msg': '获取成功', 'data': [dict(row) for row in cur.fetchall()]})
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'获取任务记录失败：{str(e)}', 'data': None})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus文本格式性能指标：接口耗时、SQL条数/耗时、外部接口调用、Session耗时、行情缓存、熔断/负缓存、Session存储"""
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    cache_stats = QUOTE_CACHE.stats()
+    for key in ('hits', 'misses', 'evictions', 'shared'):
+        lines.append(f"# TYPE fund_quote_cache_{key}_total counter")
+        lines.append(f"fund_quote_cache_{key}_total {cache_stats[key]}")
+    lines.append("# TYPE fund_quote_cache_size gauge")
+    lines.append(f"fund_quote_cache_size {cache_stats['size']}")
+    breaker_stats = UPSTREAM_BREAKER.stats()
+    failure_stats = FUND_FAILURES.stats(limit=0)
+    lines.append("# TYPE fund_upstream_breaker_open gauge")
+    lines.append(f"fund_upstream_breaker_open {0 if breaker_stats['state'] == 'closed' else 1}")
+    for key in ('opened', 'short_circuits'):
+        lines.append(f"# TYPE fund_upstream_breaker_{key}_total counter")
+        lines.append(f"fund_upstream_breaker_{key}_total {breaker_stats[key]}")
+    lines.append("# TYPE fund_upstream_failing_funds gauge")
+    for kind in ('not_found', 'error'):
+        lines.append(f'fund_upstream_failing_funds{{kind="{kind}"}} {failure_stats[kind]}')
+    lines.append("# TYPE fund_upstream_skipped_total counter")
+    lines.append(f"fund_upstream_skipped_total {failure_stats['skipped']}")
+    lines.append("# TYPE fund_async_prefetch_total counter")
+    lines.append(f"fund_async_prefetch_total {asgi_app.prefetched if asgi_app else 0}")
+    session_stats = SESSION_STORE.stats()
+    for key in ('cache_hits', 'cache_misses', 'writes', 'skipped_writes', 'swept'):
+        lines.append(f"# TYPE fund_session_{key}_total counter")
+        lines.append(f"fund_session_{key}_total {session_stats[key]}")
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/fund/stat', methods=['GET'])
 @login_required
+@portfolio_conditional
 def fund_stat():
     """获取基金总统计数据（概览卡片：总投入、总现存、总今日收益、总累计收益）"""
     try:
-        db = get_db()
-        cur = db.cursor()
-        user_id = session['user_id']
-        cur.execute('SELECT * FROM user_fund_relation WHERE user_id=?', (user_id,))
-        relation_list = cur.fetchall()
-        if not relation_list:
+        snapshot = get_portfolio_snapshot(session['user_id'])
+        if not snapshot['funds']:
             return jsonify({
                 'code': 200, 'msg': '暂无统计数据',
                 'data': {
@@ -950,49 +5069,189 @@ def fund_stat():
                     'total_today_earn': 0.0, 'total_total_earn': 0.0
                 }
             })
-        # 计算总统计数据
-        total_invest = 0.0
-        total_current = 0.0
-        total_today_earn = 0.0
-        total_total_earn = 0.0
-        for relation in relation_list:
-            fund_code = relation['fund_code']
-            invest_principal = relation['invest_principal']
-            total_invest += invest_principal
-            # 计算单基金各项数据
-            today_real = fetch_fund_real(fund_code) or {}
-            today_gszzl = today_real.get('gszzl', 0.0)
-            history_earn = calc_history_earn_sum(user_id, fund_code)
-            temp_today_earn = calc_today_earn(invest_principal, today_gszzl)
-            total_earn = calc_total_earn(user_id, fund_code, temp_today_earn)
-            current_principal = calc_current_principal(invest_principal, total_earn)
-            today_earn = calc_today_earn(current_principal, today_gszzl)
-            # 累加总数据
-            total_current += current_principal
-            total_today_earn += today_earn
-            total_total_earn += total_earn
-        # 保留2位小数
-        total_invest = round(total_invest, 2)
-        total_current = round(total_current, 2)
-        total_today_earn = round(total_today_earn, 2)
-        total_total_earn = round(total_total_earn, 2)
+        return jsonify({'code': 200, 'msg': '获取统计数据成功', 'data': snapshot['stat']})
+    except Exception as e:
+        return jsonify({'code': 500, 'msg': f'获取统计数据失败：{str(e)}', 'data': None})
+
+
+@app.route('/api/fund/dashboard', methods=['GET'])
+@login_required
+@portfolio_conditional
+def fund_dashboard():
+    """看板合并接口：一次返回基金列表、总统计、饼图数据（共用同一份组合快照）"""
+    try:
+        snapshot = get_portfolio_snapshot(session['user_id'])
         return jsonify({
-            'code': 200, 'msg': '获取统计数据成功',
-            'data': {
-                'total_invest': total_invest,  # 总投入本金
-                'total_current': total_current,  # 总现存本金
-                'total_today_earn': total_today_earn,  # 总今日收益
-                'total_total_earn': total_total_earn  # 总累计收益
-            }
+            'code': 200, 'msg': '获取看板数据成功',
+            'data': {'list': snapshot['funds'], 'stat': snapshot['stat'], 'pie': snapshot['pie']}
         })
     except Exception as e:
-        return jsonify({'code': 500, 'msg': f'获取统计数据失败：{str(e)}', 'data': None})
+        return jsonify({'code': 500, 'msg': f'获取看板数据失败：{str(e)}', 'data': None})
+
+
+# ---------------------- 异步服务模式（ASGI：行情拉取在事件循环上，Flask视图在固定线程池中执行） ----------------------
+ASYNC_PREFETCHED_KEY = 'fund.quotes_prefetched'  # WSGI environ标记：行情已由事件循环拉取，工作线程不再请求接口
+ASYNC_PREFETCH_PATHS = ('/api/fund/list', '/api/fund/stat', '/api/fund/chart/pie', '/api/fund/dashboard',
+                        '/api/portfolio/trend')
+ASYNC_TREND_PATH = re.compile(r'^/api/fund/chart/trend/([^/]+)$')
+ASYNC_STREAM_PATH = '/api/fund/stream'  # 实时推送（长连接），使用单独的线程池
+
+
+async def fetch_fund_real_async(client, fund_code):
+    """事件循环中拉取基金实时行情（httpx.AsyncClient，退避/熔断/统计与fetch_fund_real_remote一致）"""
+    allowed, fallback = quote_fetch_allowed(fund_code)
+    if not allowed:
+        return fallback
+    start = time.perf_counter()
+    url = FUND_API_URL.format(fund_code=fund_code, timestamp=int(time.time()))
+    try:
+        res = await client.get(url, headers=HEADERS, timeout=QUOTE_FETCH_TIMEOUT)
+        res.raise_for_status()
+        fund_data = parse_fund_jsonp(fund_code, res.text)
+    except Exception as e:
+        return quote_fetch_finished(fund_code, start, error=e)
+    return quote_fetch_finished(fund_code, start, fund_data)
+
+
+def plan_quote_prefetch(sid, fund_code=None):
+    """
+    异步模式请求进入工作线程前调用（在数据库线程池中执行）：找出需要实时拉取行情的基金，
+    即本地行情表缺失/长时间未刷新且行情缓存中没有有效数据的持有基金
+    :param fund_code: 趋势图只检查该基金，None=用户全部持有基金（组合快照有效时无需拉取）
+    :return: 基金代码列表，未登录返回[]
+    """
+    loaded = SESSION_STORE.load_session_data(sid) if sid else None
+    user_id = loaded[0].get('user_id') if loaded else None
+    if user_id is None:
+        return []
+    if fund_code is None and PORTFOLIO_SNAPSHOT_CACHE.get_cached(user_id) is not None:
+        return []
+    with app.app_context():
+        get_db(readonly=True)
+        codes = [relation['fund_code'] for relation in load_user_relations(user_id)]
+        if fund_code is not None:
+            codes = [code for code in codes if code == fund_code]
+        fresh, _ = read_intraday_quotes(codes)
+    return [code for code in codes if code not in fresh and QUOTE_CACHE.get_cached(code) is None]
+
+
+class AsyncPortfolioApp:
+    """
+    ASGI入口（可选，需安装httpx、a2wsgi，uvicorn main:asgi_app）：
+    1. 组合接口（列表/统计/饼图/看板/趋势图）先在事件循环上用httpx.AsyncClient并发拉取缺失的行情（不占用线程，写入行情缓存）
+    2. 再由a2wsgi交给Flask在固定大小的线程池中执行（只做数据库读取和计算，不再请求外部接口）
+    3. 其余接口直接交给Flask；实时推送（SSE）使用单独的线程池，长连接不占用Flask工作线程
+    外部接口慢时等待发生在事件循环上，少量线程即可支撑大量并发看板请求；同步部署方式不受影响
+    """
+
+    def __init__(self, wsgi_app, workers=ASYNC_WORKER_THREADS):
+        self.wsgi_app = wsgi_app
+        self.wsgi = WSGIMiddleware(self.run_wsgi, workers=workers)
+        self.stream_wsgi = WSGIMiddleware(self.run_wsgi, workers=STREAM_MAX_CLIENTS)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-cache')
+        self.client = None
+        self.loop = None
+        self._inflight = {}  # 基金代码 -> 进行中的拉取任务（同一基金并发请求只拉一次）
+        self.prefetched = 0  # 事件循环上发起的行情拉取次数
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        if scope['method'] in ('GET', 'HEAD'):
+            match = ASYNC_TREND_PATH.match(scope['path'])
+            if match or scope['path'] in ASYNC_PREFETCH_PATHS:
+                await self.prefetch(scope, match.group(1) if match else None)
+                scope = dict(scope, **{ASYNC_PREFETCHED_KEY: True})
+        wsgi = self.stream_wsgi if scope['path'] == ASYNC_STREAM_PATH else self.wsgi
+        await wsgi(scope, receive, send)
+
+    def run_wsgi(self, environ, start_response):
+        """工作线程中执行Flask：把事件循环上已拉取行情的标记（scope）带入WSGI environ"""
+        environ[ASYNC_PREFETCHED_KEY] = environ.get('asgi.scope', {}).get(ASYNC_PREFETCHED_KEY, False)
+        return self.wsgi_app(environ, start_response)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client:
+                    await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def get_client(self):
+        """HTTP客户端的连接绑定事件循环，循环变化（如测试中多次运行）时重建"""
+        loop = asyncio.get_running_loop()
+        if self.client is None or self.loop is not loop:
+            self.client = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=QUOTE_FETCH_WORKERS))
+            self.loop = loop
+            self._inflight = {}
+        return self.client
+
+    def quote_task(self, fund_code):
+        """获取基金的拉取任务，已有进行中的任务则复用；成功结果写入行情缓存（缓存存储操作在线程池中执行）"""
+        task = self._inflight.get(fund_code)
+        if task is None:
+            client = self.get_client()
+
+            async def run():
+                try:
+                    fund_data = await fetch_fund_real_async(client, fund_code)
+                    if fund_data and not fund_data.get('stale'):
+                        await asyncio.get_running_loop().run_in_executor(self.executor, QUOTE_CACHE.set,
+                                                                         fund_code, fund_data)
+                    return fund_data
+                finally:
+                    self._inflight.pop(fund_code, None)
+
+            self.prefetched += 1
+            task = self._inflight[fund_code] = asyncio.ensure_future(run())
+        return task
+
+    async def prefetch(self, scope, fund_code=None):
+        """拉取请求用户缺失的行情，最多等待QUOTE_BATCH_DEADLINE秒，未完成的继续在后台拉取"""
+        cookie = SimpleCookie()
+        for name, value in scope.get('headers', []):
+            if name == b'cookie':
+                cookie.load(value.decode('latin-1'))
+        morsel = cookie.get(app.config['SESSION_COOKIE_NAME'])
+        if morsel is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            codes = await loop.run_in_executor(self.executor, plan_quote_prefetch, morsel.value, fund_code)
+        except Exception as e:
+            print(f"❌ 异步行情预取失败：{str(e)}")
+            return
+        if codes:
+            self.get_client()
+            await asyncio.wait([self.quote_task(code) for code in codes], timeout=QUOTE_BATCH_DEADLINE)
+
+
+asgi_app = AsyncPortfolioApp(app) if httpx is not None and WSGIMiddleware is not None else None
 
 
 # ---------------------- 启动应用 ----------------------
+def start_background_jobs():
+    """启动后台任务（定时落库、行情刷新）；gunicorn部署时在每个worker启动后调用，由租约保证只有一个执行"""
+    start_schedule()
+    start_quote_refresher()
+
+
+def close_db_pools():
+    """关闭所有连接池的空闲连接（gunicorn主进程初始化数据库后、fork worker前调用）"""
+    for pool in list(DB_POOLS.values()):
+        pool.close_all()
+
+
 if __name__ == '__main__':
     init_db()  # 初始化数据库
-    start_schedule()  # 启动定时任务
+    start_background_jobs()  # 启动定时任务+后台行情刷新
     # 创建static目录（如果不存在）
     if not os.path.exists(STATIC_FOLDER):
         os.makedirs(STATIC_FOLDER)
@@ -1001,4 +5260,10 @@ if __name__ == '__main__':
     print("🔑 测试账号：admin/123456 | test/123456")
     print(
         "⚡ 刷新数据接口：/api/fund/refresh | 饼图接口：/api/fund/chart/pie | 趋势图接口：/api/fund/chart/trend/[基金代码]")
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    if ASYNC_MODE and uvicorn is not None and asgi_app is not None:
+        print(f"⚡ 异步服务模式：组合接口行情拉取在事件循环上进行，Flask视图线程数{ASYNC_WORKER_THREADS}")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=5000)
+    else:
+        if ASYNC_MODE:
+            print("⚠️ 未安装uvicorn/httpx/a2wsgi，异步服务模式不可用，使用多线程模式启动")
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
@@ -0,0 +1,602 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+import pytest
+
+import main
+
+TODAY = date.today().isoformat()
+
+
+def make_quote(gszzl=1.0, name='测试基金'):
+    """构造基金接口返回的实时行情"""
+    return {'name': name, 'jzrq': TODAY, 'dwjz': 1.0, 'gsz': 1.0 + gszzl / 100, 'gszzl': gszzl,
+            'gztime': f'{TODAY} 15:00'}
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """临时数据库（执行全部迁移），清空进程内缓存，返回读写连接"""
+    monkeypatch.setattr(main, 'DATABASE', str(tmp_path / 'funds.db'))
+    for cache in (main.FUND_SERIES_CACHE, main.DERIVED_EARNINGS_CACHE, main.PORTFOLIO_SNAPSHOT_CACHE,
+                  main.QUOTE_CACHE):
+        cache.invalidate()
+    main.init_db()
+    conn = main.get_db_pool().acquire()
+    yield conn
+    main.get_db_pool().release(conn)
+    main.close_db_pools()
+
+
+def insert_trend(cur, fund_code, record_date, gszzl):
+    """写入一行基金日行情"""
+    cur.execute('''
+                INSERT INTO fund_daily_trend (fund_code, record_date, jzrq, dwjz, gsz, gszzl, gztime, create_time)
+                VALUES (?, ?, ?, 1.0, 1.0, ?, ?, ?)
+                ''', (fund_code, record_date, record_date, gszzl, f'{record_date} 15:00', f'{record_date} 15:00:00'))
+
+
+def test_portfolio_etag_changes_after_trend_row_in_derived_mode(db, monkeypatch):
+    monkeypatch.setattr(main, 'EARNINGS_STORAGE', 'derived')
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    cur.execute("UPDATE user_fund_relation SET add_time = '2000-01-01 00:00:00'")
+    cur.execute("UPDATE user_principal_history SET effective_date = '2000-01-01'")
+    db.commit()
+    with main.app.app_context():
+        etag = main.portfolio_etag(1)
+    with main.app.app_context():
+        assert etag is not None and main.portfolio_etag(1) == etag
+
+    # 回填/定时任务写入行情后失效本进程序列缓存（与backfill_history、auto_record_data一致）
+    insert_trend(cur, '000001', (date.today() - timedelta(days=1)).isoformat(), 2.0)
+    db.commit()
+    main.FUND_SERIES_CACHE.invalidate('000001')
+    with main.app.app_context():
+        assert main.portfolio_etag(1) != etag
+        assert main.portfolio_etag(1, '000001') is not None
+
+    # 其他进程写入：本进程序列缓存过期后ETag随数据一起变化
+    with main.app.app_context():
+        etag = main.portfolio_etag(1)
+    insert_trend(cur, '000001', (date.today() - timedelta(days=2)).isoformat(), -1.0)
+    db.commit()
+    monkeypatch.setattr(main, 'DERIVED_CACHE_TTL', 0)
+    main.FUND_SERIES_CACHE.set('000001', main.FUND_SERIES_CACHE.peek('000001'))  # 按新TTL立即过期
+    time.sleep(0.01)
+    with main.app.app_context():
+        assert main.portfolio_etag(1) != etag
+
+
+@pytest.fixture
+def client(db):
+    """已登录admin的测试客户端"""
+    client = main.app.test_client()
+    assert client.post('/api/login', json={'username': 'admin', 'password': '123456'}).get_json()['code'] == 200
+    return client
+
+
+def test_fund_add_rejects_stale_and_unavailable_quotes(client, db, monkeypatch):
+    quotes = {'000001': dict(make_quote(), stale=True), '000002': None, '000003': make_quote()}
+    monkeypatch.setattr(main, 'fetch_fund_real', quotes.get)
+    monkeypatch.setattr(main, 'fetch_funds_real', lambda codes, deadline=None: {code: quotes[code] for code in codes})
+    main.FUND_FAILURES.clear()
+
+    assert client.post('/api/fund', json={'fundcode': '000001', 'invest_principal': 100}).get_json()['code'] == 503
+    assert client.post('/api/fund', json={'fundcode': '000002', 'invest_principal': 100}).get_json()['code'] == 503
+    main.FUND_FAILURES.record_failure('000002', 'not_found', '接口返回非标准JSONP')
+    results = client.post('/api/fund/batch', json={'funds': [
+        {'fundcode': code, 'invest_principal': 100} for code in quotes]}).get_json()['data']
+    assert [item['code'] for item in results] == [503, 404, 200]
+    main.FUND_FAILURES.clear()
+
+    cur = db.cursor()
+    cur.execute('SELECT fund_code FROM user_fund_relation')
+    assert [row['fund_code'] for row in cur.fetchall()] == ['000003']
+    cur.execute('SELECT fund_code FROM fund_daily_trend')
+    assert [row['fund_code'] for row in cur.fetchall()] == ['000003']
+
+
+def test_summary_trigger_matches_rebuild(db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    cur.execute("UPDATE user_fund_relation SET add_time = '2026-01-05 10:00:00'")
+    cur.execute('DELETE FROM user_fund_earnings')
+    cur.execute('DELETE FROM user_fund_summary')
+    # 添加日之前的收益（回填/修改添加日后残留）、添加日当天及之后的收益，乱序插入
+    for record_date, day_earn in [('2026-01-06', 3.0), ('2026-01-02', 100.0), ('2026-01-05', 1.5),
+                                  ('2026-01-07', -2.0), ('2026-01-01', 50.0)]:
+        cur.execute('''
+                    INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal, day_gszzl,
+                                                    day_earn, total_earn, create_time)
+                    VALUES (1, '000001', ?, 1000, ?, ?, 0, '2026-01-08 00:00:00')
+                    ''', (record_date, day_earn / 10, day_earn))
+    columns = ('last_record_date', 'total_earn', 'last_day_gszzl', 'last_day_earn', 'prev_record_date',
+               'prev_day_gszzl', 'prev_day_earn')
+    cur.execute(f"SELECT {', '.join(columns)} FROM user_fund_summary")
+    by_trigger = [tuple(row) for row in cur.fetchall()]
+    main.rebuild_fund_summaries(cur)
+    cur.execute(f"SELECT {', '.join(columns)} FROM user_fund_summary")
+    assert [tuple(row) for row in cur.fetchall()] == by_trigger == [
+        ('2026-01-07', 2.5, -0.2, -2.0, '2026-01-06', 0.3, 3.0)]
+
+
+def test_auto_record_data_keeps_first_trend_and_recomputes_only_mismatched(db, monkeypatch):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote(1.0)), ('000002', 1000.0, make_quote(2.0))])
+    cur.execute('''
+                INSERT INTO user_fund_relation (user_id, fund_code, fund_name, invest_principal, add_time)
+                VALUES (2, '000001', '测试基金', 500, ?)
+                ''', (f'{TODAY} 09:00:00',))
+    cur.execute("UPDATE user_fund_relation SET invest_principal = 2000 WHERE user_id = 1 AND fund_code = '000002'")
+    db.commit()
+    # 收盘后行情已变化，今日行情仍以添加基金时写入的为准
+    monkeypatch.setattr(main, 'fetch_funds_real', lambda codes, deadline=None: {
+        code: make_quote(5.0) for code in codes})
+    recomputed = []
+    recompute_earnings = main.recompute_earnings
+    monkeypatch.setattr(main, 'recompute_earnings', lambda cur, fund_codes, *args: (
+        recomputed.append((args[-1], fund_codes)), recompute_earnings(cur, fund_codes, *args))[1])
+
+    result = main.auto_record_data()
+    assert result['fail'] == 0 and recomputed == [(1, ['000002'])]
+    cur.execute('SELECT fund_code, gszzl FROM fund_daily_trend ORDER BY fund_code')
+    assert [tuple(row) for row in cur.fetchall()] == [('000001', 1.0), ('000002', 2.0)]
+    cur.execute('SELECT user_id, fund_code, invest_principal, day_gszzl, day_earn, total_earn '
+                'FROM user_fund_earnings ORDER BY user_id, fund_code')
+    assert [tuple(row) for row in cur.fetchall()] == [
+        (1, '000001', 1000.0, 1.0, 10.0, 10.0), (1, '000002', 2000.0, 2.0, 40.0, 40.0),
+        (2, '000001', 500.0, 1.0, 5.0, 5.0)]
+
+    # 重复执行：记录均一致，不写入也不重算
+    recomputed.clear()
+    assert main.auto_record_data()['rows_written'] == 0 and recomputed == []
+
+
+def test_perf_middleware_times_streamed_body_and_cursor_iteration(monkeypatch):
+    def stream_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+
+        def body():
+            conn = sqlite3.connect(':memory:', factory=main.InstrumentedConnection)
+            cur = conn.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100) '
+                               'SELECT i FROM n')
+            yield str(sum(row[0] for row in cur)).encode()
+            time.sleep(0.05)
+            yield b'done'
+
+        return body()
+
+    recorded = []
+    monkeypatch.setattr(main.PerfMiddleware, 'finish', staticmethod(lambda perf, environ: recorded.append(
+        (time.perf_counter() - perf.start, perf.sql_count, perf.sql_seconds))))
+    response = main.PerfMiddleware(stream_app)({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream'},
+                                               lambda status, headers: None)
+    assert recorded == []
+    assert b''.join(response) == b'5050done'
+    response.close()  # 迭代完已记录，close不重复记录
+    [(seconds, sql_count, sql_seconds)] = recorded
+    assert seconds >= 0.05 and sql_count == 1 and sql_seconds > 0
+
+
+def test_job_runs_requires_admin(client, db):
+    assert client.get('/api/jobs/runs').get_json()['code'] == 200
+    other = main.app.test_client()
+    other.post('/api/login', json={'username': 'test', 'password': '123456'})
+    response = other.get('/api/jobs/runs')
+    assert response.status_code == 403 and response.get_json()['code'] == 403
+
+
+def test_backfill_is_admin_only_and_runs_as_background_job(client, db, monkeypatch):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 2, [('000001', 1000.0, make_quote())])
+    db.commit()
+    calls = []
+    monkeypatch.setattr(main, 'create_history_source', lambda spec=None: object())
+    monkeypatch.setattr(main, 'backfill_history', lambda source, fund_codes, start_date, end_date: (
+        calls.append(fund_codes), {'rows_written': 3, 'fail': 0})[1])
+
+    other = main.app.test_client()
+    other.post('/api/login', json={'username': 'test', 'password': '123456'})
+    assert other.post('/api/fund/backfill', json={}).status_code == 403
+
+    response = client.post('/api/fund/backfill', json={'start_date': '2026-01-01', 'end_date': '2026-01-31'})
+    assert response.status_code == 202 and response.get_json()['data']['funds'] == 1
+    for _ in range(100):
+        cur.execute("SELECT status, rows_written FROM job_runs WHERE job_name = 'backfill_history'")
+        row = cur.fetchone()
+        if row and row['status'] != 'running':
+            break
+        time.sleep(0.02)
+    assert tuple(row) == ('success', 3) and calls == [['000001']]
+
+
+def test_upstream_reset_requires_admin(client, db):
+    main.FUND_FAILURES.record_failure('000009', 'error', 'timeout')
+    other = main.app.test_client()
+    other.post('/api/login', json={'username': 'test', 'password': '123456'})
+    assert other.post('/api/fund/upstream/reset', json={}).status_code == 403
+    assert main.FUND_FAILURES.last_kind('000009') == 'error'
+    assert client.post('/api/fund/upstream/reset', json={}).get_json()['code'] == 200
+    assert main.FUND_FAILURES.last_kind('000009') is None
+
+
+class ListHistorySource:
+    """测试用历史净值数据源：按区间返回预置行"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iter_rows(self, fund_codes, start_date, end_date):
+        return (row for row in self.rows
+                if row['fund_code'] in fund_codes and start_date <= row['record_date'] <= end_date)
+
+
+def test_fill_trend_gaps_inserts_only_missing_dates_and_gives_up_on_holidays(db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    first_day = date.today() - timedelta(days=14)
+    cur.execute('UPDATE user_fund_relation SET add_time = ?', (f'{first_day.isoformat()} 09:00:00',))
+    weekdays = [(first_day + timedelta(days=i)).isoformat() for i in range(14)
+                if (first_day + timedelta(days=i)).weekday() < 5]
+    missing, holiday = weekdays[:2]
+    for record_date in weekdays[2:]:
+        insert_trend(cur, '000001', record_date, 1.0)
+    db.commit()
+    # 数据源有除休市日外所有日期的净值（涨幅与已存行情不同）
+    source = ListHistorySource([{'fund_code': '000001', 'record_date': record_date, 'dwjz': 1.0, 'gszzl': 9.9}
+                                for record_date in weekdays if record_date != holiday])
+
+    assert main.fill_trend_gaps(source)['gap_days'] == 2
+    cur.execute('SELECT record_date, gszzl FROM fund_daily_trend WHERE record_date < ? ORDER BY record_date',
+                (TODAY,))
+    rows = [tuple(row) for row in cur.fetchall()]
+    assert rows == [(missing, 9.9)] + [(record_date, 1.0) for record_date in weekdays[2:]]
+    cur.execute('SELECT day_gszzl FROM user_fund_earnings WHERE record_date = ?', (missing,))
+    assert cur.fetchone()['day_gszzl'] == 9.9
+
+    # 再次执行不改写已有行情，休市日尝试TREND_GAP_MAX_ATTEMPTS次后不再算作缺口
+    for _ in range(main.TREND_GAP_MAX_ATTEMPTS - 1):
+        result = main.fill_trend_gaps(source)
+        assert result['gap_days'] == 1 and result['rows_written'] == 0
+    assert main.fill_trend_gaps(source)['gap_days'] == 0
+    cur.execute('SELECT record_date, gszzl FROM fund_daily_trend WHERE record_date < ? ORDER BY record_date',
+                (TODAY,))
+    assert [tuple(row) for row in cur.fetchall()] == rows
+
+
+def test_backfill_history_keeps_stored_gszzl_when_it_cannot_be_derived(db):
+    cur = db.cursor()
+    insert_trend(cur, '000001', '2026-01-05', 1.5)
+    insert_trend(cur, '000002', '2026-01-02', 0.5)  # 区间之前的行情，首行涨幅按其净值计算
+    db.commit()
+    source = ListHistorySource([
+        {'fund_code': '000001', 'record_date': '2026-01-05', 'dwjz': 1.2},
+        {'fund_code': '000001', 'record_date': '2026-01-06', 'dwjz': 1.32},
+        {'fund_code': '000002', 'record_date': '2026-01-05', 'dwjz': 1.05},
+        {'fund_code': '000003', 'record_date': '2026-01-05', 'dwjz': 2.0},
+    ])
+    stats = main.backfill_history(source, ['000001', '000002', '000003'], '2026-01-05', '2026-01-06')
+    assert stats['rows'] == 3 and stats['skipped'] == 1
+    cur.execute('SELECT fund_code, record_date, dwjz, gszzl FROM fund_daily_trend '
+                "WHERE record_date >= '2026-01-05' ORDER BY fund_code, record_date")
+    assert [tuple(row) for row in cur.fetchall()] == [
+        ('000001', '2026-01-05', 1.2, 1.5), ('000001', '2026-01-06', 1.32, 10.0), ('000002', '2026-01-05', 1.05, 5.0)]
+
+
+def test_fund_chart_returns_backfilled_nav_before_add_date(client, db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    insert_trend(cur, '000001', yesterday, 0.8)
+    db.commit()
+    data = client.get('/api/fund/chart/trend/000001').get_json()['data']
+    assert data['nav_list'] == [{'date': yesterday, 'dwjz': 1.0, 'gszzl': 0.8}]
+    assert [point['date'] for point in data['trend_list']] == [TODAY]
+
+
+def test_conditional_response_etag_matches_served_snapshot(client, db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    db.commit()
+    response = client.get('/api/fund/stat')
+    etag = response.headers['ETag']
+    assert response.get_json()['data']['total_invest'] == 1000.0
+    assert client.get('/api/fund/stat', headers={'If-None-Match': etag}).status_code == 304
+
+    # 其他进程修改本金：本进程快照缓存未失效，响应仍需与新ETag对应
+    cur.execute('UPDATE user_fund_relation SET invest_principal = 2000')
+    db.commit()
+    response = client.get('/api/fund/stat', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert response.get_json()['data']['total_invest'] == 2000.0
+    assert client.get('/api/fund/stat', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_sqlite_cache_lease_wait_is_capped_and_falls_back(db):
+    backend, other = main.SQLiteCacheBackend('test', 10), main.SQLiteCacheBackend('test', 10)
+    loaded = []
+    cache = main.TTLCache(lambda key: (loaded.append(key), {'v': 2})[1], 10, lambda: 60, backend=backend,
+                          lease_wait=0.2)
+    backend.set('old', time.time() - 1, {'v': 1})
+    assert other.acquire_lease('old', 10) and other.acquire_lease('new', 10)
+
+    start = time.perf_counter()
+    assert cache.get('old') == {'v': 1, 'stale': True}  # 其他进程回源超时：返回过期结果
+    assert cache.get('new') == {'v': 2}  # 没有过期结果：自己加载
+    assert loaded == ['new'] and time.perf_counter() - start < 1
+
+
+def test_sqlite_cache_prunes_least_recently_read(db):
+    backend = main.SQLiteCacheBackend('test', 2, prune_every=1000, touch_interval=60)
+    for key in ('a', 'b'):
+        backend.set(key, time.time() + 60, {'key': key})
+        time.sleep(0.01)
+    assert backend.get('a')  # 命中只记在内存，清理前写回
+    backend.set('c', time.time() + 60, {'key': 'c'})
+    backend.prune()
+    assert backend.get('a') and backend.get('b') is None and backend.size() == 2
+
+
+def test_get_db_caches_readonly_and_readwrite_connections_separately(db):
+    with main.app.test_request_context('/api/fund/list'):
+        reader = main.get_db()
+        writer = main.get_db(readonly=False)
+        assert reader is not writer and main.get_db(readonly=True) is reader
+        assert main.get_db() is writer  # 取过读写连接后默认沿用，读到未提交的写入
+        with pytest.raises(sqlite3.OperationalError):
+            reader.execute('DELETE FROM fund_daily_trend')
+    # 上下文结束两个连接都归还，下次从池中复用
+    with main.app.test_request_context('/api/fund/list'):
+        assert main.get_db() is reader and main.get_db(readonly=False) is writer
+
+
+def test_fetch_funds_real_does_not_resubmit_inflight_codes_and_bounds_timeout(db, monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    class SlowSession:
+        def get(self, url, headers=None, timeout=None):
+            calls.append(timeout)
+            release.wait(5)
+            raise main.requests.Timeout('timeout')
+
+    monkeypatch.setattr(main, 'HTTP_SESSION', SlowSession())
+    monkeypatch.setattr(main, 'UPSTREAM_BREAKER', main.CircuitBreaker(main.CIRCUIT_FAILURE_THRESHOLD, main.CIRCUIT_OPEN_SECONDS))
+    main.FUND_FAILURES.clear()
+    try:
+        assert main.fetch_funds_real(['000001'], deadline=0.3) == {'000001': None}
+        future = main.QUOTE_INFLIGHT['000001']  # 超时后仍在拉取，再次请求复用而不是重复提交
+        assert main.fetch_funds_real(['000001'], deadline=0.3) == {'000001': None}
+        assert len(calls) == 1 and calls[0] <= 0.3
+    finally:
+        release.set()
+    assert future.result() is None
+    main.FUND_FAILURES.clear()
+
+
+def insert_earnings(cur, user_id, fund_code, rows):
+    """按日期升序写入收益明细：rows为(日期, 涨幅, 当日收益)，累计收益依次累加"""
+    total_earn = 0.0
+    for record_date, day_gszzl, day_earn in rows:
+        total_earn = round(total_earn + day_earn, 2)
+        cur.execute('''
+                    INSERT INTO user_fund_earnings (user_id, fund_code, record_date, invest_principal, day_gszzl,
+                                                    day_earn, total_earn, create_time)
+                    VALUES (?, ?, ?, 1000, ?, ?, ?, ?)
+                    ''', (user_id, fund_code, record_date, day_gszzl, day_earn, total_earn, f'{record_date} 15:00:00'))
+
+
+def test_archive_and_unarchive_round_trip_keeps_rows_identical(db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    cur.execute("UPDATE user_fund_relation SET add_time = '2025-01-02 09:00:00'")
+    cur.execute('DELETE FROM user_fund_earnings')
+    cur.execute('DELETE FROM user_fund_summary')
+    old_dates = [(date(2025, 1, 2) + timedelta(days=i)).isoformat() for i in range(60)]
+    recent_dates = [(date.today() - timedelta(days=1)).isoformat(), TODAY]
+    insert_earnings(cur, 1, '000001', [(record_date, round(0.1 + i / 7, 6), round(i * 0.37 - 5, 2))
+                                       for i, record_date in enumerate(old_dates + recent_dates)])
+    db.commit()
+    columns = 'record_date, invest_principal, day_gszzl, day_earn, total_earn'
+    cur.execute(f'SELECT {columns} FROM user_fund_earnings ORDER BY record_date')
+    original = [tuple(row) for row in cur.fetchall()]
+
+    stats = main.archive_earnings()
+    assert stats['rows'] == len(old_dates) and stats['fail'] == 0
+    cur.execute('SELECT COUNT(*) FROM user_fund_earnings')
+    assert cur.fetchone()[0] == len(recent_dates)
+    # 读取透明合并归档：与归档前的明细完全一致
+    rows = main.load_earnings_rows(cur, 1, '000001')
+    assert [(row['record_date'], row['day_gszzl'], row['day_earn'], row['total_earn']) for row in rows] == [
+        (record_date, day_gszzl, day_earn, total_earn) for record_date, _, day_gszzl, day_earn, total_earn in original]
+
+    assert main.unarchive_earnings(cur, ['000001'], '0001-01-01') == len(old_dates)
+    db.commit()
+    cur.execute(f'SELECT {columns} FROM user_fund_earnings ORDER BY record_date')
+    assert [tuple(row) for row in cur.fetchall()] == original
+
+
+def test_trend_rollups_match_raw_earnings(client, db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote())])
+    cur.execute("UPDATE user_fund_relation SET add_time = '2025-03-03 09:00:00'")
+    cur.execute('DELETE FROM user_fund_earnings')
+    cur.execute('DELETE FROM user_fund_summary')
+    raw = [((date(2025, 3, 3) + timedelta(days=i)).isoformat(), round((i % 5 - 2) * 0.31, 2), round(i * 0.73 - 20, 2))
+           for i in range(120) if (date(2025, 3, 3) + timedelta(days=i)).weekday() < 5]
+    insert_earnings(cur, 1, '000001', raw)
+    db.commit()
+    cur.execute("SELECT record_date, day_earn, total_earn FROM user_fund_earnings ORDER BY record_date")
+    earnings = cur.fetchall()
+    query = '/api/fund/chart/trend/000001?to=2025-06-30&granularity='
+
+    for period in ('week', 'month'):
+        data = client.get(query + period).get_json()['data']
+        groups = {}
+        for row in earnings:
+            groups.setdefault(main.period_start_of(row['record_date'], period), []).append(row)
+        assert [point['date'] for point in data['trend_list']] == sorted(groups)
+        for point in data['trend_list']:
+            rows = groups[point['date']]
+            assert point['days'] == len(rows) and point['end_date'] == rows[-1]['record_date']
+            assert point['day_earn'] == round(sum(row['day_earn'] for row in rows), 2)
+            assert point['total_earn'] == rows[-1]['total_earn']
+            assert point['high'] == max(row['total_earn'] for row in rows)
+
+    # 按天分页：各页拼接后与明细一致
+    points, cursor = [], ''
+    while True:
+        data = client.get(f'{query}day&limit=25&cursor={cursor}').get_json()['data']
+        points += data['trend_list']
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+    assert [(point['date'], point['day_earn'], point['total_earn']) for point in points] == [
+        tuple(row) for row in earnings]
+
+
+def test_session_store_saves_loads_and_expires(db):
+    store = main.SESSION_STORE
+    store.cache.invalidate()
+    client = main.app.test_client()
+    writes = store.writes
+    assert client.post('/api/login', json={'username': 'admin', 'password': '123456'}).get_json()['code'] == 200
+    assert store.writes == writes + 1
+    cur = db.cursor()
+    cur.execute('SELECT sid FROM user_sessions')
+    [(sid,)] = [tuple(row) for row in cur.fetchall()]
+    assert client.get_cookie(main.app.config['SESSION_COOKIE_NAME']).value == sid
+
+    # 读取：缓存失效后查库，未修改且有效期充足时不写库
+    store.cache.invalidate()
+    assert client.get('/api/fund/list').get_json()['code'] == 200
+    assert store.writes == writes + 1 and store.load_session_data(sid)[0]['username'] == 'admin'
+
+    # 过期：库中过期的Session视为未登录
+    cur.execute('UPDATE user_sessions SET expires_at = ?', (time.time() - 1,))
+    db.commit()
+    store.cache.invalidate()
+    response = client.get('/api/fund/list')
+    assert response.status_code == 401 and store.load_session_data(sid) is None
+
+    # 登出删除库中记录
+    client.post('/api/login', json={'username': 'admin', 'password': '123456'})
+    client.get('/api/logout')
+    cur.execute('SELECT COUNT(*) FROM user_sessions WHERE expires_at > ?', (time.time(),))
+    assert cur.fetchone()[0] == 0
+
+
+def test_batch_add_update_and_delete_report_per_fund_results(client, db, monkeypatch):
+    monkeypatch.setattr(main, 'fetch_funds_real', lambda codes, deadline=None: {code: make_quote() for code in codes})
+    monkeypatch.setattr(main, 'create_history_source', lambda spec=None: None)
+    response = client.post('/api/fund/batch', json={'funds': [
+        {'fundcode': '000001', 'invest_principal': 100}, {'fundcode': '000002', 'invest_principal': 200},
+        {'fundcode': '000003', 'invest_principal': 0}, {'fundcode': '000001', 'invest_principal': 100}]})
+    assert [item['code'] for item in response.get_json()['data']] == [400, 200, 400]  # 每只基金一条结果，重复代码整体拒绝
+    response = client.post('/api/fund/batch', json={'funds': [
+        {'fundcode': '000001', 'invest_principal': 100}, {'fundcode': '000002', 'invest_principal': 200}]})
+    assert [item['code'] for item in response.get_json()['data']] == [200, 409]
+
+    response = client.put('/api/fund/batch/principal', json={'funds': [
+        {'fundcode': '000001', 'invest_principal': 300}, {'fundcode': '000009', 'invest_principal': 300}]})
+    assert [item['code'] for item in response.get_json()['data']] == [200, 404]
+    cur = db.cursor()
+    cur.execute('SELECT fund_code, invest_principal FROM user_fund_relation WHERE user_id = 1 ORDER BY fund_code')
+    assert [tuple(row) for row in cur.fetchall()] == [('000001', 300.0), ('000002', 200.0)]
+
+    response = client.delete('/api/fund/batch', json={'fund_codes': ['000001', '000009', '000002']})
+    assert [item['code'] for item in response.get_json()['data']] == [200, 404, 200]
+    cur.execute('SELECT COUNT(*) FROM user_fund_relation WHERE user_id = 1')
+    assert cur.fetchone()[0] == 0
+
+
+def test_portfolio_stream_pushes_changed_and_removed_funds(db):
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote()), ('000002', 1000.0, make_quote())])
+    db.commit()
+    subscriber = main.QUOTE_BROKER.subscribe(1, ['000001', '000002'])
+    stream = main.generate_portfolio_stream(subscriber)
+    assert next(stream).startswith('retry:')
+
+    def change_funds():
+        conn = sqlite3.connect(main.DATABASE)
+        conn.execute("UPDATE user_fund_relation SET invest_principal = 2000 WHERE fund_code = '000001'")
+        conn.execute("DELETE FROM user_fund_relation WHERE fund_code = '000002'")
+        conn.commit()
+        conn.close()
+        main.invalidate_portfolio_snapshot(1)
+
+    timer = threading.Timer(0.2, change_funds)  # 基线快照计算完、等待通知时修改
+    timer.start()
+    event = next(stream)
+    timer.join()
+    stream.close()
+    assert event.startswith('event: update\n')
+    data = json.loads(event.split('data: ', 1)[1])
+    assert [fund['fund_code'] for fund in data['funds']] == ['000001'] and data['removed'] == ['000002']
+    assert data['funds'][0]['invest_principal'] == 2000.0 and data['stat']['total_invest'] == 2000.0
+    assert subscriber not in main.QUOTE_BROKER.subscribers
+
+
+def test_async_app_returns_same_body_as_wsgi_and_prefetches_outdated_quotes(client, db, monkeypatch):
+    import asyncio
+    import httpx
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    requested = []
+
+    class FundApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            quote = {'fundcode': '000002', 'name': '测试基金', 'jzrq': TODAY, 'dwjz': '1.0', 'gsz': '1.03',
+                     'gszzl': '3.0', 'gztime': f'{TODAY} 14:30'}
+            body = f'jsonpgz({json.dumps(quote, ensure_ascii=False)});'.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/javascript; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FundApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(main, 'FUND_API_URL', f'http://127.0.0.1:{server.server_port}/js/{{fund_code}}.js')
+    main.FUND_FAILURES.clear()
+    cur = db.cursor()
+    main.insert_user_funds(cur, 1, [('000001', 1000.0, make_quote()), ('000002', 500.0, make_quote(1.0))])
+    cur.execute("UPDATE fund_intraday_quote SET update_ts = 0 WHERE fund_code = '000002'")  # 后台刷新未运行
+    db.commit()
+    cookie = client.get_cookie(main.app.config['SESSION_COOKIE_NAME']).value
+    paths = ['/api/fund/dashboard', '/api/fund/list', '/api/fund/chart/trend/000002', '/api/fund/chart/trend/000001']
+
+    async def request_all():
+        transport = httpx.ASGITransport(app=main.AsyncPortfolioApp(main.app))
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver',
+                                     cookies={main.app.config['SESSION_COOKIE_NAME']: cookie}) as async_client:
+            responses = [await async_client.get(path) for path in paths]
+            responses.append(await async_client.post('/api/login', json={'username': 'admin', 'password': 'x'}))
+            return responses
+
+    try:
+        async_responses = asyncio.run(request_all())
+    finally:
+        server.shutdown()
+        server.server_close()
+    # 事件循环上只拉取了行情过期的基金，Flask视图读缓存中的结果
+    assert len(requested) == 1 and requested[0].startswith('/js/000002.js')
+    funds = {fund['fund_code']: fund for fund in async_responses[0].json()['data']['list']}
+    assert funds['000002']['today_gszzl'] == 3.0
+    main.PORTFOLIO_SNAPSHOT_CACHE.invalidate()
+    for path, async_response in zip(paths, async_responses):
+        response = client.get(path)
+        assert async_response.status_code == response.status_code == 200
+        assert async_response.json() == response.get_json()
+    assert async_responses[-1].json() == client.post('/api/login', json={
+        'username': 'admin', 'password': 'x'}).get_json()
+    assert len(requested) == 1